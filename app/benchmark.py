@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Benchmark Module
+Times each stage of the render/PDF/zip pipeline on synthetic data
+
+Usage:
+    python -m app.benchmark
+    python -m app.benchmark --rows 100 1000 --resolutions 1754x1240 --out bench.json
+
+Each run writes a JSON report (rows/sec, p50/p99 per-row latency per stage,
+peak RSS) so runs before and after a change can be compared. Every case
+runs in a fresh process, so its peak RSS is its own rather than the
+high-water mark of the cases before it.
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+from PIL import Image, ImageDraw
+
+from .config import FONTS_DIR
+from .utils import metrics
+from .utils.excel_reader import read_excel_rows, iter_excel_rows, invalidate_dataset
+from .utils.image_processor import (
+    load_font, load_template, layout_certificate, draw_layout,
+    reset_font_caches, invalidate_template_cache
+)
+from .utils.pdf_generator import render_pdf_bytes, create_pdfs_from_rows, zip_files
+
+DEFAULT_RESOLUTIONS = ["1123x794", "2480x1754", "3508x2480"]
+DEFAULT_ROWS = [100, 1000, 10000]
+
+FIRST_NAMES = ["Aarav", "Priya", "Jonathan", "Mei", "Oluwaseun", "Sofia", "Maximilian", "Ana", "Raj", "Elizabeth"]
+LAST_NAMES = ["Sharma", "Nguyen", "Okafor", "Fitzgerald-Montgomery", "Li", "Garcia", "Venkataraman", "Smith"]
+COURSES = ["Python Basics", "Advanced Machine Learning and Data Engineering", "Cloud Fundamentals"]
+
+
+def _bundled_fonts():
+    return sorted(f.name for f in FONTS_DIR.glob("*.ttf"))
+
+
+def make_template(path: Path, width: int, height: int):
+    """Synthetic certificate background with gradients and noise (hard to compress)"""
+    img = Image.new("RGB", (width, height), "#f5f0e6")
+    draw = ImageDraw.Draw(img)
+    rnd = random.Random(width * height)
+    for i in range(0, height, 4):
+        shade = 200 + (i * 40 // height)
+        draw.line([(0, i), (width, i)], fill=(shade, 190, 160), width=2)
+    for _ in range(400):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        r = rnd.randrange(5, max(6, width // 20))
+        draw.ellipse([x - r, y - r, x + r, y + r], outline=(rnd.randrange(255), 120, 90))
+    border = max(8, width // 80)
+    draw.rectangle([border, border, width - border, height - border], outline="#8a6d3b", width=border // 2)
+    img.save(path, format="PNG")
+    return path
+
+
+def make_placeholders(width: int, height: int):
+    fonts = _bundled_fonts()
+    font = lambda i: fonts[i % len(fonts)] if fonts else None
+    return {
+        "name": {"label": "name", "columns": ["first_name", "last_name"], "x": width * 0.2, "y": height * 0.40,
+                 "width": width * 0.6, "height": height * 0.10, "font": font(0), "color": "#1a1a1a"},
+        "course": {"label": "course", "x": width * 0.15, "y": height * 0.55,
+                   "width": width * 0.7, "height": height * 0.06, "font": font(1), "color": "#333333", "underline": True},
+        "date": {"label": "date", "x": width * 0.1, "y": height * 0.8,
+                 "width": width * 0.25, "height": height * 0.05, "font": font(2), "color": "#333333"},
+    }
+
+
+def make_sheet(path: Path, rows: int):
+    rnd = random.Random(rows)
+    df = pd.DataFrame({
+        "first_name": [rnd.choice(FIRST_NAMES) for _ in range(rows)],
+        "last_name": [rnd.choice(LAST_NAMES) for _ in range(rows)],
+        "course": [rnd.choice(COURSES) for _ in range(rows)],
+        "date": ["2026-%02d-%02d" % (rnd.randint(1, 12), rnd.randint(1, 28)) for _ in range(rows)],
+    })
+    df.to_excel(path, index=False)
+    return path
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def _summary(samples, rows=None):
+    """Latency summary in milliseconds"""
+    total = sum(samples)
+    out = {
+        "count": len(samples),
+        "total_s": round(total, 4),
+        "p50_ms": round(_percentile(samples, 50) * 1000, 3) if samples else None,
+        "p99_ms": round(_percentile(samples, 99) * 1000, 3) if samples else None,
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3) if samples else None,
+    }
+    n = rows if rows is not None else len(samples)
+    if total > 0 and n:
+        out["rows_per_sec"] = round(n / total, 2)
+    return out
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Peak RSS of this process, or with RUSAGE_CHILDREN of the largest child it has waited for"""
+    peak = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(peak / divisor, 1)
+
+
+def bench_case(workdir: Path, width: int, height: int, rows: int, render_rows: int, output_mode: str, executor: str):
+    template = make_template(workdir / f"template_{width}x{height}.png", width, height)
+    sheet = make_sheet(workdir / f"data_{rows}.xlsx", rows)
+    placeholders = make_placeholders(width, height)
+    stages = {}
+
+    # Excel parse: full pandas parse vs streaming reader
+    invalidate_dataset(sheet)
+    t0 = time.perf_counter()
+    data = read_excel_rows(sheet)
+    stages["excel_parse"] = _summary([time.perf_counter() - t0], rows)
+    invalidate_dataset(sheet)
+    t0 = time.perf_counter()
+    streamed = sum(1 for _ in iter_excel_rows(sheet))
+    stages["excel_stream"] = _summary([time.perf_counter() - t0], streamed)
+
+    sample = data[:render_rows]
+
+    # Font load: cold loads of every font/size a fit might touch
+    reset_font_caches()
+    samples = []
+    for cfg in placeholders.values():
+        for size in range(12, 120, 8):
+            t0 = time.perf_counter()
+            load_font(FONTS_DIR, cfg.get("font"), size)
+            samples.append(time.perf_counter() - t0)
+    stages["font_load_cold"] = _summary(samples)
+
+    # Fit: per-row fitting with a cold memo, then warm
+    for label in ("fit_cold", "fit_warm"):
+        if label == "fit_cold":
+            reset_font_caches()
+        samples = []
+        for row in sample:
+            t0 = time.perf_counter()
+            layout_certificate(placeholders, row, FONTS_DIR, None)
+            samples.append(time.perf_counter() - t0)
+        stages[label] = _summary(samples)
+
+    # Draw: template copy + text drawing with precomputed layout
+    invalidate_template_cache()
+    samples = []
+    for row in sample:
+        ops = layout_certificate(placeholders, row, FONTS_DIR, None)
+        t0 = time.perf_counter()
+        draw_layout(load_template(template), ops)
+        samples.append(time.perf_counter() - t0)
+    stages["draw"] = _summary(samples)
+
+    # Whole row in the selected output mode, split into render and PDF encode
+    # (downsampling and image compression included) from the row's stage timings
+    samples, render_samples, encode_samples = [], [], []
+    for row in sample:
+        with metrics.collect() as timer:
+            t0 = time.perf_counter()
+            render_pdf_bytes(template, placeholders, row, FONTS_DIR, None, output_mode)
+            elapsed = time.perf_counter() - t0
+        encode = timer.totals.get("pdf_encode", 0.0) + timer.totals.get("downsample", 0.0)
+        samples.append(elapsed)
+        encode_samples.append(encode)
+        render_samples.append(elapsed - encode)
+    stages["render"] = _summary(render_samples)
+    stages["encode"] = _summary(encode_samples)
+    stages["row_total"] = _summary(samples)
+
+    # Batch: parallel generation to disk, then zip
+    out_dir = workdir / f"out_{width}x{height}_{rows}"
+    out_dir.mkdir()
+    t0 = time.perf_counter()
+    pdf_paths = create_pdfs_from_rows(template, sample, placeholders, FONTS_DIR, out_dir, None,
+                                      executor=executor, output_mode=output_mode)
+    stages["batch_generate"] = _summary([time.perf_counter() - t0], len(pdf_paths))
+    t0 = time.perf_counter()
+    zip_path = workdir / f"out_{width}x{height}_{rows}.zip"
+    zip_files(pdf_paths, zip_path)
+    stages["zip"] = _summary([time.perf_counter() - t0], len(pdf_paths))
+    pdf_bytes = sum(p.stat().st_size for p in pdf_paths)
+
+    return {
+        "resolution": f"{width}x{height}",
+        "rows": rows,
+        "rendered_rows": len(sample),
+        "output_mode": output_mode,
+        "executor": executor,
+        "avg_pdf_kb": round(pdf_bytes / max(1, len(pdf_paths)) / 1024, 1),
+        "zip_mb": round(zip_path.stat().st_size / (1024 * 1024), 2),
+        "stages": stages,
+    }
+
+
+def _isolated_case(*args):
+    """bench_case in this (fresh) process, with its own peak RSS and that of its render workers"""
+    case = bench_case(*args)
+    case["peak_rss_mb"] = _peak_rss_mb()
+    # Process-executor workers have exited by now; the largest of them
+    case["worker_peak_rss_mb"] = _peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return case
+
+
+def run_case(*args):
+    """Run one case in a new process so RSS figures are not inherited from earlier cases"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(_isolated_case, *args).result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the certificate render pipeline")
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS, help="synthetic sheet sizes")
+    parser.add_argument("--resolutions", nargs="+", default=DEFAULT_RESOLUTIONS, help="template sizes, WxH")
+    parser.add_argument("--max-render-rows", type=int, default=500,
+                        help="rows rendered per case (the whole sheet is always parsed)")
+    parser.add_argument("--output-mode", default="raster", choices=["raster", "vector"])
+    parser.add_argument("--executor", default="auto", choices=["thread", "process", "auto"])
+    parser.add_argument("--out", default="bench_output.json", help="JSON report path")
+    args = parser.parse_args(argv)
+
+    report = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "fonts": _bundled_fonts(),
+        "cases": [],
+    }
+    with tempfile.TemporaryDirectory(prefix="certbench_") as tmp:
+        workdir = Path(tmp)
+        for res in args.resolutions:
+            width, height = (int(v) for v in res.lower().split("x"))
+            for rows in args.rows:
+                print(f"[Bench] {res} x {rows} rows ({args.output_mode}, {args.executor})...")
+                case = run_case(workdir, width, height, rows, min(rows, args.max_render_rows),
+                                args.output_mode, args.executor)
+                print(f"[Bench]   row p50={case['stages']['row_total']['p50_ms']}ms "
+                      f"(encode {case['stages']['encode']['p50_ms']}ms) "
+                      f"p99={case['stages']['row_total']['p99_ms']}ms "
+                      f"batch={case['stages']['batch_generate'].get('rows_per_sec')} rows/s "
+                      f"rss={case['peak_rss_mb']}MB workers={case['worker_peak_rss_mb']}MB")
+                report["cases"].append(case)
+
+    report["peak_rss_mb"] = max((c["peak_rss_mb"] for c in report["cases"]), default=None)
+    Path(args.out).write_text(json.dumps(report, indent=2))
+    print(f"[Bench] Report written to {args.out}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
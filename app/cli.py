@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Command-line Batch Generator
+Renders certificates for a whole sheet without the web server
+
+Usage:
+    python -m app.cli --template cert.png --sheet people.xlsx --placeholders layout.json --out out/
+    python -m app.cli ... --shard 0/4 --resume --zip
+    python -m app.cli ... --zip --part-mb 500
+
+layout.json is either the placeholder mapping itself or the /set-placeholders
+payload ({"placeholders": {...}, "default_font": ..., "filename_field": ...}).
+
+--shard i/N renders every N-th row starting at row i (0 <= i < N), so N
+machines or processes pointed at the same sheet split it without overlap.
+--resume skips rows whose PDF already exists in the output folder; PDFs
+are written atomically, so anything present is complete.
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from .config import FONTS_DIR
+from .settings import OUTPUT_MODE
+from .utils.excel_reader import load_dataset, iter_excel_rows, count_rows, constant_columns
+from .utils.image_processor import index_fonts, static_placeholder_keys, plan_layout
+from .utils.pdf_generator import (
+    create_pdfs_from_rows, zip_files, pdf_filename, raster_encoding, OUTPUT_MODES, IMAGE_FORMATS
+)
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 5.0
+
+
+def parse_shard(value):
+    """"i/N" -> (i, N)"""
+    try:
+        index, count = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must look like i/N, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must satisfy 0 <= i < N")
+    return index, count
+
+
+def load_layout(path: Path):
+    """(placeholders, default_font, filename_field) from a layout JSON file"""
+    data = json.loads(Path(path).read_text(encoding="utf-8"))
+    if isinstance(data.get("placeholders"), dict):
+        return data["placeholders"], data.get("default_font"), data.get("filename_field")
+    return data, None, None
+
+
+def _progress_printer(label):
+    state = {"last": 0.0, "start": time.perf_counter()}
+
+    def report(done, total):
+        now = time.perf_counter()
+        if now - state["last"] < PROGRESS_INTERVAL and done != total:
+            return
+        state["last"] = now
+        rate = done / max(now - state["start"], 1e-9)
+        print(f"[CLI] {label}{done}/{total or '?'} rows ({rate:.1f} rows/s)", flush=True)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate certificate PDFs from a template and a sheet")
+    parser.add_argument("--template", required=True, type=Path, help="PNG/JPG certificate template")
+    parser.add_argument("--sheet", required=True, type=Path, help="XLSX/XLS/CSV with one row per certificate")
+    parser.add_argument("--placeholders", required=True, type=Path, help="placeholder layout JSON")
+    parser.add_argument("--out", required=True, type=Path, help="output folder for the PDFs")
+    parser.add_argument("--default-font", help="font for placeholders without one (overrides the JSON)")
+    parser.add_argument("--filename-field", help="column used in PDF names (overrides the JSON)")
+    parser.add_argument("--fonts-dir", type=Path, default=FONTS_DIR)
+    parser.add_argument("--output-mode", default=OUTPUT_MODE, choices=sorted(OUTPUT_MODES))
+    parser.add_argument("--image-format", choices=sorted(IMAGE_FORMATS), help="raster page compression")
+    parser.add_argument("--jpeg-quality", type=int, help="JPEG quality (1-100) for --image-format jpeg")
+    parser.add_argument("--dpi", type=int, help="downsample raster pages to this DPI")
+    parser.add_argument("--max-edge", type=int, help="longest raster page edge in pixels")
+    parser.add_argument("--executor", default="auto", choices=["thread", "process", "auto"])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--encode-workers", type=int, default=None, help="PDF encode threads (thread executor)")
+    parser.add_argument("--sink-workers", type=int, default=None, help="file writer threads (thread executor)")
+    parser.add_argument("--shard", type=parse_shard, default=(0, 1), metavar="i/N",
+                        help="render only rows where (row - 1) %% N == i")
+    parser.add_argument("--resume", action="store_true", help="skip rows whose PDF already exists")
+    parser.add_argument("--zip", action="store_true", help="also zip this shard's PDFs")
+    parser.add_argument("--part-mb", type=float, help="with --zip, write volumes of about this many MB")
+    parser.add_argument("--part-files", type=int, help="with --zip, write volumes of at most this many PDFs")
+    args = parser.parse_args(argv)
+
+    if (args.part_mb is not None and args.part_mb <= 0) or (args.part_files is not None and args.part_files <= 0):
+        parser.error("--part-mb and --part-files must be positive")
+    for path in (args.template, args.sheet, args.placeholders):
+        if not path.exists():
+            parser.error(f"{path} does not exist")
+    placeholders, default_font, filename_field = load_layout(args.placeholders)
+    default_font = args.default_font or default_font
+    filename_field = args.filename_field or filename_field
+    shard_index, shard_count = args.shard
+    out_dir = args.out
+    out_dir.mkdir(parents=True, exist_ok=True)
+    label = f"shard {shard_index}/{shard_count}: " if shard_count > 1 else ""
+
+    index_fonts(args.fonts_dir)
+    total = count_rows(args.sheet)
+    print(f"[CLI] {args.sheet.name}: {total} rows, {label}output -> {out_dir}")
+
+    # Same pre-passes the web job runs: fit each distinct text once, pre-draw sheet-constant fields.
+    # Only this shard's rows are planned, and nothing is written next to the user's sheet.
+    df = load_dataset(args.sheet, sidecar=False).iloc[shard_index::shard_count]
+    layout = plan_layout(placeholders, df, args.fonts_dir, default_font)
+    if layout["overflow_count"]:
+        print(f"[CLI] Warning: {layout['overflow_count']} placeholder texts do not fit their box")
+        for item in layout["overflow"][:5]:
+            print(f"[CLI]   row {item['row']} {item['placeholder']}: {item['text']!r} "
+                  f"({item['text_width']}px in a {item['box_width']}px box at {item['font_size']}px)")
+    static_keys = None
+    if args.output_mode == "raster":
+        static_keys = static_placeholder_keys(placeholders, constant_columns(args.sheet, df), df.columns) or None
+    del df
+
+    shard_names = []
+    resumed = 0
+
+    def row_filter(i, row):
+        nonlocal resumed
+        if (i - 1) % shard_count != shard_index:
+            return False
+        name = pdf_filename(i, row, filename_field)
+        shard_names.append(name)
+        if args.resume and (out_dir / name).exists():
+            resumed += 1
+            return False
+        return True
+
+    t0 = time.perf_counter()
+    pdf_paths = create_pdfs_from_rows(
+        args.template, iter_excel_rows(args.sheet), placeholders, args.fonts_dir, out_dir, default_font,
+        filename_field, executor=args.executor, workers=args.workers, total=total,
+        progress_callback=_progress_printer(label), output_mode=args.output_mode,
+        row_filter=row_filter, static_keys=static_keys, fits=layout["fits"],
+        encoding=raster_encoding(args.image_format, args.jpeg_quality, args.dpi, args.max_edge),
+        encode_workers=args.encode_workers, sink_workers=args.sink_workers
+    )
+    elapsed = time.perf_counter() - t0
+    failed = len(shard_names) - resumed - len(pdf_paths)
+    print(f"[CLI] Rendered {len(pdf_paths)} PDFs in {elapsed:.1f}s"
+          + (f", skipped {resumed} existing" if resumed else "")
+          + (f", {failed} failed" if failed else ""))
+
+    if args.zip:
+        suffix = f"-shard-{shard_index}-of-{shard_count}" if shard_count > 1 else ""
+        zip_path = out_dir / f"certificates{suffix}.zip"
+        files = [out_dir / name for name in shard_names if (out_dir / name).exists()]
+        max_part_bytes = int(args.part_mb * 1024 * 1024) if args.part_mb else None
+        written = zip_files(files, zip_path, max_part_bytes=max_part_bytes, max_part_files=args.part_files)
+        print(f"[CLI] Zipped {len(files)} PDFs into " + ", ".join(str(p) for p in written))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,7 +7,16 @@ TEMPLATES_DIR = STATIC_DIR / "templates"
 TEMP_DIR = STATIC_DIR / "temp"
 OUTPUT_DIR = STATIC_DIR / "output"
 FONTS_DIR = STATIC_DIR / "fonts"
+# uploads stored once by content hash (cas/<aa>/<sha256><ext>)
+CAS_DIR = STATIC_DIR / "cas"
+
+# server-side state shared by all worker processes (not served publicly)
+DATA_DIR = BASE_DIR / "data"
+STATE_DB_PATH = DATA_DIR / "state.sqlite3"
+# certificates rendered on demand (served only through /certificate/...)
+CERT_CACHE_DIR = DATA_DIR / "certificates"
 
 # default filenames
 TEMPLATE_FILENAME = "template.png"
 EXCEL_FILENAME = "data.xlsx"
+
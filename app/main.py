@@ -1,50 +1,163 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Form, Request, Depends
+from fastapi.responses import FileResponse, StreamingResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
-import shutil
+import re
 import uuid
+import zipfile
 from typing import Dict
+from urllib.parse import quote
 import os
 import time
 import asyncio
 from contextlib import asynccontextmanager
+from fastapi.concurrency import run_in_threadpool
 
 from .config import (
-    TEMPLATES_DIR, OUTPUT_DIR, TEMP_DIR, FONTS_DIR,
-    TEMPLATE_FILENAME, EXCEL_FILENAME
+    STATIC_DIR, TEMPLATES_DIR, OUTPUT_DIR, TEMP_DIR, FONTS_DIR, CAS_DIR,
+    STATE_DB_PATH, CERT_CACHE_DIR
 )
 
-from .utils.excel_reader import read_excel_rows
-from .utils.image_processor import render_certificate_image, pil_image_to_bytes
-from .utils.pdf_generator import create_pdfs_from_rows, zip_files
+from .utils.excel_reader import (
+    load_dataset, get_row_count, get_row,
+    iter_excel_rows, count_rows, constant_columns
+)
+from .utils.image_processor import (
+    invalidate_template_cache, template_cache_stats,
+    index_fonts, font_cache_stats, static_placeholder_keys, plan_layout
+)
+from .utils.preview import (
+    PREVIEW_FORMATS, preview_key, preview_scale, render_preview, preview_cache_stats
+)
+from .utils.pdf_generator import (
+    create_pdfs_from_rows, iter_pdf_bytes, stream_zip, create_merged_pdf, raster_encoding,
+    render_pdf_bytes, pdf_filename, OUTPUT_MODES, GenerationCancelled
+)
 from .utils.storage_manager import StorageManager
+from .utils.job_manager import JobManager
+from .utils.state_store import StateStore
+from .utils.content_store import ContentStore, config_hash
+from .utils.storage_index import StorageIndex, zip_part_name
+from .utils.incremental import IncrementalPlan, rebuild_zip
+from .utils.downloads import (
+    RangeNotSatisfiable, file_validators, parse_range, if_range_matches, iter_file
+)
+from .utils.on_demand import OnDemandStore
+from .utils.uploads import (
+    UploadStore, UploadWriter, UploadRejected, MultipartFileParser, MULTIPART_OVERHEAD, UPLOAD_KINDS, check_magic,
+    max_upload_bytes
+)
+from .utils import metrics
+from .settings import (
+    MAX_CONCURRENT_JOBS, JOB_HISTORY_LIMIT, JOB_HEARTBEAT_SECONDS, JOB_STALE_SECONDS, OUTPUT_MODE,
+    ZIP_RETENTION_HOURS, MAX_ZIP_FILES, DELETE_PDFS_AFTER_ZIP, AUTO_CLEANUP_ENABLED,
+    CLEANUP_INTERVAL_SECONDS, CLEANUP_BATCH_SIZE, CLEANUP_BATCH_PAUSE_SECONDS,
+    ZIP_PART_MAX_MB, ZIP_PART_MAX_FILES, CERTIFICATE_CACHE_MB, SESSION_TTL_HOURS, MAX_UPLOAD_STORAGE_MB
+)
+
+# Sessions and job status live in SQLite so every worker process sees the same state
+state_store = StateStore(STATE_DB_PATH)
+
+# Generated, temporary and stored upload files are indexed as they are written, so sizes never need a tree walk
+storage_index = StorageIndex(state_store, OUTPUT_DIR, TEMP_DIR, CAS_DIR)
+
+# Uploads are stored once by content hash and kept while referenced
+content_store = ContentStore(CAS_DIR, state_store, index=storage_index)
+
+# Resumable uploads in progress (part files live in the temp dir)
+upload_store = UploadStore(state_store, TEMP_DIR)
+
+# Published on-demand certificate jobs and their rendered-PDF cache
+on_demand = OnDemandStore(state_store, CERT_CACHE_DIR, CERTIFICATE_CACHE_MB * 1024 * 1024)
+
+# Initialize storage manager (retention, quotas and session expiry from settings)
+storage_manager = StorageManager(OUTPUT_DIR, TEMP_DIR, TEMPLATES_DIR, retention_hours=ZIP_RETENTION_HOURS,
+                                 content_store=content_store, index=storage_index,
+                                 max_zip_files=MAX_ZIP_FILES, state_store=state_store,
+                                 session_ttl_hours=SESSION_TTL_HOURS, max_cas_mb=MAX_UPLOAD_STORAGE_MB)
+
+# Generation batches run here so requests never wait on a whole batch
+job_manager = JobManager(max_concurrent_jobs=MAX_CONCURRENT_JOBS, history_limit=JOB_HISTORY_LIMIT,
+                         store=state_store, heartbeat_seconds=JOB_HEARTBEAT_SECONDS,
+                         stale_seconds=JOB_STALE_SECONDS)
+
+@metrics.register_collector
+def _cache_metrics():
+    tpl = template_cache_stats()
+    fonts = font_cache_stats()
+    previews = preview_cache_stats()
+    certificates = on_demand.stats()
+    return [
+        ("certgen_cache_hits_total", "counter", "Cache hits in this server process", [
+            ({"cache": "template"}, tpl["hits"]),
+            ({"cache": "font"}, fonts["font_hits"]),
+            ({"cache": "fit"}, fonts["fit_memo_hits"]),
+            ({"cache": "preview"}, previews["hits"]),
+            ({"cache": "certificate"}, certificates["hits"]),
+        ]),
+        ("certgen_cache_misses_total", "counter", "Cache misses in this server process", [
+            ({"cache": "template"}, tpl["misses"]),
+            ({"cache": "font"}, fonts["font_misses"]),
+            ({"cache": "fit"}, fonts["fit_memo_misses"]),
+            ({"cache": "preview"}, previews["misses"]),
+            ({"cache": "certificate"}, certificates["misses"]),
+        ]),
+    ]
 
-# Initialize storage manager (Retention: 24 hours)
-storage_manager = StorageManager(OUTPUT_DIR, TEMP_DIR, TEMPLATES_DIR, retention_hours=24)
+# Identifies this worker process when taking the shared cleanup lease
+_WORKER_ID = uuid.uuid4().hex
+_cleanup_lock = asyncio.Lock()
+
+async def run_cleanup(force=False):
+    """Clean up in bounded batches on a worker thread, leaving files of running jobs alone"""
+    totals = {}
+    async with _cleanup_lock:
+        if force:
+            # a forced cleanup also picks up files written behind the index's back
+            await run_in_threadpool(storage_index.rebuild)
+        while True:
+            stats = await run_in_threadpool(
+                lambda: storage_manager.full_cleanup(force=force, exclude_jobs=job_manager.active_job_ids(),
+                                                     max_items=CLEANUP_BATCH_SIZE,
+                                                     exclude_files=upload_store.part_names() | _receiving)
+            )
+            for key, value in stats.items():
+                totals[key] = totals.get(key, 0) + value
+            if sum(stats.values()) < CLEANUP_BATCH_SIZE:
+                return totals
+            await asyncio.sleep(CLEANUP_BATCH_PAUSE_SECONDS)
 
 async def scheduled_cleanup_task():
-    """Background task to clean up old files every hour"""
+    """Background task to clean up old files every CLEANUP_INTERVAL_SECONDS"""
     while True:
         try:
-            print(f"[Scheduler] Running hourly cleanup check...")
-            stats = storage_manager.full_cleanup()
-            if sum(stats.values()) > 0:
-                print(f"[Scheduler] Cleanup stats: {stats}")
+            # Only one worker process runs each pass
+            if state_store.try_lease("cleanup", _WORKER_ID, CLEANUP_INTERVAL_SECONDS * 0.9):
+                print(f"[Scheduler] Running scheduled cleanup check...")
+                stats = await run_cleanup()
+                if sum(stats.values()) > 0:
+                    print(f"[Scheduler] Cleanup stats: {stats}")
         except Exception as e:
             print(f"[Scheduler] Error during cleanup: {e}")
         
-        # Wait for 1 hour (3600 seconds)
-        await asyncio.sleep(3600)
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: Start the background task
-    task = asyncio.create_task(scheduled_cleanup_task())
+    # Startup: resolve the bundled fonts once
+    index_fonts(FONTS_DIR)
+    # First start only: index whatever is already on disk
+    await run_in_threadpool(storage_index.ensure_built)
+    # Jobs left queued/running by a worker that died are failed so their folders are usable again
+    await run_in_threadpool(job_manager.reap_stale)
+    # Start the background task
+    task = asyncio.create_task(scheduled_cleanup_task()) if AUTO_CLEANUP_ENABLED else None
     yield
     # Shutdown: Cancel task if needed (optional, simplistic handling here)
-    task.cancel()
+    if task is not None:
+        task.cancel()
+    job_manager.shutdown()
 
 app = FastAPI(title="Certificate Generator Backend", lifespan=lifespan)
 
@@ -61,51 +174,219 @@ app.mount("/outputs", StaticFiles(directory=OUTPUT_DIR), name="outputs")
 
 
 
-# in-memory store (simple)
-CURRENT = {
-    "template_path": None,
-    "excel_path": None,
-    "placeholders": {},
-    "default_font": None,
-    "filename_field": None
-}
+_SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+_FOLDER_NAME_RE = re.compile(r"^\w[\w\- .]{0,127}$")
+
+def _sent_session_id(request: Request):
+    return (
+        request.headers.get("x-session-id")
+        or request.query_params.get("session_id")
+        or request.cookies.get("session_id")
+    )
+
+@app.middleware("http")
+async def assign_session(request: Request, call_next):
+    """Clients that send no session id (such as a plain browser) get their own session in a cookie"""
+    new_sid = None
+    if not _sent_session_id(request):
+        new_sid = uuid.uuid4().hex
+        request.state.session_id = new_sid
+    response = await call_next(request)
+    if new_sid is not None:
+        max_age = int(SESSION_TTL_HOURS * 3600) if SESSION_TTL_HOURS else None
+        response.set_cookie("session_id", new_sid, max_age=max_age, httponly=True, samesite="lax")
+    return response
+
+def get_session_id(request: Request) -> str:
+    """Session from the X-Session-Id header, ?session_id=, the session_id cookie or the one just assigned"""
+    sid = _sent_session_id(request) or getattr(request.state, "session_id", None)
+    if not sid:
+        raise HTTPException(400, "Missing session id")
+    if not _SESSION_ID_RE.match(sid):
+        raise HTTPException(400, "Invalid session id")
+    return sid
+
+def get_session(session_id: str = Depends(get_session_id)) -> dict:
+    return state_store.get_session(session_id)
+
+def _upload_error(e: UploadRejected):
+    return HTTPException(e.status, str(e))
+
+# Temp files of one-shot uploads still being received (kept out of temp cleanup)
+_receiving = set()
 
-def save_upload(file: UploadFile, dest: Path) -> Path:
-    dest.parent.mkdir(parents=True, exist_ok=True)
-    with dest.open("wb") as f:
-        shutil.copyfileobj(file.file, f)
-    return dest
+async def save_upload(request: Request, kind: str, bad_ext_message: str):
+    """Stream the multipart "file" field to a temp file while hashing and checking it, then store it
+
+    The endpoint takes the raw request, so nothing is spooled before this
+    runs: a Content-Length above the limit is refused before the body is
+    read, and the body is parsed chunk by chunk as it arrives. Oversized or
+    mislabelled files are refused as soon as the offending chunk arrives.
+    """
+    limit = max_upload_bytes(kind)
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > limit + MULTIPART_OVERHEAD:
+        raise HTTPException(413, f"Upload exceeds the {limit // (1024 * 1024)} MB limit")
+    tmp = TEMP_DIR / f"upload-{uuid.uuid4().hex}.part"
+    writer = None
+    _receiving.add(tmp.name)
+    try:
+        parser = MultipartFileParser(request.headers.get("content-type"))
+        async for chunk in request.stream():
+            data = parser.feed(chunk)
+            if writer is None and parser.filename is not None:
+                ext = Path(parser.filename).suffix.lower()
+                if ext not in UPLOAD_KINDS[kind]:
+                    raise HTTPException(400, bad_ext_message)
+                writer = await run_in_threadpool(UploadWriter, tmp, ext, limit)
+                # indexed so a file left behind by a crashed worker still ages out of temp
+                storage_index.add(tmp, "temp")
+            if data:
+                await run_in_threadpool(writer.write, data)
+        parser.finish()
+        sha = writer.finish()
+        return await run_in_threadpool(content_store.put_file, tmp, ext, sha)
+    except UploadRejected as e:
+        raise _upload_error(e)
+    finally:
+        _receiving.discard(tmp.name)
+        if writer is not None:
+            writer.close()
+            storage_index.remove(tmp)
+        tmp.unlink(missing_ok=True)
+
+def _accept_template(session_id: str, sha: str, dest: Path, created: bool):
+    previous = state_store.get_session(session_id).get("template_path")
+    if previous and previous != dest:
+        invalidate_template_cache(previous)
+    content_store.set_ref(f"session:{session_id}:template", sha)
+    state_store.update_session(session_id, template_path=dest)
+    return {"status": "ok", "template": dest.name, "session_id": session_id,
+            "sha256": sha, "deduplicated": not created}
+
+async def _accept_excel(session_id: str, sha: str, dest: Path, created: bool):
+    # Parse once here; headers, previews and generation reuse the cached dataset
+    try:
+        df = await run_in_threadpool(load_dataset, dest)
+    except Exception as e:
+        raise HTTPException(400, f"Error reading excel: {str(e)}")
+    # the parsed-sheet sidecar written next to the blob counts toward upload storage
+    content_store.index_derived(dest)
+    content_store.set_ref(f"session:{session_id}:excel", sha)
+    state_store.update_session(session_id, excel_path=dest)
+    return {"status": "ok", "excel": dest.name, "rows": len(df), "headers": df.columns.tolist(),
+            "session_id": session_id, "sha256": sha, "deduplicated": not created}
 
 @app.post("/upload-template")
-async def upload_template(file: UploadFile = File(...)):
-    ext = Path(file.filename).suffix.lower()
-    if ext not in {".png", ".jpg", ".jpeg"}:
-        raise HTTPException(400, "Template must be PNG or JPG")
-    dest = TEMPLATES_DIR / TEMPLATE_FILENAME
-    save_upload(file, dest)
-    CURRENT["template_path"] = dest
-    return {"status": "ok", "template": dest.name}
+async def upload_template(request: Request, session_id: str = Depends(get_session_id)):
+    """multipart/form-data with the image in a "file" field"""
+    sha, dest, created = await save_upload(request, "template", "Template must be PNG or JPG")
+    return _accept_template(session_id, sha, dest, created)
 
 @app.get("/template")
-def get_template(request: Request):
-    tpl = CURRENT.get("template_path")
+def get_template(request: Request, session: dict = Depends(get_session)):
+    tpl = session.get("template_path")
     if not tpl or not tpl.exists():
         return {"url": None}
-    return {"url": str(request.base_url) + f"static/templates/{tpl.name}"}
+    return {"url": str(request.base_url) + f"static/{tpl.relative_to(STATIC_DIR).as_posix()}"}
 
 @app.post("/upload-excel")
-async def upload_excel(file: UploadFile = File(...)):
-    ext = Path(file.filename).suffix.lower()
-    if ext not in {".xlsx", ".xls"}:
-        raise HTTPException(400, "Excel must be XLSX or XLS")
-    dest = TEMP_DIR / EXCEL_FILENAME
-    save_upload(file, dest)
-    CURRENT["excel_path"] = dest
-    return {"status": "ok", "excel": dest.name}
+async def upload_excel(request: Request, session_id: str = Depends(get_session_id)):
+    """multipart/form-data with the sheet in a "file" field"""
+    # The stored blob keeps its extension so the reader knows how to parse CSV
+    sha, dest, created = await save_upload(request, "excel", "Excel must be XLSX, XLS or CSV")
+    return await _accept_excel(session_id, sha, dest, created)
+
+# ---- resumable uploads ----
+# POST /uploads announces kind, filename and size; the client then PUTs the
+# bytes in any number of chunks, each with an Upload-Offset header equal to
+# the offset the server reports. After a dropped connection, GET /uploads/{id}
+# tells it where to continue. POST /uploads/{id}/complete hands the file to
+# the same path as a one-shot upload.
+
+def _upload_state(upload: dict):
+    return {"upload_id": upload["upload_id"], "kind": upload["kind"], "filename": upload["filename"],
+            "size": upload["size"], "offset": upload["received"],
+            "complete": upload["received"] == upload["size"]}
+
+def _get_upload(upload_id: str, session_id: str):
+    upload = upload_store.get(upload_id, session_id)
+    if upload is None:
+        raise HTTPException(404, "Upload not found or expired")
+    return upload
+
+@app.post("/uploads")
+async def create_upload(payload: Dict, session_id: str = Depends(get_session_id)):
+    try:
+        size = int(payload.get("size") or 0)
+    except (TypeError, ValueError):
+        raise HTTPException(400, "size must be an integer")
+    try:
+        upload = upload_store.create(session_id, payload.get("kind"), payload.get("filename"), size)
+    except UploadRejected as e:
+        raise _upload_error(e)
+    return _upload_state(upload)
+
+@app.get("/uploads/{upload_id}")
+def get_upload(upload_id: str, session_id: str = Depends(get_session_id)):
+    return _upload_state(_get_upload(upload_id, session_id))
+
+@app.put("/uploads/{upload_id}")
+async def put_upload_chunk(upload_id: str, request: Request, session_id: str = Depends(get_session_id)):
+    upload = _get_upload(upload_id, session_id)
+    try:
+        offset = int(request.headers.get("upload-offset", ""))
+    except ValueError:
+        raise HTTPException(400, "Upload-Offset header required")
+    if offset != upload["received"]:
+        raise HTTPException(409, {"message": "Offset mismatch", "offset": upload["received"]})
+    writer = await run_in_threadpool(upload_store.writer, upload)
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await run_in_threadpool(writer.write, chunk)
+    except UploadRejected as e:
+        raise _upload_error(e)
+    finally:
+        # Keep whatever arrived, even if the client went away mid-chunk; it resumes from here
+        writer.close()
+        committed = upload_store.commit(upload_id, offset, writer)
+        storage_index.add(writer.path, "temp")
+    if not committed:
+        raise HTTPException(409, "Upload was modified by a concurrent request")
+    return _upload_state(_get_upload(upload_id, session_id))
+
+@app.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str, session_id: str = Depends(get_session_id)):
+    upload = _get_upload(upload_id, session_id)
+    if upload["received"] != upload["size"]:
+        raise HTTPException(409, {"message": "Upload incomplete", "offset": upload["received"]})
+    part = upload_store.part_path(upload_id)
+    try:
+        with part.open("rb") as f:
+            check_magic(upload["ext"], f.read(8))
+    except UploadRejected as e:
+        upload_store.discard(upload_id)
+        storage_index.remove(part)
+        raise _upload_error(e)
+    # Hashed chunk by chunk as it arrived; put_file only reads the file if another process took the last chunk
+    sha, dest, created = await run_in_threadpool(content_store.put_file, part, upload["ext"],
+                                                 upload_store.sha256(upload))
+    upload_store.discard(upload_id)
+    storage_index.remove(part)
+    if upload["kind"] == "template":
+        return _accept_template(session_id, sha, dest, created)
+    return await _accept_excel(session_id, sha, dest, created)
+
+@app.delete("/uploads/{upload_id}")
+def delete_upload(upload_id: str, session_id: str = Depends(get_session_id)):
+    upload_store.discard(_get_upload(upload_id, session_id)["upload_id"])
+    storage_index.remove(upload_store.part_path(upload_id))
+    return {"status": "deleted", "upload_id": upload_id}
 
 @app.get("/excel-headers")
-async def get_excel_headers():
-    excel = CURRENT.get("excel_path")
+async def get_excel_headers(session: dict = Depends(get_session)):
+    excel = session.get("excel_path")
     if not excel or not excel.exists():
         raise HTTPException(400, "Excel not uploaded")
     try:
@@ -116,7 +397,7 @@ async def get_excel_headers():
         raise HTTPException(400, f"Error reading headers: {str(e)}")
 
 @app.post("/set-placeholders")
-async def set_placeholders(payload: Dict):
+async def set_placeholders(payload: Dict, session_id: str = Depends(get_session_id)):
     placeholders = payload.get("placeholders")
     default_font = payload.get("default_font")
     filename_field = payload.get("filename_field")
@@ -129,79 +410,588 @@ async def set_placeholders(payload: Dict):
         if "x" not in v or "y" not in v or "width" not in v or "height" not in v:
             raise HTTPException(400, f"Placeholder '{key}' missing x/y/width/height")
     
-    CURRENT["placeholders"] = placeholders
-    CURRENT["default_font"] = default_font
-    CURRENT["filename_field"] = filename_field
+    state_store.update_session(session_id, placeholders=placeholders, default_font=default_font,
+                               filename_field=filename_field)
     return {"status": "ok"}
 
-@app.post("/preview")
-async def preview_image(row_index: int = Form(0)):
-    tpl = CURRENT["template_path"]
-    excel = CURRENT["excel_path"]
-    placeholders = CURRENT["placeholders"]
+def _etag_matches(request: Request, etag: str):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in {t.strip().removeprefix("W/") for t in header.split(",")}
+
+async def _preview_response(request, session, row_index, width, scale, fmt, quality):
+    tpl = session["template_path"]
+    excel = session["excel_path"]
+    placeholders = session["placeholders"]
     if not tpl or not tpl.exists():
         raise HTTPException(400, "Template not uploaded")
     if not excel or not excel.exists():
         raise HTTPException(400, "Excel not uploaded")
-    rows = read_excel_rows(excel)
-    if row_index < 0 or row_index >= len(rows):
+    fmt = (fmt or "png").lower()
+    if fmt not in PREVIEW_FORMATS:
+        raise HTTPException(400, f"format must be one of {sorted(PREVIEW_FORMATS)}")
+    if (width is not None and width <= 0) or (scale is not None and scale <= 0):
+        raise HTTPException(400, "width and scale must be positive")
+    quality = min(100, max(1, quality)) if quality else None
+    if row_index < 0 or row_index >= await run_in_threadpool(get_row_count, excel):
         raise HTTPException(400, "row_index out of bounds")
-    row = rows[row_index]
-    img = render_certificate_image(tpl, placeholders, row, FONTS_DIR, CURRENT.get("default_font"))
-    data = pil_image_to_bytes(img, format="PNG")
-    return StreamingResponse(iter([data]), media_type="image/png")
+
+    scale = await run_in_threadpool(preview_scale, tpl, width, scale)
+    # The ETag is derived from the inputs, so an unchanged preview is answered without rendering
+    etag = '"' + preview_key(content_store.hash_of(tpl), content_store.hash_of(excel), row_index, placeholders,
+                             session.get("default_font"), scale, fmt, quality) + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    row = await run_in_threadpool(get_row, excel, row_index)
+    data = await run_in_threadpool(render_preview, etag, tpl, placeholders, row, FONTS_DIR,
+                                   session.get("default_font"), scale, fmt, quality)
+    return Response(data, media_type=PREVIEW_FORMATS[fmt][1], headers=headers)
+
+@app.post("/preview")
+async def preview_image(request: Request, row_index: int = Form(0), width: int = Form(None),
+                        scale: float = Form(None), format: str = Form("png"), quality: int = Form(None),
+                        session: dict = Depends(get_session)):
+    return await _preview_response(request, session, row_index, width, scale, format, quality)
+
+@app.get("/preview")
+async def preview_image_get(request: Request, row_index: int = 0, width: int = None, scale: float = None,
+                            format: str = "png", quality: int = None, session: dict = Depends(get_session)):
+    """Same as POST /preview; as a GET the browser can revalidate it with If-None-Match"""
+    return await _preview_response(request, session, row_index, width, scale, format, quality)
+
+def _timing_breakdown(timings):
+    return {
+        stage: {"seconds": round(v["seconds"], 4), "count": v["count"]}
+        for stage, v in sorted(timings.items())
+    }
+
+def _static_keys(excel, placeholders, output_mode):
+    """Placeholders with the same text on every row (raster pages draw them once into a shared background)"""
+    if (output_mode or OUTPUT_MODE) != "raster":
+        return None
+    keys = static_placeholder_keys(placeholders, constant_columns(excel), load_dataset(excel).columns)
+    return keys or None
+
+def _plan_layout(job, excel, placeholders, default_font):
+    """Fit each distinct placeholder text once up front; rows then draw with the stored sizes"""
+    t0 = time.perf_counter()
+    layout = plan_layout(placeholders, load_dataset(excel), FONTS_DIR, default_font)
+    job.timings["layout_plan"] = {"seconds": time.perf_counter() - t0, "count": 1}
+    if layout["overflow_count"]:
+        print(f"[Jobs] Job {job.job_id}: {layout['overflow_count']} placeholder texts do not fit their box")
+    return layout
+
+_NOTHING_RENDERED = "No certificate could be rendered; see the server log for the per-row errors"
+
+def _run_generation(job, tpl, excel, placeholders, default_font, filename_field, output_mode, merged=False,
+                    include_timings=False, memo=None, row_base=None, encoding=None, zip_parts=None):
+    """Job body: read rows, render every PDF and zip the batch
+
+    memo is (gen_key, template_sha, sheet_sha); the finished output is
+    recorded under it so an identical request can reuse it. row_base hashes
+    the template and config; rerunning into the same folder only renders
+    rows whose fingerprint under it changed. encoding holds the raster
+    page resolution/compression settings from raster_encoding().
+    """
+    total = count_rows(excel)
+    if total == 0:
+        raise ValueError("No rows found in excel")
+    job.set_total(total)
+    # This job's outputs are about to be overwritten; stop serving them as cached results
+    if merged:
+        content_store.forget_output(f"{job.job_id}.pdf")
+    else:
+        content_store.forget_output(f"{job.job_id}.zip")
+        content_store.forget_output(zip_part_name(OUTPUT_DIR / f"{job.job_id}.zip", 1).name)
+    layout = _plan_layout(job, excel, placeholders, default_font)
+    if merged:
+        # One multi-page PDF for printing instead of a zip of single PDFs
+        pdf_path = OUTPUT_DIR / f"{job.job_id}.pdf"
+        count = create_merged_pdf(
+            tpl, iter_excel_rows(excel), placeholders, FONTS_DIR, pdf_path, default_font,
+            progress_callback=job.progress, cancel_event=job.cancel_event, total=total,
+            timings=job.timings, fits=layout["fits"], encoding=encoding
+        )
+        if count == 0:
+            pdf_path.unlink(missing_ok=True)
+            raise ValueError(_NOTHING_RENDERED)
+        storage_index.add(pdf_path, "pdf", job.job_id)
+        result = {
+            "pdf": pdf_path.name,
+            "count": count,
+            "failed": total - count,
+            "overflow_count": layout["overflow_count"],
+            "job_id": job.job_id
+        }
+        # Only a complete output may stand in for a later identical request
+        if memo and count == total:
+            content_store.record_generation(memo[0], job.job_id, pdf_path.name, result, memo[1], memo[2])
+        if include_timings:
+            result["timings"] = _timing_breakdown(job.timings)
+        return result
+    job_folder = OUTPUT_DIR / job.job_id
+    job_folder.mkdir(parents=True, exist_ok=True)
+    storage_index.add(job_folder, "job_dir", job.job_id)
+    zip_path = OUTPUT_DIR / f"{job.job_id}.zip"
+    # Rows unchanged since the last run into this folder keep their PDF (on disk or in the old zip or volumes)
+    plan = IncrementalPlan(content_store.load_row_fingerprints(job.job_id), placeholders, filename_field,
+                           row_base or "", job_folder,
+                           [zip_path, *storage_index.job_items(job.job_id, ("zip_part",))])
+    # Rows are streamed from the sheet so memory stays flat for any sheet size
+    pdf_paths = create_pdfs_from_rows(
+        tpl, iter_excel_rows(excel), placeholders, FONTS_DIR, job_folder, default_font, filename_field,
+        progress_callback=job.progress, cancel_event=job.cancel_event, total=total,
+        output_mode=output_mode, timings=job.timings, row_filter=plan,
+        static_keys=_static_keys(excel, placeholders, output_mode), fits=layout["fits"], encoding=encoding
+    )
+    storage_index.add_many(pdf_paths, "job_file", job.job_id)
+    fingerprints = plan.finish([p.name for p in pdf_paths])
+    storage_index.remove_many(job_folder / name for name in plan.removed)
+    file_list = sorted({p.name for p in pdf_paths} | plan.reused)
+    if not file_list:
+        raise ValueError(_NOTHING_RENDERED)
+    t0 = time.perf_counter()
+    parts = []
+    if zip_parts and any(zip_parts):
+        # Volumes are written straight from the PDFs; no full zip is built alongside them
+        parts = rebuild_zip(zip_path, file_list, job_folder, old_archives=plan.old_archives,
+                            max_part_bytes=zip_parts[0], max_part_files=zip_parts[1])
+        storage_index.add_many(parts, "zip_part", job.job_id)
+        # The archives of an earlier run describe the old batch
+        storage_manager.discard_zip_parts(job.job_id, keep=parts)
+        storage_manager.discard_zip(job.job_id)
+    else:
+        rebuild_zip(zip_path, file_list, job_folder, old_archives=plan.old_archives)
+        storage_index.add(zip_path, "zip", job.job_id)
+        storage_manager.discard_zip_parts(job.job_id)
+    job.timings["zip"] = {"seconds": time.perf_counter() - t0, "count": len(parts) or 1}
+    content_store.save_row_fingerprints(job.job_id, fingerprints)
+    if DELETE_PDFS_AFTER_ZIP:
+        # The zip holds every PDF; an incremental rerun copies unchanged ones back out of it
+        storage_manager.discard_job_folder(job.job_id)
+
+    # Otherwise files are kept for preview (cleaned up by the background scheduler after retention)
+    result = {
+        "zip": None if parts else zip_path.name,
+        "count": len(file_list),
+        "rendered": len(pdf_paths),
+        "reused": len(plan.reused),
+        "failed": total - len(file_list),
+        "overflow_count": layout["overflow_count"],
+        "job_id": job.job_id,
+    }
+    if DELETE_PDFS_AFTER_ZIP:
+        # /outputs/{job}/{file} is gone; the names only describe the zip's entries
+        result["zip_entries"] = file_list
+    else:
+        result["files"] = file_list
+    if parts:
+        result["parts"] = [p.name for p in parts]
+    if memo and len(file_list) == total:
+        output_name = parts[0].name if parts else zip_path.name
+        content_store.record_generation(memo[0], job.job_id, output_name, result, memo[1], memo[2])
+    if include_timings:
+        result["timings"] = _timing_breakdown(job.timings)
+    return result
+
+def _hold_inputs(job_id: str, template_sha: str, sheet_sha: str):
+    """Keep a job's template and sheet stored while it runs, even if its session uploads new ones"""
+    content_store.set_ref(f"job:{job_id}:template", template_sha)
+    content_store.set_ref(f"job:{job_id}:sheet", sheet_sha)
+
+def _release_inputs(job_id: str):
+    content_store.release_refs(f"job:{job_id}:")
+
+def _generation_job(job, *args, **kwargs):
+    """_run_generation, letting go of the job's inputs when it ends"""
+    try:
+        return _run_generation(job, *args, **kwargs)
+    finally:
+        _release_inputs(job.job_id)
 
 @app.post("/generate")
-async def generate_all(folder_name: str = Form(None)):
-    tpl = CURRENT["template_path"]
-    excel = CURRENT["excel_path"]
-    placeholders = CURRENT["placeholders"]
-    filename_field = CURRENT.get("filename_field")
+async def generate_all(folder_name: str = Form(None), stream: bool = Form(False), output_mode: str = Form(None),
+                       merged: bool = Form(False), timings: bool = Form(False),
+                       image_format: str = Form(None), jpeg_quality: int = Form(None), dpi: int = Form(None),
+                       max_edge: int = Form(None), part_mb: float = Form(None), part_files: int = Form(None),
+                       session: dict = Depends(get_session)):
+    tpl = session["template_path"]
+    excel = session["excel_path"]
+    placeholders = session["placeholders"]
+    filename_field = session.get("filename_field")
     
     if not tpl or not tpl.exists():
         raise HTTPException(400, "Template not uploaded")
     if not excel or not excel.exists():
         raise HTTPException(400, "Excel not uploaded")
-    rows = read_excel_rows(excel)
-    if len(rows) == 0:
-        raise HTTPException(400, "No rows found in excel")
+    if output_mode and output_mode not in OUTPUT_MODES:
+        raise HTTPException(400, f"output_mode must be one of {sorted(OUTPUT_MODES)}")
+    if stream and merged:
+        raise HTTPException(400, "stream and merged cannot be combined")
+    if (dpi is not None and dpi <= 0) or (max_edge is not None and max_edge <= 0):
+        raise HTTPException(400, "dpi and max_edge must be positive")
+    try:
+        encoding = raster_encoding(image_format, jpeg_quality, dpi, max_edge)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    if (part_mb is not None and part_mb <= 0) or (part_files is not None and part_files <= 0):
+        raise HTTPException(400, "part_mb and part_files must be positive")
+    if stream and (part_mb or part_files):
+        raise HTTPException(400, "split volumes are not available with stream")
+    # (max bytes, max PDFs) per zip volume; volumes only apply to zip batches
+    part_mb = part_mb if part_mb is not None else ZIP_PART_MAX_MB
+    zip_parts = None
+    if not merged and not stream and (part_mb or part_files or ZIP_PART_MAX_FILES):
+        zip_parts = (int(part_mb * 1024 * 1024) if part_mb else None, part_files or ZIP_PART_MAX_FILES)
     job_id = folder_name or str(uuid.uuid4())
-    job_folder = OUTPUT_DIR / job_id
-    job_folder.mkdir(parents=True, exist_ok=True)
-    pdf_paths = create_pdfs_from_rows(tpl, rows, placeholders, FONTS_DIR, job_folder, CURRENT.get("default_font"), filename_field)
-    zip_path = OUTPUT_DIR / f"{job_id}.zip"
-    zip_files(pdf_paths, zip_path)
-    
+    if not _FOLDER_NAME_RE.match(job_id):
+        raise HTTPException(400, "folder_name may only contain letters, digits, spaces, '.', '-' and '_'")
+    # A named folder belongs to the session that first generated it
+    previous = state_store.get_job(job_id)
+    if previous and previous.get("session_id") not in (None, session["session_id"]):
+        raise HTTPException(409, f"Folder '{job_id}' belongs to another session")
 
-    
+    # Same template bytes + sheet bytes + config as an earlier run: reuse its output
+    template_sha = content_store.hash_of(tpl)
+    sheet_sha = content_store.hash_of(excel)
+    gen_key = content_store.generation_key(template_sha, sheet_sha, {
+        "placeholders": placeholders,
+        "default_font": session.get("default_font"),
+        "filename_field": filename_field,
+        "output_mode": output_mode or OUTPUT_MODE,
+        "merged": merged,
+        "encoding": encoding,
+        "zip_parts": zip_parts,
+    })
+    memo = (gen_key, template_sha, sheet_sha)
+    # Per-row fingerprints are taken under this; any template/config change re-renders every row
+    row_base = config_hash({
+        "template": template_sha,
+        "placeholders": placeholders,
+        "default_font": session.get("default_font"),
+        "filename_field": filename_field,
+        "output_mode": output_mode or OUTPUT_MODE,
+        "encoding": encoding,
+    })
+    cached = content_store.find_generation(gen_key)
+    cached_name = (cached.get("zip") or cached.get("pdf") or (cached.get("parts") or [None])[0]) if cached else None
+    cached_file = OUTPUT_DIR / cached_name if cached_name else None
+    if cached_file is not None and cached_file.exists():
+        if stream:
+            return FileResponse(cached_file, filename=cached_file.name, media_type="application/zip",
+                                headers={"X-Job-Id": cached["job_id"]})
+        return {
+            "status": "completed",
+            "cached": True,
+            "job_id": cached["job_id"],
+            "job_url": f"/jobs/{cached['job_id']}",
+            "result": cached
+        }
 
-    
+    if stream:
+        # Send the zip while PDFs are rendered; a copy is kept for /download
+        total = await run_in_threadpool(count_rows, excel)
+        if total == 0:
+            raise HTTPException(400, "No rows found in excel")
+        zip_path = OUTPUT_DIR / f"{job_id}.zip"
+        static_keys = await run_in_threadpool(_static_keys, excel, placeholders, output_mode)
+        # Registered like a queued job: same-folder conflicts, session ownership and cleanup exclusion
+        try:
+            job = job_manager.start(job_id, session_id=session["session_id"])
+        except ValueError as e:
+            raise HTTPException(409, str(e))
+        job.set_total(total)
+        _hold_inputs(job_id, template_sha, sheet_sha)
+        entries = iter_pdf_bytes(tpl, iter_excel_rows(excel), dict(placeholders), FONTS_DIR,
+                                 session.get("default_font"), filename_field, total=total,
+                                 progress_callback=job.progress, cancel_event=job.cancel_event,
+                                 output_mode=output_mode, timings=job.timings, static_keys=static_keys,
+                                 encoding=encoding)
+        content_store.forget_output(zip_path.name)
+        # The streamed archive replaces whatever the per-row fingerprints described
+        content_store.forget_row_fingerprints(job_id)
+
+        written = 0
+
+        def _counted():
+            nonlocal written
+            for entry in entries:
+                written += 1
+                yield entry
+
+        def _stream_and_record():
+            state, result, error = "failed", None, None
+            try:
+                yield from stream_zip(_counted(), persist_path=zip_path)
+                storage_index.add(zip_path, "zip", job_id)
+                result = {"zip": zip_path.name, "count": written, "failed": total - written, "job_id": job_id}
+                state = "completed"
+                # Only a fully written archive holding every row becomes reusable
+                if written == total:
+                    content_store.record_generation(gen_key, job_id, zip_path.name, result,
+                                                    template_sha, sheet_sha)
+            except (GenerationCancelled, GeneratorExit):
+                state, error = "cancelled", "Stream stopped before the archive was complete"
+                raise
+            except Exception as e:
+                error = str(e)
+                raise
+            finally:
+                job_manager.finish(job, state, result, error)
+                _release_inputs(job_id)
+
+        return StreamingResponse(
+            _stream_and_record(),
+            media_type="application/zip",
+            headers={
+                "Content-Disposition": f'attachment; filename="{zip_path.name}"',
+                "X-Job-Id": job_id
+            }
+        )
+
+    try:
+        job = job_manager.submit(
+            job_id, _generation_job, tpl, excel, dict(placeholders),
+            session.get("default_font"), filename_field, output_mode, merged, timings, memo, row_base,
+            encoding=encoding, zip_parts=zip_parts, session_id=session["session_id"]
+        )
+    except ValueError as e:
+        raise HTTPException(409, str(e))
+    # Taken once the id is ours; jobs that never reach the end have theirs dropped by cleanup
+    _hold_inputs(job_id, template_sha, sheet_sha)
 
-    
-    # Files are kept for preview (cleaned up by background scheduler after 24h)
-    file_list = [p.name for p in pdf_paths]
-    
     return {
-        "status": "ok", 
-        "zip": zip_path.name, 
-        "count": len(pdf_paths),
-        "job_id": job_id,
-        "files": file_list
+        "status": "queued",
+        "job_id": job.job_id,
+        "job_url": f"/jobs/{job.job_id}"
+    }
+
+@app.get("/layout-check")
+async def layout_check(limit: int = 200, session: dict = Depends(get_session)):
+    """Fit every row's text without rendering and list placeholders that overflow their box"""
+    excel = session["excel_path"]
+    if not excel or not excel.exists():
+        raise HTTPException(400, "Excel not uploaded")
+    t0 = time.perf_counter()
+    df = await run_in_threadpool(load_dataset, excel)
+    layout = await run_in_threadpool(plan_layout, session["placeholders"], df, FONTS_DIR,
+                                     session.get("default_font"), max(0, limit))
+    return {
+        "rows": len(df),
+        "unique_texts": layout["unique_texts"],
+        "overflow_count": layout["overflow_count"],
+        "overflow": layout["overflow"],
+        "seconds": round(time.perf_counter() - t0, 3)
+    }
+
+@app.get("/jobs")
+def list_jobs(session_id: str = Depends(get_session_id)):
+    return {"jobs": job_manager.list_status(session_id)}
+
+def _owned_job(job_id: str, session_id: str):
+    """Job status for its own session; other sessions get the same 404 as an unknown id"""
+    job = job_manager.status(job_id)
+    if job is None or job.get("session_id") != session_id:
+        raise HTTPException(404, "Job not found")
+    return job
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, session_id: str = Depends(get_session_id)):
+    return _owned_job(job_id, session_id)
+
+@app.post("/jobs/{job_id}/cancel")
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str, session_id: str = Depends(get_session_id)):
+    _owned_job(job_id, session_id)
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    return job
+
+def _content_disposition(filename: str):
+    if filename.isascii():
+        return f'attachment; filename="{filename}"'
+    return f"attachment; filename*=utf-8''{quote(filename)}"
+
+def _download_response(request: Request, path: Path, media_type: str, filename: str = None):
+    """Send a file with Range, If-Range and If-None-Match support so large downloads can resume"""
+    try:
+        size, etag, last_modified = file_validators(path)
+    except FileNotFoundError:
+        raise HTTPException(404, "File not found")
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Content-Disposition": _content_disposition(filename or path.name),
     }
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    start, end = 0, size - 1
+    status = 200
+    if size and if_range_matches(request.headers.get("if-range"), etag, last_modified):
+        try:
+            byte_range = parse_range(request.headers.get("range"), size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(iter_file(path, start, end), status_code=status, media_type=media_type,
+                             headers=headers)
 
 @app.get("/download/{zip_name}")
-async def download_zip(zip_name: str):
+async def download_zip(zip_name: str, request: Request):
     zip_path = OUTPUT_DIR / zip_name
-    if not zip_path.exists():
+    if not zip_path.is_file():
         raise HTTPException(404, "Zip file not found")
-    return FileResponse(zip_path, filename=zip_name, media_type="application/zip")
+    media_type = "application/pdf" if zip_path.suffix == ".pdf" else "application/zip"
+    return _download_response(request, zip_path, media_type)
+
+@app.get("/manifest/{job_id}")
+def download_manifest(job_id: str, session_id: str = Depends(get_session_id)):
+    """The job's zip and its volumes with sizes and ETags, for parallel or resumable downloads"""
+    _owned_job(job_id, session_id)
+    def describe(path: Path):
+        size, etag, _ = file_validators(path)
+        return {"name": path.name, "url": f"/download/{path.name}", "size": size, "etag": etag}
+
+    zip_path = OUTPUT_DIR / f"{job_id}.zip"
+    parts = []
+    for number, path in enumerate(storage_index.job_items(job_id, ("zip_part",)), 1):
+        try:
+            entry = describe(path)
+            with zipfile.ZipFile(path) as z:
+                entry["files"] = len(z.infolist())
+        except FileNotFoundError:
+            continue
+        parts.append({"part": number, **entry})
+    if not parts and not zip_path.is_file():
+        raise HTTPException(404, "No download found for this job")
+    return {
+        "job_id": job_id,
+        "zip": describe(zip_path) if zip_path.is_file() else None,
+        "parts": parts,
+        "total_size": sum(p["size"] for p in parts)
+    }
+
+# ---- on-demand certificates ----
+# POST /certificates/{job_id} publishes the session's current template, sheet
+# and layout without rendering anything; each recipient then fetches
+# /certificate/{job_id}/{row_key}, where row_key is their filename_field value
+# (or the 1-based row number when no filename_field is set).
+
+@app.post("/certificates/{job_id}")
+async def publish_certificates(job_id: str, output_mode: str = Form(None), image_format: str = Form(None),
+                               jpeg_quality: int = Form(None), dpi: int = Form(None), max_edge: int = Form(None),
+                               session: dict = Depends(get_session)):
+    tpl = session["template_path"]
+    excel = session["excel_path"]
+    placeholders = session["placeholders"]
+    filename_field = session.get("filename_field")
+    if not tpl or not tpl.exists():
+        raise HTTPException(400, "Template not uploaded")
+    if not excel or not excel.exists():
+        raise HTTPException(400, "Excel not uploaded")
+    if output_mode and output_mode not in OUTPUT_MODES:
+        raise HTTPException(400, f"output_mode must be one of {sorted(OUTPUT_MODES)}")
+    if not _FOLDER_NAME_RE.match(job_id):
+        raise HTTPException(400, "job id may only contain letters, digits, spaces, '.', '-' and '_'")
+    previous = on_demand.get_job(job_id)
+    if previous and previous.get("session_id") not in (None, session["session_id"]):
+        raise HTTPException(409, f"'{job_id}' belongs to another session")
+    try:
+        encoding = raster_encoding(image_format, jpeg_quality, dpi, max_edge)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+    df = await run_in_threadpool(load_dataset, excel)
+    if filename_field and filename_field not in df.columns:
+        raise HTTPException(400, f"filename_field '{filename_field}' is not a column of the sheet")
+    config = {
+        "template_path": str(tpl),
+        "excel_path": str(excel),
+        "placeholders": placeholders,
+        "default_font": session.get("default_font"),
+        "filename_field": filename_field,
+        "output_mode": output_mode or OUTPUT_MODE,
+        "encoding": encoding,
+    }
+    static_keys = await run_in_threadpool(_static_keys, excel, placeholders, output_mode)
+    # stored as JSON, so as a list; get_certificate turns it back into a set
+    config["static_keys"] = sorted(static_keys) if static_keys else None
+    version = config_hash({**config, "template": content_store.hash_of(tpl), "sheet": content_store.hash_of(excel)})
+    if filename_field:
+        keys = zip(df[filename_field].tolist(), range(len(df)))
+    else:
+        keys = ((i + 1, i) for i in range(len(df)))
+    indexed = await run_in_threadpool(on_demand.publish, job_id, session["session_id"], config, version, keys)
+    # The published inputs stay stored for as long as the job exists
+    content_store.set_ref(f"ondemand:{job_id}:template", content_store.hash_of(tpl))
+    content_store.set_ref(f"ondemand:{job_id}:sheet", content_store.hash_of(excel))
+    return {
+        "status": "published",
+        "job_id": job_id,
+        "rows": len(df),
+        "keys": indexed,
+        "duplicate_keys": len(df) - indexed,
+        "url": f"/certificate/{job_id}/{{row_key}}"
+    }
+
+@app.get("/certificate/{job_id}/{row_key}")
+async def get_certificate(job_id: str, row_key: str, request: Request):
+    """One recipient's certificate, rendered on the first request and served from the disk cache after"""
+    job = on_demand.get_job(job_id)
+    if job is None:
+        raise HTTPException(404, "Certificate job not found")
+    row_index = on_demand.lookup(job_id, row_key)
+    if row_index is None:
+        raise HTTPException(404, "No certificate for this key")
+    excel = Path(job["excel_path"])
+    tpl = Path(job["template_path"])
+    if not excel.exists() or not tpl.exists():
+        raise HTTPException(410, "The inputs of this certificate job are gone")
+
+    row = await run_in_threadpool(get_row, excel, row_index)
+    filename = pdf_filename(row_index + 1, row, job["filename_field"])
+    key = on_demand.cache_key(job_id, job["version"], row_index)
+    path = on_demand.cached(key)
+    if path is None:
+        with metrics.stage("on_demand_render"):
+            data = await run_in_threadpool(
+                render_pdf_bytes, tpl, job["placeholders"], row, FONTS_DIR, job["default_font"],
+                job["output_mode"], frozenset(job["static_keys"] or ()) or None, None, job["encoding"]
+            )
+        path = await run_in_threadpool(on_demand.put, key, job_id, data)
+    return _download_response(request, path, "application/pdf", filename)
 
+@app.delete("/certificates/{job_id}")
+def delete_certificates(job_id: str, session_id: str = Depends(get_session_id)):
+    job = on_demand.get_job(job_id)
+    if job is None:
+        raise HTTPException(404, "Certificate job not found")
+    if job.get("session_id") not in (None, session_id):
+        raise HTTPException(409, f"'{job_id}' belongs to another session")
+    on_demand.delete(job_id)
+    content_store.release_refs(f"ondemand:{job_id}:")
+    return {"status": "deleted", "job_id": job_id}
 
+@app.get("/metrics")
+def prometheus_metrics():
+    """Prometheus text exposition of stage timings, row counters, cache and job gauges"""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
 
 @app.get("/storage-info")
 async def storage_info():
     """Get current storage usage information"""
     info = storage_manager.get_storage_info()
+    # on-demand certificates keep their own size-bounded cache
+    info["certificate_cache_mb"] = round(on_demand.stats()["bytes"] / (1024 * 1024), 2)
+    info["total_mb"] = round(info["total_mb"] + info["certificate_cache_mb"], 2)
     return {
         "status": "ok",
         "storage": info,
@@ -211,7 +1001,7 @@ async def storage_info():
 @app.post("/storage-cleanup")
 async def storage_cleanup():
     """Trigger full storage cleanup"""
-    stats = storage_manager.full_cleanup(force=True)
+    stats = await run_cleanup(force=True)
     return {
         "status": "ok",
         "cleanup_stats": stats,
@@ -219,11 +1009,16 @@ async def storage_cleanup():
     }
 
 @app.get("/status")
-def status():
+def status(session: dict = Depends(get_session)):
     return {
-        "template": str(CURRENT.get("template_path").name) if CURRENT.get("template_path") else None,
-        "excel": str(CURRENT.get("excel_path").name) if CURRENT.get("excel_path") else None,
-        "placeholders": CURRENT.get("placeholders"),
-        "default_font": CURRENT.get("default_font"),
-        "filename_field": CURRENT.get("filename_field")
+        "session_id": session["session_id"],
+        "template": str(session.get("template_path").name) if session.get("template_path") else None,
+        "excel": str(session.get("excel_path").name) if session.get("excel_path") else None,
+        "placeholders": session.get("placeholders"),
+        "default_font": session.get("default_font"),
+        "filename_field": session.get("filename_field"),
+        "template_cache": template_cache_stats(),
+        "font_cache": font_cache_stats(),
+        "preview_cache": preview_cache_stats(),
+        "certificate_cache": on_demand.stats()
     }
@@ -29,6 +29,23 @@ AUTO_CLEANUP_ENABLED = True
 # Maximum zip files to keep on server at any time
 MAX_ZIP_FILES = 100
 
+# Sessions
+# A session whose template, sheet or layout has not changed for this many
+# hours is forgotten and its uploads released (None = sessions never expire)
+SESSION_TTL_HOURS = 72
+
+# Stored uploads (templates, sheets and their parsed caches)
+# Beyond this many MB, uploads no session, job or output references are
+# deleted oldest first, even inside the retention window (None = no limit)
+MAX_UPLOAD_STORAGE_MB = 2048
+
+# Split Zip Volumes
+# Instead of one full zip, write the batch as independent volumes of about
+# this many MB and/or this many PDFs each (None = a single zip); /manifest/{job_id}
+# lists them so clients can download them in parallel
+ZIP_PART_MAX_MB = None
+ZIP_PART_MAX_FILES = None
+
 # ============================================
 # CLEANUP ENDPOINTS
 # ============================================
@@ -58,3 +75,158 @@ MAX_ZIP_FILES = 100
 # - Old templates removed automatically
 # ============================================
 
+
+# ============================================
+# SCHEDULED CLEANUP
+# ============================================
+
+# Seconds between background cleanup passes (one worker process runs each pass)
+CLEANUP_INTERVAL_SECONDS = 3600
+
+# Cleanup deletes at most this many items per batch and pauses between
+# batches, so a large backlog never stalls requests or running generations
+CLEANUP_BATCH_SIZE = 200
+CLEANUP_BATCH_PAUSE_SECONDS = 0.5
+
+# ============================================
+# RENDERING CACHES
+# ============================================
+
+# Decoded templates kept in memory per worker, least recently used dropped first;
+# each one also holds its preview scales and prepared backgrounds (below)
+TEMPLATE_CACHE_SIZE = 8
+
+# Parsed sheets kept in memory per worker, least recently used dropped first
+DATASET_CACHE_SIZE = 8
+
+# Number of (font file, size) FreeType objects kept in memory
+FONT_CACHE_SIZE = 512
+
+# Number of remembered font-size fits per (text, font, box width)
+# Repeated values such as course titles skip fitting entirely
+FIT_MEMO_SIZE = 20000
+
+# Templates with sheet-constant placeholders (event name, date, signer...)
+# pre-drawn, kept per template; rows then only draw their varying fields
+PREPARED_BACKGROUNDS_PER_TEMPLATE = 4
+
+# ============================================
+# RENDER EXECUTOR
+# ============================================
+
+# "thread", "process" or "auto"
+# Pillow text drawing and ReportLab writing mostly hold the GIL, so large
+# batches only use every core when rendered in worker processes
+RENDER_EXECUTOR = "auto"
+
+# Number of render workers (0 = one per CPU core in process mode, 4 threads otherwise)
+RENDER_WORKERS = 0
+
+# Rows sent to a worker process per task
+RENDER_CHUNK_SIZE = 16
+
+# "auto" only pays the process start-up cost for batches at least this big
+RENDER_PROCESS_MIN_ROWS = 64
+
+# Start method for worker processes ("spawn" is safe inside the threaded server)
+RENDER_MP_CONTEXT = "spawn"
+
+# Thread mode runs rows through three stages, each on its own pool:
+# render (RENDER_WORKERS) -> PDF encode (ENCODE_WORKERS) -> file sink (SINK_WORKERS).
+# zlib/JPEG encoding and file writes release the GIL, so they overlap with
+# rendering. Process workers keep all three in one task, because sending
+# full-size page bitmaps between processes costs more than encoding them.
+ENCODE_WORKERS = 2
+SINK_WORKERS = 1
+
+# Rows in flight between the row source and the sink, counted in rows in both
+# modes (0 = two per thread-pipeline worker, four chunks per process worker).
+# Peak memory is about this many pages, whatever the sheet size.
+PIPELINE_DEPTH = 0
+
+# ============================================
+# BACKGROUND JOBS
+# ============================================
+
+# /generate enqueues a job and returns immediately; poll /jobs/{job_id}
+# Maximum number of batches rendering at the same time per server process
+MAX_CONCURRENT_JOBS = 2
+
+# Finished jobs remembered for /jobs polling before the oldest are forgotten
+JOB_HISTORY_LIMIT = 200
+
+# Queued/running jobs are re-stamped in the shared store this often
+JOB_HEARTBEAT_SECONDS = 15
+
+# A queued/running job not stamped for this long belongs to a worker that
+# died; it is marked failed so its folder can be reused and cleaned up
+JOB_STALE_SECONDS = 120
+
+# Rows read per batch by the streaming spreadsheet reader
+ROW_BATCH_SIZE = 500
+
+# ============================================
+# PDF OUTPUT
+# ============================================
+
+# "raster": every page is the full composited bitmap (pixel-identical to /preview)
+# "vector": the template is embedded once and placeholder text is real PDF text
+#           (much smaller/faster, selectable text; rows using fonts ReportLab
+#           cannot embed fall back to raster automatically)
+OUTPUT_MODE = "raster"
+
+# Raster page image compression:
+# "flate": lossless, pixel-exact, several MB per page at print resolution
+# "jpeg":  encoded once with PDF_JPEG_QUALITY and embedded as-is (DCTDecode)
+PDF_IMAGE_FORMAT = "flate"
+PDF_JPEG_QUALITY = 85
+
+# Resolution the template artwork is assumed to be made at (A4 at 300 dpi is 3508x2480)
+TEMPLATE_DPI = 300
+
+# Downsample raster page images to this DPI (None keeps the template's resolution)
+PDF_TARGET_DPI = None
+
+# Upper bound for the longest edge of a raster page image in pixels (None = no bound)
+PDF_MAX_IMAGE_EDGE = None
+
+# Merged PDFs are rendered this many pages at a time and each chunk is appended
+# to the file before the next starts, so memory does not grow with the sheet.
+# Every chunk carries its own copy of the template background and fonts.
+MERGED_PDF_CHUNK_PAGES = 200
+
+# ============================================
+# PREVIEW
+# ============================================
+
+# Rendered previews kept in memory per worker, keyed by row, placeholder
+# layout, scale and format; repeat clicks are served without rendering
+PREVIEW_CACHE_SIZE = 256
+
+# Total size of those previews per worker in MB, least recently used dropped
+# first (a full-resolution PNG preview alone is several MB)
+PREVIEW_CACHE_MB = 64
+
+# Downscaled template copies kept per template (one per distinct scale)
+PREVIEW_SCALES_PER_TEMPLATE = 4
+
+# ============================================
+# UPLOADS
+# ============================================
+
+# Largest accepted template image and sheet; bigger uploads are refused with 413
+# from their Content-Length before the body is read, or as soon as the limit
+# is crossed when no length is sent
+MAX_TEMPLATE_UPLOAD_MB = 25
+MAX_SHEET_UPLOAD_MB = 100
+
+# Resumable uploads with no new chunk for this long are discarded
+UPLOAD_SESSION_TTL_HOURS = 24
+
+# ============================================
+# ON-DEMAND CERTIFICATES
+# ============================================
+
+# Disk space for certificates rendered by /certificate/{job}/{row_key};
+# least recently downloaded ones are deleted beyond this
+CERTIFICATE_CACHE_MB = 512
@@ -0,0 +1,200 @@
+"""
+Content Store Module
+Content-addressed, reference-counted storage for uploads and generation results
+"""
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blob_refs (
+    owner TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_blob_refs_sha ON blob_refs(sha256);
+CREATE TABLE IF NOT EXISTS generations (
+    gen_key TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    output_name TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_generations_output ON generations(output_name);
+CREATE TABLE IF NOT EXISTS row_fingerprints (
+    job_id TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    PRIMARY KEY (job_id, filename)
+);
+"""
+
+_CHUNK = 1024 * 1024
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def config_hash(config: dict):
+    """Stable hash of a JSON-serialisable generation config"""
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class ContentStore:
+    """Files stored once under root/<aa>/<sha256><ext>, kept alive by named references
+
+    With a StorageIndex covering root, every stored file (and the caches
+    derived from it) is recorded there so it counts toward storage totals.
+    """
+
+    def __init__(self, root, state_store, index=None):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.store = state_store
+        self.index = index
+        self.store.executescript(_SCHEMA)
+
+    def _blob_path(self, sha, ext):
+        return self.root / sha[:2] / f"{sha}{ext.lower()}"
+
+    def put_file(self, src: Path, ext: str, sha: str = None):
+        """Move src into the store and return (sha256, path, created)
+
+        Identical content that is already stored is a no-op: src is removed
+        and the existing blob is returned.
+        """
+        src = Path(src)
+        sha = sha or sha256_file(src)
+        row = self.store.execute("SELECT path FROM blobs WHERE sha256 = ?", (sha,)).fetchone()
+        if row and Path(row["path"]).exists():
+            src.unlink(missing_ok=True)
+            return sha, Path(row["path"]), False
+
+        dest = self._blob_path(sha, ext)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, dest)
+        self.store.execute(
+            "INSERT OR REPLACE INTO blobs (sha256, path, size, created_at) VALUES (?, ?, ?, ?)",
+            (sha, str(dest), dest.stat().st_size, time.time()),
+        )
+        if self.index is not None:
+            self.index.add(dest, "blob")
+        return sha, dest, True
+
+    def index_derived(self, path: Path):
+        """Record caches written next to a blob (e.g. the parsed-sheet sidecar) in the storage index"""
+        if self.index is not None:
+            self.index.add_many(Path(path).parent.glob(f".{Path(path).name}.*"), "blob")
+
+    def hash_of(self, path):
+        """sha256 of a stored blob, taken from its content-addressed name"""
+        if not path:
+            return None
+        path = Path(path)
+        if path.resolve().parent.parent == self.root.resolve():
+            return path.stem
+        return sha256_file(path)
+
+    # ---- references ----
+
+    def set_ref(self, owner: str, sha: str):
+        """Point owner at sha, dropping whatever owner referenced before"""
+        self.store.execute("INSERT OR REPLACE INTO blob_refs (owner, sha256) VALUES (?, ?)", (owner, sha))
+
+    def release_refs(self, owner_prefix: str):
+        """Drop every reference whose owner starts with owner_prefix (a range scan, so ids may hold _ or %)"""
+        upper = owner_prefix[:-1] + chr(ord(owner_prefix[-1]) + 1)
+        self.store.execute("DELETE FROM blob_refs WHERE owner >= ? AND owner < ?", (owner_prefix, upper))
+
+    def release_job_refs(self, keep_jobs=()):
+        """Drop job:{id}: references of jobs not in keep_jobs (left behind by jobs that never ran to the end)"""
+        rows = self.store.execute("SELECT owner FROM blob_refs WHERE owner >= 'job:' AND owner < 'job;'").fetchall()
+        jobs = {r["owner"][len("job:"):].rsplit(":", 1)[0] for r in rows}
+        for job_id in jobs - set(keep_jobs):
+            self.release_refs(f"job:{job_id}:")
+        return len(jobs - set(keep_jobs))
+
+    def unreferenced_blobs(self, older_than_seconds=0):
+        """Blobs nobody references any more (and created before the cutoff), oldest first"""
+        cutoff = time.time() - older_than_seconds
+        rows = self.store.execute(
+            """SELECT b.sha256, b.path FROM blobs b
+               LEFT JOIN blob_refs r ON r.sha256 = b.sha256
+               WHERE r.sha256 IS NULL AND b.created_at <= ?
+               ORDER BY b.created_at""",
+            (cutoff,),
+        ).fetchall()
+        return [(r["sha256"], Path(r["path"])) for r in rows]
+
+    def delete_blob(self, sha: str):
+        row = self.store.execute("SELECT path FROM blobs WHERE sha256 = ?", (sha,)).fetchone()
+        if row:
+            path = Path(row["path"])
+            path.unlink(missing_ok=True)
+            # derived caches (e.g. parsed dataset sidecars) live next to the blob
+            extras = list(path.parent.glob(f".{path.name}.*"))
+            for extra in extras:
+                extra.unlink(missing_ok=True)
+            if self.index is not None:
+                self.index.remove_many([path, *extras])
+        self.store.execute("DELETE FROM blobs WHERE sha256 = ?", (sha,))
+
+    # ---- generation memo ----
+
+    def generation_key(self, template_sha: str, sheet_sha: str, config: dict):
+        return hashlib.sha256(f"{template_sha}:{sheet_sha}:{config_hash(config)}".encode("utf-8")).hexdigest()
+
+    def find_generation(self, gen_key: str):
+        row = self.store.execute("SELECT result FROM generations WHERE gen_key = ?", (gen_key,)).fetchone()
+        return json.loads(row["result"]) if row else None
+
+    def record_generation(self, gen_key: str, job_id: str, output_name: str, result: dict,
+                          template_sha: str, sheet_sha: str):
+        """Remember a finished output; it keeps its inputs referenced while it exists"""
+        # an output file name maps to one generation only (a rerun overwrites the file)
+        self.forget_output(output_name)
+        self.store.execute(
+            "INSERT OR REPLACE INTO generations (gen_key, job_id, output_name, result, created_at) VALUES (?, ?, ?, ?, ?)",
+            (gen_key, job_id, output_name, json.dumps(result), time.time()),
+        )
+        self.set_ref(f"generation:{gen_key}:template", template_sha)
+        self.set_ref(f"generation:{gen_key}:sheet", sheet_sha)
+
+    def forget_output(self, output_name: str):
+        """Drop memo entries (and their references) for a deleted output file"""
+        rows = self.store.execute("SELECT gen_key FROM generations WHERE output_name = ?", (output_name,)).fetchall()
+        for r in rows:
+            self.release_refs(f"generation:{r['gen_key']}:")
+        self.store.execute("DELETE FROM generations WHERE output_name = ?", (output_name,))
+        return len(rows)
+
+    # ---- per-row fingerprints for incremental reruns ----
+
+    def load_row_fingerprints(self, job_id: str):
+        rows = self.store.execute("SELECT filename, fingerprint FROM row_fingerprints WHERE job_id = ?",
+                                  (job_id,)).fetchall()
+        return {r["filename"]: r["fingerprint"] for r in rows}
+
+    def save_row_fingerprints(self, job_id: str, fingerprints: dict):
+        conn = self.store.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM row_fingerprints WHERE job_id = ?", (job_id,))
+            conn.executemany("INSERT INTO row_fingerprints (job_id, filename, fingerprint) VALUES (?, ?, ?)",
+                             [(job_id, name, fp) for name, fp in fingerprints.items()])
+
+    def forget_row_fingerprints(self, job_id: str):
+        self.store.execute("DELETE FROM row_fingerprints WHERE job_id = ?", (job_id,))
@@ -0,0 +1,77 @@
+"""
+Download Module
+Range and conditional request handling for generated files
+"""
+
+from email.utils import formatdate
+from pathlib import Path
+
+# Bytes read from disk per step while sending a file
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    """The requested range starts beyond the end of the file"""
+
+
+def file_validators(path: Path):
+    """(size, etag, last_modified) for a file; the ETag changes whenever the file is rewritten"""
+    st = Path(path).stat()
+    etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+    return st.st_size, etag, formatdate(st.st_mtime, usegmt=True)
+
+
+def parse_range(header: str, size: int):
+    """(start, end) inclusive for a single "bytes=" range, or None to send the whole file
+
+    Malformed and multi-range headers are ignored (the whole file is sent),
+    as RFC 9110 allows.
+    """
+    if not header or not header.strip().startswith("bytes="):
+        return None
+    spec = header.strip()[len("bytes="):].strip()
+    if "," in spec:
+        return None
+    first, sep, last = spec.partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            # suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable(header)
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    if start < 0 or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def if_range_matches(header: str, etag: str, last_modified: str):
+    """Whether a Range may be honoured under If-Range (absent header: always)"""
+    if not header:
+        return True
+    header = header.strip()
+    if header.startswith('"') or header.startswith("W/"):
+        # If-Range requires a strong comparison, so weak tags never match
+        return header == etag
+    return header == last_modified
+
+
+def iter_file(path: Path, start: int, end: int, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+    """Yield bytes start..end (inclusive) of path"""
+    remaining = end - start + 1
+    with Path(path).open("rb") as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -1,11 +1,243 @@
 import pandas as pd
+from pathlib import Path
+import csv
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from ..settings import ROW_BATCH_SIZE, DATASET_CACHE_SIZE
+from . import metrics
+
+# Parsed sheets keyed by resolved path, validated against the file's mtime/size.
+# A pickled sidecar next to the upload lets other worker processes skip parsing too.
+# At most DATASET_CACHE_SIZE sheets stay in memory, least recently used dropped first.
+_DATASETS = OrderedDict()
+_DATASETS_LOCK = threading.Lock()
+# Bumped whenever _parse changes the values it produces, so old sidecars are reparsed
+_SIDECAR_VERSION = 2
+
+
+def _sidecar_path(path: Path):
+    return path.with_name(f".{path.name}.dataset.pkl")
+
+
+def _sheet_kind(path: Path):
+    """'xlsx', 'xls' or 'csv', sniffed from the file header rather than the name"""
+    with open(path, "rb") as f:
+        head = f.read(8)
+    if head.startswith(b"PK\x03\x04"):
+        return "xlsx"
+    if head.startswith(b"\xd0\xcf\x11\xe0"):
+        return "xls"
+    if path.suffix.lower() == ".csv":
+        return "csv"
+    return "xlsx"
+
+
+def _cell(value):
+    """A cell as every reader reports it: "" for blanks, 12.0 -> 12, plain Python scalars
+
+    Both the cached DataFrame and the streamed rows go through this, so a
+    preview shows exactly what generation renders.
+    """
+    if value is None or isinstance(value, str):
+        return "" if value is None else value
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if value is pd.NaT or value is pd.NA:
+        return ""
+    if hasattr(value, "item"):
+        # numpy scalar
+        value = value.item()
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ""
+        if value.is_integer():
+            return int(value)
+    return value
+
+
+def _is_blank(values):
+    return not any(v is not None and v != "" for v in values)
+
+
+def _parse(path: Path):
+    with metrics.stage("excel_parse"):
+        if _sheet_kind(path) == "csv":
+            # Text as written ("00123" stays "00123"), like the streaming csv reader
+            df = pd.read_csv(path, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+        else:
+            df = pd.read_excel(path)
+        df = df.astype(object).map(_cell)
+        # The streaming reader skips blank rows; keep row indices in step with it
+        df = df[(df != "").any(axis=1)].reset_index(drop=True)
+    return df
+
+
+def _records(df):
+    return [{c: _cell(v) for c, v in row.items()} for row in df.to_dict(orient="records")]
+
+
+def load_dataset(path, sidecar: bool = True):
+    """Return the sheet as a DataFrame, parsing the file only once per upload
+
+    sidecar=False keeps the parse in memory only, for callers such as the
+    CLI that must not write a hidden pickle next to a user's file.
+    """
+    path = Path(path).resolve()
+    st = path.stat()
+    key = str(path)
+    with _DATASETS_LOCK:
+        entry = _DATASETS.get(key)
+        if entry:
+            _DATASETS.move_to_end(key)
+    if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+        return entry["df"]
+
+    entry = None
+    sidecar_path = _sidecar_path(path) if sidecar else None
+    if sidecar_path is not None and sidecar_path.exists():
+        try:
+            cached = pd.read_pickle(sidecar_path)
+            if (cached.get("version") == _SIDECAR_VERSION and cached["mtime_ns"] == st.st_mtime_ns
+                    and cached["size"] == st.st_size):
+                entry = cached
+        except Exception:
+            entry = None
+
+    if entry is None:
+        entry = {"version": _SIDECAR_VERSION, "mtime_ns": st.st_mtime_ns, "size": st.st_size, "df": _parse(path)}
+        if sidecar_path is not None:
+            try:
+                pd.to_pickle(entry, sidecar_path)
+            except Exception as e:
+                print(f"Could not write dataset cache for {path.name}: {e}")
+
+    with _DATASETS_LOCK:
+        _DATASETS[key] = entry
+        _DATASETS.move_to_end(key)
+        while len(_DATASETS) > DATASET_CACHE_SIZE:
+            _DATASETS.popitem(last=False)
+    return entry["df"]
+
+
+def invalidate_dataset(path):
+    """Forget the parsed sheet (call before/after replacing the file)"""
+    path = Path(path).resolve()
+    with _DATASETS_LOCK:
+        _DATASETS.pop(str(path), None)
+    _sidecar_path(path).unlink(missing_ok=True)
+
 
 def read_excel_rows(path):
-    df = pd.read_excel(path)
-    df = df.fillna("")
-    return df.to_dict(orient="records")
+    return _records(load_dataset(path))
+
 
 def get_excel_headers(path):
     """Get column headers from Excel file"""
-    df = pd.read_excel(path)
-    return df.columns.tolist()
+    return load_dataset(path).columns.tolist()
+
+
+def get_row_count(path):
+    return len(load_dataset(path))
+
+
+def get_row(path, index: int):
+    """Single row as a dict (same value types as read_excel_rows)"""
+    df = load_dataset(path)
+    if index < 0 or index >= len(df):
+        raise IndexError("row_index out of bounds")
+    return _records(df.iloc[[index]])[0]
+
+
+def _header_names(values):
+    """Column names the way pandas names them (Unnamed: i, duplicate -> name.1)"""
+    names = []
+    seen = {}
+    for idx, v in enumerate(values):
+        name = f"Unnamed: {idx}" if v is None or v == "" else v
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _iter_raw_rows(path: Path):
+    """Yield the header followed by each row as a tuple of cell values"""
+    kind = _sheet_kind(path)
+    if kind == "csv":
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            yield from csv.reader(f)
+    elif kind == "xlsx":
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            yield from wb.active.iter_rows(values_only=True)
+        finally:
+            wb.close()
+    else:
+        # Legacy .xls has no streaming reader; fall back to the cached dataset
+        df = load_dataset(path)
+        yield tuple(df.columns)
+        yield from df.itertuples(index=False, name=None)
+
+
+def iter_excel_row_batches(path, batch_size: int = None):
+    """Yield lists of row dicts without loading the whole sheet into memory"""
+    batch_size = batch_size or ROW_BATCH_SIZE
+    raw = _iter_raw_rows(Path(path))
+    header = next(raw, None)
+    if header is None:
+        return
+    columns = _header_names(list(header))
+    width = len(columns)
+    batch = []
+    t0 = time.perf_counter()
+    for values in raw:
+        if _is_blank(values):
+            continue
+        values = list(values)[:width] + [""] * (width - len(values))
+        batch.append({c: _cell(v) for c, v in zip(columns, values)})
+        if len(batch) >= batch_size:
+            # Time spent reading this batch, excluding the consumer's work between batches
+            metrics.observe("excel_read", time.perf_counter() - t0)
+            yield batch
+            batch = []
+            t0 = time.perf_counter()
+    if batch:
+        metrics.observe("excel_read", time.perf_counter() - t0)
+        yield batch
+
+
+def iter_excel_rows(path, batch_size: int = None):
+    """Row dicts one at a time, read in bounded batches"""
+    for batch in iter_excel_row_batches(path, batch_size):
+        yield from batch
+
+
+def count_rows(path):
+    """Number of data rows, without building row dicts"""
+    path = Path(path).resolve()
+    st = path.stat()
+    with _DATASETS_LOCK:
+        entry = _DATASETS.get(str(path))
+    if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+        return len(entry["df"])
+    count = -1
+    for values in _iter_raw_rows(path):
+        if count < 0 or not _is_blank(values):
+            count += 1
+    return max(count, 0)
+
+
+def constant_columns(path, df=None):
+    """Columns holding the same value in every row (of df when given, else the cached dataset)"""
+    if df is None:
+        df = load_dataset(path)
+    if len(df) == 0:
+        return set()
+    return {col for col, n in df.nunique(dropna=False).items() if n <= 1}
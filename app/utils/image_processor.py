@@ -1,32 +1,198 @@
 from PIL import Image, ImageDraw, ImageFont
 from pathlib import Path
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import json
+import threading
 
-def load_font(fonts_dir: Path, font_name: str, size: int):
+from ..settings import (
+    TEMPLATE_CACHE_SIZE, FONT_CACHE_SIZE, FIT_MEMO_SIZE, PREVIEW_SCALES_PER_TEMPLATE, PREPARED_BACKGROUNDS_PER_TEMPLATE
+)
+from . import metrics
+
+# Decoded templates keyed by resolved path. Each entry remembers the mtime/size it
+# was decoded from plus a content hash, so an overwritten file is never served stale.
+# At most TEMPLATE_CACHE_SIZE templates (with their scaled and prepared copies) are kept.
+_TEMPLATE_CACHE = OrderedDict()
+_TEMPLATE_CACHE_LOCK = threading.Lock()
+_TEMPLATE_CACHE_STATS = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+# Text measurement does not depend on image content, so one scratch canvas serves all rows
+_MEASURE_DRAW = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+# Font files available per fonts_dir, resolved once instead of globbing per call
+_FONT_INDEX = {}
+_FONT_INDEX_LOCK = threading.Lock()
+
+# (text, fonts_dir, font_name, max_width, initial_size) -> (size, (w, h))
+_FIT_MEMO = OrderedDict()
+_FIT_MEMO_LOCK = threading.Lock()
+_FIT_MEMO_STATS = {"hits": 0, "misses": 0}
+
+
+def _file_sha256(path: Path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_template_image(template_path: Path):
+    """Shared decoded RGB template (read-only: copy before drawing on it)"""
+    path = Path(template_path).resolve()
+    st = path.stat()
+    key = str(path)
+    with _TEMPLATE_CACHE_LOCK:
+        entry = _TEMPLATE_CACHE.get(key)
+        if entry and entry["mtime_ns"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            _TEMPLATE_CACHE.move_to_end(key)
+            _TEMPLATE_CACHE_STATS["hits"] += 1
+            return entry["image"]
+
+    # Decode outside the lock so other templates are not blocked meanwhile
+    img = Image.open(path).convert("RGB")
+    img.load()
+    entry = {
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+        "sha256": _file_sha256(path),
+        "image": img,
+    }
+    with _TEMPLATE_CACHE_LOCK:
+        _TEMPLATE_CACHE[key] = entry
+        _TEMPLATE_CACHE.move_to_end(key)
+        _TEMPLATE_CACHE_STATS["misses"] += 1
+        while len(_TEMPLATE_CACHE) > TEMPLATE_CACHE_SIZE:
+            _TEMPLATE_CACHE.popitem(last=False)
+            _TEMPLATE_CACHE_STATS["evictions"] += 1
+    return img
+
+
+def get_scaled_template(template_path: Path, scale: float):
+    """Shared downscaled copy of the template (read-only), cached alongside the full-size one"""
+    base = get_template_image(template_path)
+    if scale >= 1:
+        return base
+    key = str(Path(template_path).resolve())
+    with _TEMPLATE_CACHE_LOCK:
+        entry = _TEMPLATE_CACHE.get(key)
+        scaled = entry.setdefault("scaled", OrderedDict()) if entry else OrderedDict()
+        if scale in scaled:
+            scaled.move_to_end(scale)
+            return scaled[scale]
+
+    w, h = base.size
+    img = base.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.LANCZOS, reducing_gap=3.0)
+    with _TEMPLATE_CACHE_LOCK:
+        # Only attach to the entry the base image came from (the file may have changed meanwhile)
+        if entry is not None and entry["image"] is base:
+            scaled[scale] = img
+            while len(scaled) > PREVIEW_SCALES_PER_TEMPLATE:
+                scaled.popitem(last=False)
+    return img
+
+
+def load_template(template_path: Path):
+    """Return a private RGB copy of the template, decoding it only on first use"""
+    return get_template_image(template_path).copy()
+
+
+def invalidate_template_cache(template_path: Path = None):
+    """Drop one cached template (or all of them when no path is given)"""
+    with _TEMPLATE_CACHE_LOCK:
+        if template_path is None:
+            removed = len(_TEMPLATE_CACHE)
+            _TEMPLATE_CACHE.clear()
+        else:
+            removed = 1 if _TEMPLATE_CACHE.pop(str(Path(template_path).resolve()), None) else 0
+        _TEMPLATE_CACHE_STATS["invalidations"] += removed
+
+
+def template_cache_stats():
+    with _TEMPLATE_CACHE_LOCK:
+        return {
+            **_TEMPLATE_CACHE_STATS,
+            "entries": len(_TEMPLATE_CACHE),
+            "templates": {k: v["sha256"] for k, v in _TEMPLATE_CACHE.items()},
+        }
+
+def index_fonts(fonts_dir: Path):
+    """Scan fonts_dir once and remember which files exist and the fallback font"""
+    key = str(fonts_dir)
+    with _FONT_INDEX_LOCK:
+        entry = _FONT_INDEX.get(key)
+        if entry is not None:
+            return entry
+        names = set()
+        fallback = None
+        if fonts_dir and Path(fonts_dir).exists():
+            names = {f.name for f in Path(fonts_dir).iterdir() if f.is_file()}
+            # Prefer GoogleSans.ttf as a good default, otherwise any ttf in the dir
+            if "GoogleSans.ttf" in names:
+                fallback = str(Path(fonts_dir) / "GoogleSans.ttf")
+            else:
+                for f in Path(fonts_dir).glob("*.ttf"):
+                    fallback = str(f)
+                    break
+        entry = {"names": names, "fallback": fallback}
+        _FONT_INDEX[key] = entry
+        return entry
+
+
+def reset_font_caches():
+    """Forget the font index and every cached font / fit result"""
+    with _FONT_INDEX_LOCK:
+        _FONT_INDEX.clear()
+    _truetype.cache_clear()
+    with _FIT_MEMO_LOCK:
+        _FIT_MEMO.clear()
+
+
+def font_cache_stats():
+    info = _truetype.cache_info()
+    with _FIT_MEMO_LOCK:
+        fit_entries = len(_FIT_MEMO)
+    return {
+        "font_hits": info.hits,
+        "font_misses": info.misses,
+        "font_entries": info.currsize,
+        "fit_memo_hits": _FIT_MEMO_STATS["hits"],
+        "fit_memo_misses": _FIT_MEMO_STATS["misses"],
+        "fit_memo_entries": fit_entries,
+    }
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def _truetype(path: str, size: int):
+    # Only cache misses reach here, so this times real FreeType loads
+    with metrics.stage("font_load"):
+        return ImageFont.truetype(path, size)
+
+
+def _font_candidates(fonts_dir: Path, font_name: str):
+    index = index_fonts(fonts_dir)
+    candidates = []
     # 1. Try specific requested font
-    if font_name:
-        fp = fonts_dir / font_name
-        if fp.exists():
-            try:
-                return ImageFont.truetype(str(fp), size)
-            except Exception:
-                pass
-    
-    # 2. Try to find a reliable fallback in our fonts dir (e.g. GoogleSans or anything available)
-    try:
-        # Check specifically for GoogleSans.ttf as a good default
-        fallback_path = fonts_dir / "GoogleSans.ttf"
-        if fallback_path.exists():
-            return ImageFont.truetype(str(fallback_path), size)
-            
-        # Or try OpenSans or any other ttf file in the dir
-        for f in fonts_dir.glob("*.ttf"):
-            return ImageFont.truetype(str(f), size)
-    except Exception:
-        pass
-        
+    if font_name and font_name in index["names"]:
+        candidates.append(str(Path(fonts_dir) / font_name))
+    # 2. Reliable fallback in our fonts dir (e.g. GoogleSans or anything available)
+    if index["fallback"]:
+        candidates.append(index["fallback"])
+    return candidates
+
+
+def load_font(fonts_dir: Path, font_name: str, size: int):
+    for path in _font_candidates(fonts_dir, font_name):
+        try:
+            return _truetype(path, size)
+        except Exception:
+            pass
+
     # 3. Try system Arial (Works on Windows, often fails on minimal Linux)
     try:
-        return ImageFont.truetype("arial.ttf", size)
+        return _truetype("arial.ttf", size)
     except Exception:
         # 4. Last resort: Default bitmap font (looks tiny/bad)
         return ImageFont.load_default()
@@ -38,17 +204,60 @@ def _measure_text(draw: ImageDraw.Draw, text: str, font: ImageFont.FreeTypeFont)
     except Exception:
         return draw.textsize(text, font=font)
 
-def _fit_font_size(draw: ImageDraw.Draw, text: str, fonts_dir: Path, font_name: str, max_width: int, initial_size: int):
-    size = initial_size
-    font = load_font(fonts_dir, font_name, size)
+def _search_font_size(draw: ImageDraw.Draw, text: str, fonts_dir: Path, font_name: str, max_width: int, initial_size: int):
+    """Largest size <= initial_size whose text width fits max_width (floor of 4pt)"""
+    font = load_font(fonts_dir, font_name, initial_size)
     w, h = _measure_text(draw, text, font)
-    attempts = 0
-    while w > max_width and size > 4 and attempts < 200:
-        size = max(4, size - 1)
-        font = load_font(fonts_dir, font_name, size)
-        w, h = _measure_text(draw, text, font)
-        attempts += 1
-    return font, (w, h)
+    if w <= max_width or initial_size <= 4:
+        return initial_size, (w, h)
+
+    # Same lower bound the old linear search reached (4pt or 200 steps down)
+    lo = max(4, initial_size - 200)
+    hi = initial_size - 1
+    measured = {initial_size: (w, h)}
+
+    def fits(size):
+        dims = _measure_text(draw, text, load_font(fonts_dir, font_name, size))
+        measured[size] = dims
+        return dims[0] <= max_width
+
+    # Text width scales ~linearly with size, so one proportional guess narrows the range
+    guess = min(hi, max(lo, int(initial_size * max_width / max(w, 1))))
+    if fits(guess):
+        lo = guess
+    else:
+        hi = guess - 1
+        # Nothing in range fits: the old loop stopped at the lower bound as well
+        if hi < lo or not fits(lo):
+            return lo, measured[lo]
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if fits(mid):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo, measured[lo]
+
+def _fit_font_size(draw: ImageDraw.Draw, text: str, fonts_dir: Path, font_name: str, max_width: int, initial_size: int):
+    with metrics.stage("fit"):
+        return _fit_font_size_memo(draw, text, fonts_dir, font_name, max_width, initial_size)
+
+def _fit_font_size_memo(draw: ImageDraw.Draw, text: str, fonts_dir: Path, font_name: str, max_width: int, initial_size: int):
+    key = (text, str(fonts_dir), font_name, max_width, initial_size)
+    with _FIT_MEMO_LOCK:
+        hit = _FIT_MEMO.get(key)
+        if hit is not None:
+            _FIT_MEMO.move_to_end(key)
+            _FIT_MEMO_STATS["hits"] += 1
+    if hit is None:
+        hit = _search_font_size(draw, text, fonts_dir, font_name, max_width, initial_size)
+        with _FIT_MEMO_LOCK:
+            _FIT_MEMO[key] = hit
+            _FIT_MEMO_STATS["misses"] += 1
+            while len(_FIT_MEMO) > FIT_MEMO_SIZE:
+                _FIT_MEMO.popitem(last=False)
+    size, dims = hit
+    return load_font(fonts_dir, font_name, size), dims
 
 def _get_placeholder_text(cfg: dict, row_data: dict):
     """Extract and format text from single or multiple columns"""
@@ -75,10 +284,24 @@ def _get_placeholder_text(cfg: dict, row_data: dict):
     
     return text
 
-def render_certificate_image(template_path: Path, placeholders: dict, row_data: dict, fonts_dir: Path, default_font: str):
-    img = Image.open(template_path).convert("RGB")
-    draw = ImageDraw.Draw(img)
+def _fit_box(cfg: dict, default_font: str):
+    """(font_name, max_text_width, initial_size) a boxed placeholder is fitted with, or None without a box"""
+    width = int(cfg.get("width", 0))
+    height = int(cfg.get("height", 0))
+    if not width or not height:
+        return None
+    init_size = int(cfg.get("font_size", max(12, int(height * 0.6))))
+    padding = max(4, int(width * 0.03))
+    return cfg.get("font", default_font), max(1, width - padding * 2), init_size
 
+def layout_certificate(placeholders: dict, row_data: dict, fonts_dir: Path, default_font: str, fits: dict = None):
+    """Resolve, fit and position every placeholder's text for one row
+
+    Returns a list of text operations shared by the raster and vector
+    renderers so both place text identically. fits is plan_layout()'s
+    {placeholder: {text: (size, (w, h))}}; texts found there skip fitting.
+    """
+    ops = []
     for key, cfg in placeholders.items():
         text = _get_placeholder_text(cfg, row_data)
         x = int(cfg.get("x", 0))
@@ -95,29 +318,204 @@ def render_certificate_image(template_path: Path, placeholders: dict, row_data:
         # if no width/height draw simple text
         if not width or not height:
             font = load_font(fonts_dir, font_name, init_size)
-            draw.text((x, y), text, font=font, fill=color)
+            ops.append({"key": key, "text": text, "font": font, "x": x, "y": y,
+                        "width": None, "height": None, "color": color, "underline": False})
             continue
 
-        padding = max(4, int(width * 0.03))
-        max_text_width = max(1, width - padding * 2)
-
-        font, (tw, th) = _fit_font_size(draw, text, fonts_dir, font_name, max_text_width, init_size)
+        font_name, max_text_width, init_size = _fit_box(cfg, default_font)
+        fit = fits.get(key, {}).get(text) if fits else None
+        if fit is not None:
+            font, (tw, th) = load_font(fonts_dir, font_name, fit[0]), fit[1]
+        else:
+            font, (tw, th) = _fit_font_size(_MEASURE_DRAW, text, fonts_dir, font_name, max_text_width, init_size)
 
         # center text inside box
         tx = x + (width - tw) / 2
         ty = y + (height - th) / 2
 
-        draw.text((tx, ty), text, font=font, fill=color)
-        
-        # Apply underline if needed
-        if is_underline:
-            underline_y = int(ty + th + 2)
-            draw.line([(tx, underline_y), (tx + tw, underline_y)], fill=color, width=2)
+        ops.append({"key": key, "text": text, "font": font, "x": tx, "y": ty,
+                    "width": tw, "height": th, "color": color, "underline": bool(is_underline)})
+    return ops
+
+def draw_layout(img, ops):
+    """Draw text operations from layout_certificate onto a PIL image"""
+    with metrics.stage("draw"):
+        draw = ImageDraw.Draw(img)
+        for op in ops:
+            tx, ty, color = op["x"], op["y"], op["color"]
+            draw.text((tx, ty), op["text"], font=op["font"], fill=color)
 
+            # Apply underline if needed
+            if op["underline"]:
+                underline_y = int(ty + op["height"] + 2)
+                draw.line([(tx, underline_y), (tx + op["width"], underline_y)], fill=color, width=2)
     return img
 
-def pil_image_to_bytes(pil_img, format="PNG"):
+def _placeholder_columns(cfg: dict):
+    """Sheet columns _get_placeholder_text reads for one placeholder"""
+    columns = cfg.get("columns", [])
+    if columns and isinstance(columns, list) and len(columns) > 0:
+        return [c for c in columns if c]
+    return [cfg["label"]] if cfg.get("label") else []
+
+def static_placeholder_keys(placeholders: dict, constant_columns, sheet_columns):
+    """Placeholders whose text is the same on every row
+
+    A placeholder is static when each column it reads is either constant
+    across the sheet or missing from it (missing columns resolve to "").
+    """
+    constant = set(constant_columns)
+    present = set(sheet_columns)
+    return frozenset(
+        key for key, cfg in placeholders.items()
+        if all(col in constant or col not in present for col in _placeholder_columns(cfg))
+    )
+
+def get_prepared_background(template_path: Path, placeholders: dict, static_keys, row_data: dict,
+                            fonts_dir: Path, default_font: str):
+    """Shared template with the static placeholders already drawn (read-only: copy before drawing)
+
+    Cached in the template's cache entry under the static placeholders'
+    config and resolved text, so a row whose "static" text differs simply
+    gets its own background instead of a wrong one.
+    """
+    static = {k: placeholders[k] for k in placeholders if k in static_keys}
+    texts = [_get_placeholder_text(cfg, row_data) for cfg in static.values()]
+    bg_key = hashlib.sha1(
+        json.dumps([static, texts, str(fonts_dir), default_font], sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+    base = get_template_image(template_path)
+    key = str(Path(template_path).resolve())
+    with _TEMPLATE_CACHE_LOCK:
+        entry = _TEMPLATE_CACHE.get(key)
+        prepared = entry.setdefault("prepared", OrderedDict()) if entry else OrderedDict()
+        if bg_key in prepared:
+            prepared.move_to_end(bg_key)
+            return prepared[bg_key]
+
+    img = draw_layout(base.copy(), layout_certificate(static, row_data, fonts_dir, default_font))
+    with _TEMPLATE_CACHE_LOCK:
+        if entry is not None and entry["image"] is base:
+            prepared[bg_key] = img
+            while len(prepared) > PREPARED_BACKGROUNDS_PER_TEMPLATE:
+                prepared.popitem(last=False)
+    return img
+
+def plan_layout(placeholders: dict, df, fonts_dir: Path, default_font: str, overflow_limit: int = 200):
+    """Fit every distinct placeholder text in the sheet once, before any row is rendered
+
+    Rows are grouped by the columns each placeholder reads, so a repeated
+    value (course title, date) is measured once however many rows use it.
+    Returns {"fits", "unique_texts", "overflow_count", "overflow"}, where
+    overflow lists (up to overflow_limit) rows whose text still does not fit
+    at the smallest size the fitter tries, or was shrunk to the 4px floor.
+    df may be a slice of the sheet; rows are reported by their index label.
+    """
+    fits = {}
+    unique_texts = {}
+    overflow = []
+    overflow_count = 0
+    measured = {}
+    with metrics.stage("layout_plan"):
+        for key, cfg in placeholders.items():
+            box = _fit_box(cfg, default_font)
+            if box is None:
+                continue
+            font_name, max_text_width, init_size = box
+            cols = [c for c in _placeholder_columns(cfg) if c in df.columns]
+            if cols and len(df):
+                combos = df[cols].drop_duplicates()
+                # group numbers follow first appearance, i.e. the order of combos
+                codes = df.groupby(cols, sort=False, dropna=False).ngroup()
+                texts = [_get_placeholder_text(cfg, r) for r in combos.to_dict(orient="records")]
+            else:
+                codes = None
+                texts = [_get_placeholder_text(cfg, {})]
+
+            per_text = {}
+            for text in texts:
+                mkey = (text, font_name, max_text_width, init_size)
+                if mkey not in measured:
+                    measured[mkey] = _search_font_size(_MEASURE_DRAW, text, fonts_dir, font_name,
+                                                       max_text_width, init_size)
+                per_text[text] = measured[mkey]
+            fits[key] = per_text
+            unique_texts[key] = len(per_text)
+
+            bad = [g for g, text in enumerate(texts)
+                   if per_text[text][1][0] > max_text_width or per_text[text][0] <= 4]
+            if not bad:
+                continue
+            if codes is None:
+                rows = range(len(df))
+            else:
+                rows = codes.isin(bad).to_numpy().nonzero()[0]
+            for r in rows:
+                overflow_count += 1
+                if len(overflow) >= overflow_limit:
+                    continue
+                text = texts[codes.iat[r]] if codes is not None else texts[0]
+                size, (tw, _) = per_text[text]
+                row_index = int(df.index[r])
+                overflow.append({
+                    "row_index": row_index,
+                    "row": row_index + 1,
+                    "placeholder": key,
+                    "text": text,
+                    "font_size": size,
+                    "text_width": tw,
+                    "box_width": max_text_width,
+                    "reason": "overflow" if tw > max_text_width else "min_size",
+                })
+    return {"fits": fits, "unique_texts": unique_texts, "overflow_count": overflow_count, "overflow": overflow}
+
+def render_certificate_image(template_path: Path, placeholders: dict, row_data: dict, fonts_dir: Path, default_font: str,
+                             static_keys=None, fits: dict = None):
+    """Composite one certificate; static_keys are drawn once into a cached background"""
+    if static_keys:
+        img = get_prepared_background(template_path, placeholders, static_keys, row_data,
+                                      fonts_dir, default_font).copy()
+        placeholders = {k: v for k, v in placeholders.items() if k not in static_keys}
+    else:
+        img = load_template(template_path)
+    ops = layout_certificate(placeholders, row_data, fonts_dir, default_font, fits)
+    return draw_layout(img, ops)
+
+def scale_placeholders(placeholders: dict, scale: float):
+    """Placeholder boxes and font sizes multiplied by scale (for low-resolution renders)"""
+    if scale == 1:
+        return placeholders
+    scaled = {}
+    for key, cfg in placeholders.items():
+        cfg = dict(cfg)
+        height = int(cfg.get("height", 0))
+        # Resolve the full-size default first so its 12px floor scales down too
+        font_size = int(cfg.get("font_size", max(12, int(height * 0.6) if height else 40)))
+        cfg["font_size"] = max(1, round(font_size * scale))
+        for field in ("x", "y"):
+            cfg[field] = round(int(cfg.get(field, 0)) * scale)
+        for field in ("width", "height"):
+            if int(cfg.get(field, 0)):
+                cfg[field] = max(1, round(int(cfg[field]) * scale))
+        scaled[key] = cfg
+    return scaled
+
+def render_scaled_image(template_path: Path, placeholders: dict, row_data: dict, fonts_dir: Path, default_font: str,
+                        scale: float = 1.0):
+    """render_certificate_image on a downscaled template with proportionally scaled text"""
+    if scale >= 1:
+        return render_certificate_image(template_path, placeholders, row_data, fonts_dir, default_font)
+    img = get_scaled_template(template_path, scale).copy()
+    ops = layout_certificate(scale_placeholders(placeholders, scale), row_data, fonts_dir, default_font)
+    return draw_layout(img, ops)
+
+def pil_image_to_bytes(pil_img, format="PNG", quality=None):
     import io
     buf = io.BytesIO()
-    pil_img.save(buf, format=format)
+    options = {}
+    if format.upper() in ("JPEG", "WEBP"):
+        options["quality"] = quality or 85
+        if format.upper() == "JPEG" and pil_img.mode not in ("RGB", "L"):
+            pil_img = pil_img.convert("RGB")
+    pil_img.save(buf, format=format, **options)
     return buf.getvalue()
@@ -0,0 +1,170 @@
+"""
+Incremental Regeneration Module
+Re-renders only the rows whose inputs changed since the last run into the same folder
+"""
+
+import hashlib
+import json
+import shutil
+import struct
+import zipfile
+from pathlib import Path
+
+from .pdf_generator import pdf_filename, write_zip
+
+# Size of the fixed part of a zip local file header, and the data-descriptor flag bit
+_LOCAL_HEADER_SIZE = 30
+_DATA_DESCRIPTOR_FLAG = 0x08
+
+
+def placeholder_columns(placeholders: dict, filename_field: str = None):
+    """Sheet columns that influence a row's output (text and filename)"""
+    columns = set()
+    for cfg in placeholders.values():
+        cols = cfg.get("columns") or []
+        if isinstance(cols, list) and cols:
+            columns.update(c for c in cols if c)
+        elif cfg.get("label"):
+            columns.add(cfg["label"])
+    columns.add(filename_field or "name")
+    return sorted(columns)
+
+
+def row_fingerprint(row: dict, columns, base: str):
+    values = [str(row.get(c, "")) if c in row else None for c in columns]
+    return hashlib.sha1(json.dumps([base, values], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class IncrementalPlan:
+    """Row filter for create_pdfs_from_rows that skips rows whose output is still valid
+
+    base is a hash of the template and placeholder config, so changing either
+    invalidates every row. While rows stream through, the plan records every
+    current filename with its fingerprint.
+    """
+
+    def __init__(self, previous: dict, placeholders: dict, filename_field: str, base: str,
+                 job_folder: Path, old_archives=()):
+        self.previous = previous
+        self.columns = placeholder_columns(placeholders, filename_field)
+        self.filename_field = filename_field
+        self.base = base
+        self.job_folder = job_folder
+        # The previous run's zip or zip volumes, whichever exist
+        self.old_archives = []
+        self.old_zip_names = set()
+        for archive in old_archives:
+            try:
+                with zipfile.ZipFile(archive) as z:
+                    self.old_zip_names.update(z.namelist())
+            except (FileNotFoundError, zipfile.BadZipFile):
+                continue
+            self.old_archives.append(Path(archive))
+        self.current = {}
+        self.changed = set()
+        self.reused = set()
+
+    def __call__(self, i, row):
+        name = pdf_filename(i, row, self.filename_field)
+        fp = row_fingerprint(row, self.columns, self.base)
+        self.current[name] = fp
+        available = name in self.old_zip_names or (self.job_folder / name).exists()
+        if self.previous.get(name) == fp and available:
+            self.reused.add(name)
+            return False
+        self.changed.add(name)
+        return True
+
+    @property
+    def removed(self):
+        return set(self.previous) - set(self.current)
+
+    def finish(self, rendered_names):
+        """Drop outputs of removed rows and return the fingerprints to store
+
+        Rows that failed to render are left out so the next run retries them.
+        """
+        for name in self.removed:
+            (self.job_folder / name).unlink(missing_ok=True)
+        failed = self.changed - set(rendered_names)
+        return {name: fp for name, fp in self.current.items() if name not in failed}
+
+
+def copy_raw_entry(zin: zipfile.ZipFile, src: zipfile.ZipInfo, zout: zipfile.ZipFile, name: str):
+    """Append an entry of zin to zout under name without inflating or re-deflating it
+
+    The compressed bytes are copied as they are behind a fresh local
+    header. zipfile has no public call for this, so the header is written
+    the way ZipFile.mkdir does it (fp, FileHeader, filelist, NameToInfo,
+    start_dir); if those ever change, the entry is recompressed instead.
+    """
+    info = zipfile.ZipInfo(name, date_time=src.date_time)
+    info.compress_type = src.compress_type
+    info.external_attr = src.external_attr
+    info.flag_bits = src.flag_bits & ~_DATA_DESCRIPTOR_FLAG
+    info.CRC = src.CRC
+    info.compress_size = src.compress_size
+    info.file_size = src.file_size
+    try:
+        fp = zout.fp
+        fp.seek(zout.start_dir)
+        info.header_offset = fp.tell()
+        header = info.FileHeader()
+        filelist, name_to_info = zout.filelist, zout.NameToInfo
+    except AttributeError:
+        with zin.open(src) as data, zout.open(info, "w") as dst:
+            shutil.copyfileobj(data, dst, 1024 * 1024)
+        return
+    with open(zin.filename, "rb") as f:
+        f.seek(src.header_offset)
+        local = f.read(_LOCAL_HEADER_SIZE)
+        if local[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Bad local header for {src.filename} in {zin.filename}")
+        name_length, extra_length = struct.unpack("<HH", local[26:30])
+        f.seek(src.header_offset + _LOCAL_HEADER_SIZE + name_length + extra_length)
+        fp.write(header)
+        remaining = src.compress_size
+        while remaining > 0:
+            block = f.read(min(1024 * 1024, remaining))
+            if not block:
+                raise zipfile.BadZipFile(f"Truncated entry {src.filename} in {zin.filename}")
+            fp.write(block)
+            remaining -= len(block)
+    filelist.append(info)
+    name_to_info[info.filename] = info
+    zout.start_dir = fp.tell()
+
+
+def rebuild_zip(zip_path: Path, names, job_folder: Path, old_archives=(),
+                compression=zipfile.ZIP_DEFLATED, compresslevel=6, max_part_bytes=None, max_part_files=None):
+    """Write zip_path (or only its volumes, see write_zip) with the given entries
+
+    Each entry is taken from job_folder, or else from the previous run's
+    archives: unchanged rows whose PDFs were already removed from disk are
+    copied entry by entry, still compressed, instead of being re-rendered.
+    Returns the paths written.
+    """
+    sources = {}
+    archives = []
+    try:
+        for archive in old_archives:
+            try:
+                zin = zipfile.ZipFile(archive)
+            except (FileNotFoundError, zipfile.BadZipFile):
+                continue
+            archives.append(zin)
+            for info in zin.infolist():
+                sources.setdefault(info.filename, (zin, info))
+
+        entries = []
+        for name in sorted(names):
+            path = job_folder / name
+            if path.exists():
+                entries.append((name, path.stat().st_size, lambda z, n, path=path: z.write(str(path), arcname=n)))
+            else:
+                zin, info = sources[name]
+                entries.append((name, info.compress_size, lambda z, n, zin=zin, info=info: copy_raw_entry(zin, info, z, n)))
+        return write_zip(zip_path, entries, compression, compresslevel, max_part_bytes, max_part_files)
+    finally:
+        for zin in archives:
+            zin.close()
@@ -0,0 +1,276 @@
+"""
+Background Job Module
+Runs certificate batches on a bounded executor and tracks their progress
+"""
+
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .pdf_generator import GenerationCancelled
+from . import metrics
+
+
+class Job:
+    """Progress and outcome of a single generation batch"""
+
+    # Progress is written to the shared store at most this often
+    PERSIST_INTERVAL = 0.5
+
+    def __init__(self, job_id, session_id=None, store=None):
+        self.job_id = job_id
+        self.session_id = session_id
+        self.store = store
+        self._persisted_at = 0.0
+        self.state = "queued"
+        self.rows_done = 0
+        self.rows_total = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        # Per-stage time for this job, filled in by the generator
+        self.timings = {}
+        self.cancel_event = threading.Event()
+        self.future = None
+        self._lock = threading.Lock()
+
+    def set_total(self, total):
+        with self._lock:
+            self.rows_total = total
+
+    def progress(self, done, total=None):
+        """Progress callback handed to the PDF generator"""
+        with self._lock:
+            self.rows_done = done
+            if total is not None:
+                self.rows_total = total
+        if self.store is not None and time.time() - self._persisted_at >= self.PERSIST_INTERVAL:
+            self.persist()
+            # A cancel issued through another worker process arrives via the store
+            if self.store.cancel_requested(self.job_id):
+                self.cancel_event.set()
+
+    def persist(self):
+        """Publish the current snapshot so every worker can answer /jobs/{id}"""
+        if self.store is None:
+            return
+        self._persisted_at = time.time()
+        try:
+            self.store.save_job(self.job_id, self.session_id, self.state, self.to_dict())
+        except Exception as e:
+            print(f"[Jobs] Could not persist job {self.job_id}: {e}")
+
+    @property
+    def finished(self):
+        return self.state in {"completed", "failed", "cancelled"}
+
+    def to_dict(self):
+        with self._lock:
+            done, total = self.rows_done, self.rows_total
+        now = self.finished_at or time.time()
+        elapsed = (now - self.started_at) if self.started_at else 0.0
+        throughput = done / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.state == "running" and throughput > 0 and total:
+            eta = round(max(0, total - done) / throughput, 1)
+        return {
+            "job_id": self.job_id,
+            "session_id": self.session_id,
+            "state": self.state,
+            "rows_done": done,
+            "rows_total": total,
+            "elapsed_seconds": round(elapsed, 2),
+            "rows_per_second": round(throughput, 2),
+            "eta_seconds": eta,
+            "created_at": datetime.fromtimestamp(self.created_at).isoformat(timespec="seconds"),
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """Bounded pool of generation jobs with lookup and cancellation"""
+
+    def __init__(self, max_concurrent_jobs=2, history_limit=200, store=None, heartbeat_seconds=15,
+                 stale_seconds=120):
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.history_limit = history_limit
+        # Optional StateStore shared with the other server processes
+        self.store = store
+        # Unfinished jobs are re-stamped every heartbeat_seconds; rows left
+        # unstamped for stale_seconds belong to a dead worker
+        self.heartbeat_seconds = heartbeat_seconds
+        self.stale_seconds = stale_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_jobs, thread_name_prefix="job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        if store is not None:
+            threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def _heartbeat(self):
+        while not self._stopping.wait(self.heartbeat_seconds):
+            try:
+                with self._lock:
+                    active = [j.job_id for j in self._jobs.values() if not j.finished]
+                if active:
+                    self.store.touch_jobs(active)
+            except Exception as e:
+                print(f"[Jobs] Heartbeat failed: {e}")
+
+    def reap_stale(self):
+        """Fail jobs whose worker stopped stamping them (crashed or killed mid-batch)"""
+        if self.store is None:
+            return []
+        reaped = self.store.fail_stale_jobs(self.stale_seconds, "Worker stopped before the job finished")
+        for job_id in reaped:
+            print(f"[Jobs] Job {job_id} marked failed: no heartbeat for {self.stale_seconds}s")
+        return reaped
+
+    def submit(self, job_id, fn, *args, session_id=None, **kwargs):
+        """Queue fn(job, *args, **kwargs); its return value becomes job.result"""
+        job = self._register(job_id, session_id)
+        metrics.JOBS_IN_FLIGHT.inc()
+        job.future = self._executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def start(self, job_id, session_id=None):
+        """Register a job the caller runs itself (e.g. a streamed response); end it with finish()
+
+        It is checked for conflicts, owned, listed and kept out of cleanup
+        exactly like a submitted job.
+        """
+        job = self._register(job_id, session_id)
+        metrics.JOBS_IN_FLIGHT.inc()
+        job.state = "running"
+        job.started_at = time.time()
+        job.persist()
+        return job
+
+    def finish(self, job, state, result=None, error=None):
+        """Record the outcome of a job registered with start()"""
+        if job.finished:
+            return
+        job.result = result
+        job.error = error
+        job.state = state
+        job.finished_at = time.time()
+        job.persist()
+        metrics.JOBS_IN_FLIGHT.dec()
+        metrics.JOBS_TOTAL.inc(state=job.state)
+
+    def _register(self, job_id, session_id):
+        with self._lock:
+            existing = self._jobs.get(job_id)
+            if existing and not existing.finished:
+                raise ValueError(f"Job '{job_id}' is already {existing.state}")
+            if existing is None and self.store is not None:
+                self.reap_stale()
+                state = self.store.job_state(job_id)
+                if state in {"queued", "running"}:
+                    raise ValueError(f"Job '{job_id}' is already {state}")
+            job = Job(job_id, session_id=session_id, store=self.store)
+            self._jobs[job_id] = job
+            self._prune()
+        if self.store is not None:
+            self.store.reset_job(job_id)
+        job.persist()
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        try:
+            self._execute(job, fn, args, kwargs)
+        finally:
+            job.persist()
+            metrics.JOBS_IN_FLIGHT.dec()
+            metrics.JOBS_TOTAL.inc(state=job.state)
+
+    def _execute(self, job, fn, args, kwargs):
+        if job.cancel_event.is_set():
+            job.state = "cancelled"
+            job.finished_at = time.time()
+            return
+        job.state = "running"
+        job.started_at = time.time()
+        job.persist()
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.state = "completed"
+        except GenerationCancelled:
+            job.state = "cancelled"
+            print(f"[Jobs] Job {job.job_id} cancelled after {job.rows_done} rows")
+        except Exception as e:
+            job.state = "failed"
+            job.error = str(e)
+            print(f"[Jobs] Job {job.job_id} failed: {e}")
+            traceback.print_exc()
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def status(self, job_id):
+        """Job snapshot from this process, or from the shared store if another worker owns it"""
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.store is not None:
+            return self.store.get_job(job_id)
+        return None
+
+    def list_status(self, session_id=None):
+        local = {j.job_id: j.to_dict() for j in self.list() if session_id is None or j.session_id == session_id}
+        if self.store is not None and session_id is not None:
+            for data in self.store.list_jobs(session_id, limit=self.history_limit):
+                local.setdefault(data["job_id"], data)
+        return list(local.values())
+
+    def cancel(self, job_id):
+        """Request cancellation; returns the job snapshot or None if unknown"""
+        job = self.get(job_id)
+        if job is not None:
+            if not job.finished:
+                job.cancel_event.set()
+            if self.store is not None:
+                self.store.request_cancel(job_id)
+            return job.to_dict()
+        if self.store is not None and self.store.request_cancel(job_id):
+            return self.store.get_job(job_id)
+        return None
+
+    def active_job_ids(self):
+        with self._lock:
+            active = {j.job_id for j in self._jobs.values() if not j.finished}
+        if self.store is not None:
+            active |= self.store.running_job_ids(max_idle_seconds=self.stale_seconds)
+        return active
+
+    def _prune(self):
+        """Forget the oldest finished jobs beyond history_limit"""
+        finished = sorted((j for j in self._jobs.values() if j.finished), key=lambda j: j.created_at)
+        for job in finished[:max(0, len(self._jobs) - self.history_limit)]:
+            self._jobs.pop(job.job_id, None)
+
+    def shutdown(self):
+        self._stopping.set()
+        for job in self.list():
+            job.cancel_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        # Futures dropped by cancel_futures never reach _run; record their jobs as cancelled
+        for job in self.list():
+            if job.future is not None and job.future.cancelled():
+                job.state = "cancelled"
+                job.finished_at = time.time()
+                job.persist()
+                metrics.JOBS_IN_FLIGHT.dec()
+                metrics.JOBS_TOTAL.inc(state=job.state)
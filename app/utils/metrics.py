@@ -0,0 +1,188 @@
+"""
+Metrics Module
+In-process counters, gauges and histograms exposed in Prometheus text format
+
+Hot paths wrap their work in `stage("name")`. Inside `collect()` (one per
+rendered row) the durations are gathered on a StageTimer and returned with
+the row, so rows rendered in worker processes are still reported by the
+parent. Outside `collect()` they go straight into the stage histogram.
+Stages nest: "fit" includes the "font_load" calls it triggers.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+_DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + (list(extra) if extra else [])
+    if not pairs:
+        return ""
+    body = ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in pairs)
+    return "{" + body + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.type = "counter"
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, v) for key, v in self._values.items()]
+
+
+class Gauge(Counter):
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self.type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=_DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.type = "histogram"
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][idx] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, series in self._series.items():
+                for bound, c in zip(self.buckets, series["counts"]):
+                    out.append((self.name + "_bucket", key + (("le", repr(float(bound))),), c))
+                out.append((self.name + "_bucket", key + (("le", "+Inf"),), series["count"]))
+                out.append((self.name + "_sum", key, series["sum"]))
+                out.append((self.name + "_count", key, series["count"]))
+        return out
+
+
+_METRICS = []
+_COLLECTORS = []
+
+
+def _register(metric):
+    _METRICS.append(metric)
+    return metric
+
+
+def register_collector(fn):
+    """fn() -> list of (name, type, help, [(labels_dict, value), ...]) evaluated at scrape time"""
+    _COLLECTORS.append(fn)
+    return fn
+
+
+STAGE_SECONDS = _register(Histogram("certgen_stage_seconds", "Time spent per pipeline stage (per row for render stages)"))
+ROWS_RENDERED = _register(Counter("certgen_rows_rendered_total", "Certificates rendered successfully"))
+ROWS_FAILED = _register(Counter("certgen_rows_failed_total", "Certificates that failed to render"))
+JOBS_TOTAL = _register(Counter("certgen_jobs_total", "Generation jobs finished, by final state"))
+JOBS_IN_FLIGHT = _register(Gauge("certgen_jobs_in_flight", "Generation jobs queued or running"))
+
+
+class StageTimer:
+    """Accumulates stage durations for one unit of work (e.g. one row)"""
+
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+
+_local = threading.local()
+
+
+def observe(name, seconds):
+    timer = getattr(_local, "timer", None)
+    if timer is not None:
+        timer.add(name, seconds)
+    else:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+@contextmanager
+def stage(name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0)
+
+
+@contextmanager
+def collect():
+    """Gather the stages of the enclosed work on a fresh StageTimer"""
+    previous = getattr(_local, "timer", None)
+    timer = StageTimer()
+    _local.timer = timer
+    try:
+        yield timer
+    finally:
+        _local.timer = previous
+
+
+def record_row(totals, ok=True, breakdown=None):
+    """Report one row's stage totals (from any process) and optionally add them to a job breakdown"""
+    (ROWS_RENDERED if ok else ROWS_FAILED).inc()
+    for name, seconds in totals.items():
+        STAGE_SECONDS.observe(seconds, stage=name)
+        if breakdown is not None:
+            entry = breakdown.setdefault(name, {"seconds": 0.0, "count": 0})
+            entry["seconds"] += seconds
+            entry["count"] += 1
+
+
+def render_prometheus():
+    lines = []
+    for metric in _METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, key, value in metric.samples():
+            lines.append(f"{name}{_format_labels(key)} {value}")
+    for fn in _COLLECTORS:
+        try:
+            families = fn()
+        except Exception as e:
+            print(f"[Metrics] Collector failed: {e}")
+            continue
+        for name, mtype, help_text, values in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {mtype}")
+            for labels, value in values:
+                lines.append(f"{name}{_format_labels(_label_key(labels))} {value}")
+    return "\n".join(lines) + "\n"
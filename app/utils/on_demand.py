@@ -0,0 +1,173 @@
+"""
+On-demand Certificate Module
+Per-recipient certificates rendered on first download, kept in a size-bounded disk cache
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ondemand_jobs (
+    job_id TEXT PRIMARY KEY,
+    session_id TEXT,
+    version TEXT NOT NULL,
+    config TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS ondemand_rows (
+    job_id TEXT NOT NULL,
+    row_key TEXT NOT NULL,
+    row_index INTEGER NOT NULL,
+    PRIMARY KEY (job_id, row_key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS certificate_cache (
+    cache_key TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_certificate_cache_lru ON certificate_cache(last_used);
+CREATE INDEX IF NOT EXISTS idx_certificate_cache_job ON certificate_cache(job_id);
+"""
+
+
+def normalize_key(value):
+    """Lookup form of a row key: trimmed, case-folded, 12.0 -> "12" (numeric ids read from sheets)"""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip().casefold()
+
+
+class OnDemandStore:
+    """Published on-demand jobs, their row-key index and the rendered-certificate cache
+
+    A job freezes a session's template, sheet and layout under a job id.
+    Rows are looked up through an indexed (job_id, row_key) table built
+    once at publish time. Rendered PDFs are written under cache_dir and
+    evicted least-recently-used once they exceed max_bytes.
+    """
+
+    def __init__(self, state_store, cache_dir, max_bytes):
+        self.store = state_store
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._stats_lock = threading.Lock()
+        self.store.executescript(_SCHEMA)
+
+    # ---- jobs ----
+
+    def publish(self, job_id: str, session_id: str, config: dict, version: str, keys):
+        """Register (or replace) a job; keys yields (row_key, row_index), first occurrence wins
+
+        Returns the number of distinct keys indexed.
+        """
+        self.drop_cached(job_id)
+        conn = self.store.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM ondemand_rows WHERE job_id = ?", (job_id,))
+            conn.execute(
+                "INSERT OR REPLACE INTO ondemand_jobs (job_id, session_id, version, config, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, session_id, version, json.dumps(config), time.time()),
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO ondemand_rows (job_id, row_key, row_index) VALUES (?, ?, ?)",
+                ((job_id, normalize_key(key), index) for key, index in keys),
+            )
+        return self.store.execute("SELECT COUNT(*) FROM ondemand_rows WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+    def get_job(self, job_id: str):
+        row = self.store.execute("SELECT session_id, version, config FROM ondemand_jobs WHERE job_id = ?",
+                                 (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {"session_id": row["session_id"], "version": row["version"], **json.loads(row["config"])}
+
+    def lookup(self, job_id: str, row_key: str):
+        """0-based row index for a key (primary-key lookup), or None"""
+        row = self.store.execute("SELECT row_index FROM ondemand_rows WHERE job_id = ? AND row_key = ?",
+                                 (job_id, normalize_key(row_key))).fetchone()
+        return row["row_index"] if row else None
+
+    def delete(self, job_id: str):
+        self.drop_cached(job_id)
+        conn = self.store.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM ondemand_rows WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM ondemand_jobs WHERE job_id = ?", (job_id,))
+
+    # ---- rendered certificate cache ----
+
+    @staticmethod
+    def cache_key(job_id: str, version: str, row_index: int):
+        return hashlib.sha1(f"{job_id}\0{version}\0{row_index}".encode("utf-8")).hexdigest()
+
+    def cached(self, cache_key: str):
+        """Path of a cached certificate (marked as just used), or None"""
+        row = self.store.execute("SELECT path FROM certificate_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        path = Path(row["path"]) if row else None
+        if path is None or not path.exists():
+            with self._stats_lock:
+                self._stats["misses"] += 1
+            return None
+        self.store.execute("UPDATE certificate_cache SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+        with self._stats_lock:
+            self._stats["hits"] += 1
+        return path
+
+    def put(self, cache_key: str, job_id: str, data: bytes):
+        """Write a rendered certificate into the cache and evict down to max_bytes"""
+        path = self.cache_dir / cache_key[:2] / f"{cache_key}.pdf"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.part")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        self.store.execute(
+            "INSERT OR REPLACE INTO certificate_cache (cache_key, job_id, path, size, last_used) VALUES (?, ?, ?, ?, ?)",
+            (cache_key, job_id, str(path), len(data), time.time()),
+        )
+        self.evict()
+        return path
+
+    def evict(self):
+        """Delete least recently used certificates until the cache fits max_bytes"""
+        total = self.store.execute("SELECT COALESCE(SUM(size), 0) FROM certificate_cache").fetchone()[0]
+        evicted = 0
+        while total > self.max_bytes:
+            rows = self.store.execute(
+                "SELECT cache_key, path, size FROM certificate_cache ORDER BY last_used LIMIT 64").fetchall()
+            if not rows:
+                break
+            for r in rows:
+                if total <= self.max_bytes:
+                    break
+                self._remove(r["cache_key"], r["path"])
+                total -= r["size"]
+                evicted += 1
+        if evicted:
+            with self._stats_lock:
+                self._stats["evictions"] += evicted
+        return evicted
+
+    def drop_cached(self, job_id: str):
+        """Forget every cached certificate of a job"""
+        rows = self.store.execute("SELECT cache_key, path FROM certificate_cache WHERE job_id = ?", (job_id,)).fetchall()
+        for r in rows:
+            self._remove(r["cache_key"], r["path"])
+        return len(rows)
+
+    def _remove(self, cache_key, path):
+        Path(path).unlink(missing_ok=True)
+        self.store.execute("DELETE FROM certificate_cache WHERE cache_key = ?", (cache_key,))
+
+    def stats(self):
+        row = self.store.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM certificate_cache").fetchone()
+        with self._stats_lock:
+            return {**self._stats, "entries": row[0], "bytes": row[1], "max_bytes": self.max_bytes}
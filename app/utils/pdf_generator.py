@@ -1,68 +1,748 @@
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
+from reportlab.lib.colors import toColor
+from reportlab.pdfbase import pdfmetrics, pdfdoc
+from reportlab import rl_config
+from reportlab.pdfbase.ttfonts import TTFont
 from pathlib import Path
+from PIL import Image
 import zipfile
-from .image_processor import render_certificate_image
+from .image_processor import (
+    render_certificate_image, index_fonts, load_template,
+    get_template_image, layout_certificate
+)
+import copy
+import hashlib
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 import io
+import multiprocessing
+import os
+import time
+
+from . import metrics
+from .storage_index import zip_part_name
+from .pdf_merge import PdfAppender
+from ..settings import (
+    RENDER_EXECUTOR, RENDER_WORKERS, RENDER_CHUNK_SIZE,
+    RENDER_PROCESS_MIN_ROWS, RENDER_MP_CONTEXT, OUTPUT_MODE, ENCODE_WORKERS, SINK_WORKERS, PIPELINE_DEPTH,
+    PDF_IMAGE_FORMAT, PDF_JPEG_QUALITY, TEMPLATE_DPI, PDF_TARGET_DPI, PDF_MAX_IMAGE_EDGE, MERGED_PDF_CHUNK_PAGES
+)
+
+OUTPUT_MODES = {"raster", "vector"}
+IMAGE_FORMATS = {"flate", "jpeg"}
+
+# Embedded images are written as binary streams; ASCII85 would add 25% to every page image
+rl_config.useA85 = 0
+
+# (template path, mtime_ns, size) -> encoded template XObject for vector pages
+_BACKGROUNDS = OrderedDict()
+_BACKGROUNDS_LOCK = threading.Lock()
+_BACKGROUNDS_MAX = 4
+
+# Font file path -> ReportLab font name (None when ReportLab cannot embed it, e.g. CFF .otf)
+_RL_FONTS = {}
+_RL_FONTS_LOCK = threading.Lock()
+
+class GenerationCancelled(Exception):
+    """Raised when a batch is cancelled through its cancel_event"""
+
 
 def _sanitize_filename(s: str):
     return re.sub(r'[^\w\-_\. ]', '_', str(s))
 
-def _generate_single_pdf(args):
-    """Helper function for parallel PDF generation"""
-    i, row, template_path, placeholders, fonts_dir, output_dir, default_font, filename_field = args
+def pdf_filename(i: int, row: dict, filename_field: str = None):
+    """Output filename for row i (1-based), e.g. 007_Jane Doe.pdf"""
+    if filename_field and filename_field in row:
+        safe_name = _sanitize_filename(row.get(filename_field, f"row_{i}"))
+    else:
+        safe_name = _sanitize_filename(row.get("name", f"row_{i}"))
+    return f"{i:03d}_{safe_name}.pdf"
+
+def _reportlab_font(font):
+    """Register the TTF behind a PIL font with ReportLab once and return its name"""
+    path = getattr(font, "path", None)
+    if not isinstance(path, str):
+        return None
+    with _RL_FONTS_LOCK:
+        if path in _RL_FONTS:
+            return _RL_FONTS[path]
+        name = "Cert-" + hashlib.sha1(path.encode("utf-8")).hexdigest()[:12]
+        try:
+            pdfmetrics.registerFont(TTFont(name, path))
+        except Exception as e:
+            print(f"Font {Path(path).name} cannot be embedded as PDF text, using raster output: {e}")
+            name = None
+        _RL_FONTS[path] = name
+        return name
+
+def _vector_ops(ops):
+    """Attach ReportLab font names/colors to layout ops, or None if any op needs raster output"""
+    prepared = []
+    for op in ops:
+        if "\n" in op["text"]:
+            return None
+        font_name = _reportlab_font(op["font"])
+        if font_name is None:
+            return None
+        try:
+            color = toColor(op["color"])
+        except Exception:
+            return None
+        prepared.append({**op, "rl_font": font_name, "rl_color": color})
+    return prepared
+
+def _background_xobject(template_path: Path):
+    """Template image XObject, compressed once per template and shared by every document
+
+    drawImage(path) decodes and deflates the whole template again in each
+    new document; a JPEG template is embedded as-is either way.
+    """
+    path = Path(template_path).resolve()
+    st = path.stat()
+    key = (str(path), st.st_mtime_ns, st.st_size)
+    with _BACKGROUNDS_LOCK:
+        xobj = _BACKGROUNDS.get(key)
+        if xobj is not None:
+            _BACKGROUNDS.move_to_end(key)
+            return xobj
+    with metrics.stage("background_encode"):
+        name = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        xobj = pdfdoc.PDFImageXObject(name, str(path))
+        xobj.name = name
+    with _BACKGROUNDS_LOCK:
+        _BACKGROUNDS[key] = xobj
+        while len(_BACKGROUNDS) > _BACKGROUNDS_MAX:
+            _BACKGROUNDS.popitem(last=False)
+    return xobj
+
+def _draw_background(c, template_path: Path, page_size):
+    """canvas.drawImage for the cached template XObject (same registration, no re-encoding)
+
+    ReportLab has no public call for drawing an already-encoded image, so
+    this repeats what drawImage does internally (canvas._doc, _setXObjects,
+    _code, _formsinuse). requirements.txt pins ReportLab to the series this
+    was written against; should those internals still change, pages fall
+    back to plain drawImage, which re-encodes the template per document.
+    """
+    xobj = _background_xobject(template_path)
     try:
-        img = render_certificate_image(template_path, placeholders, row, fonts_dir, default_font)
-        
-        # Determine filename
-        if filename_field and filename_field in row:
-            safe_name = _sanitize_filename(row.get(filename_field, f"row_{i}"))
-        else:
-            safe_name = _sanitize_filename(row.get("name", f"row_{i}"))
-        
-        pdf_path = output_dir / f"{i:03d}_{safe_name}.pdf"
-        
-        # Create PDF from image
+        doc, code, forms_in_use, set_xobjects = c._doc, c._code, c._formsinuse, c._setXObjects
+        reg_name = doc.getXObjectName(xobj.name)
+    except AttributeError:
+        c.drawImage(str(template_path), 0, 0, width=page_size[0], height=page_size[1])
+        return
+    if doc.idToObject.get(reg_name) is None:
+        # each document gets its own shallow copy; the compressed stream is shared
+        obj = copy.copy(xobj)
+        set_xobjects(obj)
+        doc.Reference(obj, reg_name)
+        doc.addForm(xobj.name, obj)
+    c._currentPageHasImages = 1
+    c.saveState()
+    c.scale(page_size[0], page_size[1])
+    code.append(f"/{reg_name} Do")
+    c.restoreState()
+    forms_in_use.append(xobj.name)
+
+def draw_vector_page(c, template_path: Path, ops, page_size):
+    """Draw the template background and real PDF text for one row onto canvas c
+
+    The background XObject is encoded once per template and process, and a
+    document references it from every page that draws it, so merged
+    documents share one copy.
+    """
+    img_w, img_h = page_size
+    _draw_background(c, template_path, page_size)
+    for op in ops:
+        font = op["font"]
+        ascent = font.getmetrics()[0]
+        c.setFillColor(op["rl_color"])
+        c.setFont(op["rl_font"], font.size)
+        # PIL places the ascender line at y; PDF draws from the baseline, bottom-up
+        c.drawString(op["x"], img_h - (op["y"] + ascent), op["text"])
+
+        if op["underline"]:
+            underline_y = img_h - int(op["y"] + op["height"] + 2)
+            c.setStrokeColor(op["rl_color"])
+            c.setLineWidth(2)
+            c.line(op["x"], underline_y, op["x"] + op["width"], underline_y)
+
+def raster_encoding(image_format: str = None, jpeg_quality: int = None, dpi: int = None, max_edge: int = None):
+    """Raster page settings for one job, defaulting to the PDF OUTPUT settings"""
+    image_format = (image_format or PDF_IMAGE_FORMAT).lower()
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"image_format must be one of {sorted(IMAGE_FORMATS)}")
+    return {
+        "format": image_format,
+        "quality": min(100, max(1, int(jpeg_quality or PDF_JPEG_QUALITY))),
+        "dpi": dpi or PDF_TARGET_DPI,
+        "max_edge": max_edge or PDF_MAX_IMAGE_EDGE,
+    }
+
+class _JpegBytesReader(ImageReader):
+    """ImageReader over encoded JPEG bytes, which ReportLab embeds as-is (DCTDecode)"""
+
+    def __init__(self, data: bytes):
+        super().__init__(io.BytesIO(data))
+        self._jpeg = data
+        # drawImage reads the soft mask before anything else; a JPEG never has one
+        self._dataA = None
+
+    def getRGBData(self):
+        # drawImage only calls this to name the image XObject; the JPEG bytes
+        # identify it just as well without decoding the whole bitmap again
+        return self._jpeg
+
+def _page_image(img, encoding: dict = None):
+    """ImageReader for a composited page, downsampled and encoded per the job's raster settings"""
+    encoding = encoding or raster_encoding()
+    scale = 1.0
+    if encoding.get("dpi"):
+        scale = min(scale, encoding["dpi"] / TEMPLATE_DPI)
+    if encoding.get("max_edge"):
+        scale = min(scale, encoding["max_edge"] / max(img.size))
+    if scale < 1:
+        with metrics.stage("downsample"):
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+    if encoding.get("format") == "jpeg":
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, format="JPEG", quality=encoding["quality"])
+        return _JpegBytesReader(buf.getvalue())
+    return ImageReader(img)
+
+def _raster_pdf_bytes(img, encoding: dict = None):
+    with metrics.stage("pdf_encode"):
+        buf = io.BytesIO()
+        # The page keeps the template's size; a downsampled image is simply stretched over it
         img_w, img_h = img.size
-        c = canvas.Canvas(str(pdf_path), pagesize=(img_w, img_h))
-        img_reader = ImageReader(img)
+        c = canvas.Canvas(buf, pagesize=(img_w, img_h))
+        img_reader = _page_image(img, encoding)
         c.drawImage(img_reader, 0, 0, width=img_w, height=img_h)
         c.showPage()
         c.save()
-        
-        return pdf_path
+    return buf.getvalue()
+
+def render_pdf_bytes(template_path: Path, placeholders: dict, row: dict, fonts_dir: Path, default_font: str,
+                     output_mode: str = None, static_keys=None, fits: dict = None, encoding: dict = None):
+    """Render one certificate and return the PDF document as bytes
+
+    output_mode "raster" embeds the composited bitmap; "vector" embeds the
+    template once and draws selectable text with the same fonts and layout.
+    Rows the vector path cannot reproduce exactly fall back to raster.
+    static_keys (raster only) names placeholders whose text is identical on
+    every row; they come from a cached pre-drawn background. fits are
+    precomputed font sizes from plan_layout. encoding (see raster_encoding)
+    picks the raster image's resolution and compression.
+    """
+    page = _render_page(template_path, placeholders, row, fonts_dir, default_font, output_mode, static_keys, fits)
+    if isinstance(page, bytes):
+        return page
+    return _raster_pdf_bytes(page, encoding)
+
+def _render_page(template_path: Path, placeholders: dict, row: dict, fonts_dir: Path, default_font: str,
+                 output_mode: str = None, static_keys=None, fits: dict = None):
+    """Finished PDF bytes for a vector page, otherwise the composited PIL image still to be encoded"""
+    if (output_mode or OUTPUT_MODE) == "vector":
+        ops = _vector_ops(layout_certificate(placeholders, row, fonts_dir, default_font, fits))
+        if ops is not None:
+            page_size = get_template_image(template_path).size
+            with metrics.stage("pdf_encode"):
+                buf = io.BytesIO()
+                c = canvas.Canvas(buf, pagesize=page_size)
+                draw_vector_page(c, template_path, ops, page_size)
+                c.showPage()
+                c.save()
+            return buf.getvalue()
+
+    # Create PDF from image
+    return render_certificate_image(template_path, placeholders, row, fonts_dir, default_font, static_keys, fits)
+
+# ---- pipeline stages ----
+# Each row passes render -> encode -> sink. A stage takes the previous
+# stage's tuple and returns the next one (the sink returns the final result).
+
+def _render_stage(item, config: dict):
+    """(i, row) -> (i, filename, page image or vector PDF bytes)"""
+    i, row = item
+    page = _render_page(config["template_path"], config["placeholders"], row, config["fonts_dir"],
+                        config["default_font"], config["output_mode"], config.get("static_keys"),
+                        config.get("fits"))
+    return i, pdf_filename(i, row, config["filename_field"]), page
+
+def _encode_stage(item, config: dict):
+    """(i, filename, page) -> (i, filename, PDF bytes)"""
+    i, name, page = item
+    if isinstance(page, bytes):
+        return item
+    return i, name, _raster_pdf_bytes(page, config.get("encoding"))
+
+def _sink_stage(item, config: dict):
+    """Write the PDF into config["output_dir"] and return its path, or return (filename, bytes) without one"""
+    i, name, data = item
+    output_dir = config["output_dir"]
+    if output_dir is None:
+        return name, data
+
+    # Written under a temporary name so a crash never leaves a truncated PDF behind
+    pdf_path = output_dir / name
+    part_path = output_dir / (name + ".part")
+    part_path.write_bytes(data)
+    os.replace(part_path, pdf_path)
+    return pdf_path
+
+_STAGES = (_render_stage, _encode_stage, _sink_stage)
+
+def _generate_single_pdf(i: int, row: dict, config: dict):
+    """Run one row through every stage in the calling worker
+
+    Writes the PDF into config["output_dir"] and returns its path, or returns
+    (filename, pdf_bytes) when output_dir is None.
+    """
+    try:
+        item = (i, row)
+        for stage in _STAGES:
+            item = stage(item, config)
+        return item
     except Exception as e:
         print(f"Error generating PDF for row {i}: {str(e)}")
         return None
 
-def create_pdfs_from_rows(template_path: Path, rows: list, placeholders: dict, fonts_dir: Path, output_dir: Path, default_font: str, filename_field: str = None):
-    """Generate PDFs with parallel processing for better performance"""
+class _StagedPipeline:
+    """Thread-mode pipeline with one pool per stage
+
+    A row's task on the render pool hands its page to the encode pool, which
+    hands the PDF to the sink pool; the future submitted for the row resolves
+    to the next stage's future until the sink finishes. Stage time is
+    collected per stage (each runs on a different thread) and merged.
+    """
+
+    def __init__(self, config: dict, worker_counts):
+        self.config = config
+        self.pools = [ThreadPoolExecutor(max_workers=n) for n in worker_counts]
+
+    def submit(self, chunk):
+        (i, row), = chunk
+        return self.pools[0].submit(self._run, 0, (i, row), {})
+
+    def _run(self, index, item, totals):
+        with metrics.collect() as timer:
+            try:
+                result = _STAGES[index](item, self.config)
+            except Exception as e:
+                print(f"Error generating PDF for row {item[0]}: {str(e)}")
+                result = None
+        for name, seconds in timer.totals.items():
+            totals[name] = totals.get(name, 0.0) + seconds
+        if result is None or index == len(_STAGES) - 1:
+            return [(result, totals)]
+        return self.pools[index + 1].submit(self._run, index + 1, result, totals)
+
+    def shutdown(self):
+        # Earlier stages first, so work they hand on still has a pool to run on
+        for pool in self.pools:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+def _render_rows(config: dict, chunk):
+    """Render a list of (i, row) pairs with one job config
+
+    Returns (result, stage_totals) per row so timings survive the trip back
+    from a worker process.
+    """
+    out = []
+    for i, row in chunk:
+        with metrics.collect() as timer:
+            result = _generate_single_pdf(i, row, config)
+        out.append((result, timer.totals))
+    return out
+
+# Per-process render configuration, filled once by _init_worker in process mode
+_WORKER = {}
+
+def _init_worker(config: dict):
+    """Process pool initializer: keep the job config and warm template/font caches"""
+    _WORKER.update(config)
+    index_fonts(config["fonts_dir"])
+    load_template(config["template_path"])
+
+def _generate_chunk(chunk):
+    """Render a list of (i, row) pairs inside a worker process"""
+    return _render_rows(_WORKER, chunk)
+
+def _chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _resolve_executor(executor: str, row_count: int, workers: int):
+    """Pick the pool type and size; row_count is None for an unsized row iterator"""
+    mode = (executor or RENDER_EXECUTOR).lower()
+    if mode not in {"thread", "process", "auto"}:
+        raise ValueError(f"Unknown render executor '{executor}'")
+    if mode == "auto":
+        cpus = os.cpu_count() or 1
+        big = row_count is None or row_count >= RENDER_PROCESS_MIN_ROWS
+        mode = "process" if cpus > 1 and big else "thread"
+    if not workers:
+        workers = RENDER_WORKERS or (os.cpu_count() or 1 if mode == "process" else 4)
+    if row_count is not None:
+        workers = min(workers, row_count)
+    return mode, max(1, workers)
+
+def _iter_rendered(config: dict, rows, executor=None, workers=None, chunk_size=None,
+                   progress_callback=None, cancel_event=None, total=None, timings=None, row_filter=None,
+                   encode_workers=None, sink_workers=None):
+    """Render rows on the configured pool and yield each chunk's results in row order
+
+    rows may be a list or any iterator (e.g. iter_excel_rows); it is consumed
+    lazily so only the in-flight window of rows is held in memory. Rows for
+    which row_filter(i, row) is false keep their index but are not rendered.
+    In thread mode render, encode and sink run on separate pools sized by
+    workers, encode_workers and sink_workers.
+    """
+    if total is None and hasattr(rows, "__len__"):
+        total = len(rows)
+    if total == 0:
+        return
+    mode, max_workers = _resolve_executor(executor, total, workers)
+
+    if mode == "process":
+        # Config travels once per worker; rows travel in chunks instead of one pickle per row
+        chunk_size = max(1, chunk_size or RENDER_CHUNK_SIZE)
+        window = PIPELINE_DEPTH or max_workers * 4 * chunk_size
+        # a single chunk may not exceed the row window on its own
+        chunk_size = min(chunk_size, window)
+        ctx = multiprocessing.get_context(RENDER_MP_CONTEXT)
+        pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx,
+                                   initializer=_init_worker, initargs=(config,))
+        submit = partial(pool.submit, _generate_chunk)
+        shutdown = partial(pool.shutdown, wait=True, cancel_futures=True)
+    else:
+        chunk_size = 1
+        counts = (max_workers, max(1, encode_workers or ENCODE_WORKERS), max(1, sink_workers or SINK_WORKERS))
+        pipeline = _StagedPipeline(config, counts)
+        submit = pipeline.submit
+        shutdown = pipeline.shutdown
+        window = PIPELINE_DEPTH or sum(counts) * 2
+
+    # At most `window` rows are in flight in either mode, so pages and finished PDFs
+    # never pile up: the row source only advances when the oldest task has left the sink
+    pending = deque()
+    in_flight = 0
+    done = 0
+    skipped = 0
+
+    def _selected():
+        nonlocal skipped
+        for i, row in enumerate(rows, start=1):
+            if row_filter is None or row_filter(i, row):
+                yield i, row
+            else:
+                skipped += 1
+
+    try:
+        chunks = _chunked(_selected(), chunk_size)
+        while True:
+            if in_flight < window:
+                for chunk in chunks:
+                    pending.append((submit(chunk), len(chunk)))
+                    in_flight += len(chunk)
+                    if in_flight >= window:
+                        break
+            if not pending:
+                break
+            future, size = pending.popleft()
+            in_flight -= size
+            rendered = future.result()
+            while isinstance(rendered, Future):
+                # thread pipeline: follow the row to the stage it is in now
+                rendered = rendered.result()
+            results = []
+            for result, totals in rendered:
+                metrics.record_row(totals, ok=result is not None, breakdown=timings)
+                results.append(result)
+            done += len(results)
+            if progress_callback:
+                progress_callback(done + skipped, total)
+            if cancel_event is not None and cancel_event.is_set():
+                raise GenerationCancelled()
+            yield results
+        if progress_callback and skipped:
+            progress_callback(done + skipped, total)
+    finally:
+        for future, _ in pending:
+            future.cancel()
+        shutdown()
+
+def create_pdfs_from_rows(template_path: Path, rows: list, placeholders: dict, fonts_dir: Path, output_dir: Path, default_font: str, filename_field: str = None,
+                          executor: str = None, workers: int = None, chunk_size: int = None,
+                          progress_callback=None, cancel_event=None, total: int = None, output_mode: str = None,
+                          timings: dict = None, row_filter=None, static_keys=None, fits: dict = None,
+                          encoding: dict = None, encode_workers: int = None, sink_workers: int = None):
+    """Generate PDFs in parallel on a thread or process pool (executor: thread/process/auto)
+
+    rows can be a list or a row iterator (pass total for progress reporting).
+    row_filter(i, row) -> bool limits rendering to selected rows (i is 1-based).
+    progress_callback(done, total) is called as rows finish; setting cancel_event
+    stops the batch and raises GenerationCancelled. Per-stage time is added to
+    the timings dict when one is given. static_keys lists placeholders that
+    are constant across rows (see static_placeholder_keys); fits comes from
+    plan_layout and lets rows skip font fitting. encoding sets raster page
+    resolution and JPEG/Flate compression (see raster_encoding). encode_workers
+    and sink_workers size the thread-mode encode and file-writing stages.
+    """
+    config = {
+        "template_path": template_path,
+        "placeholders": placeholders,
+        "fonts_dir": fonts_dir,
+        "output_dir": output_dir,
+        "default_font": default_font,
+        "filename_field": filename_field,
+        "output_mode": output_mode or OUTPUT_MODE,
+        "static_keys": static_keys,
+        "fits": fits,
+        "encoding": encoding,
+    }
     pdf_paths = []
-    
-    # Prepare arguments for each row
-    args_list = [
-        (i, row, template_path, placeholders, fonts_dir, output_dir, default_font, filename_field)
-        for i, row in enumerate(rows, start=1)
-    ]
-    
-    # Use ThreadPoolExecutor for parallel PDF generation
-    max_workers = min(4, len(rows))  # Use up to 4 parallel workers
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(_generate_single_pdf, args) for args in args_list]
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                pdf_paths.append(result)
-    
+    for results in _iter_rendered(config, rows, executor, workers, chunk_size, progress_callback, cancel_event, total, timings,
+                                  row_filter, encode_workers, sink_workers):
+        pdf_paths.extend(r for r in results if r)
+
     # Sort by filename to maintain order
     pdf_paths.sort()
-    
+
     return pdf_paths
 
-def zip_files(files, zip_path: Path):
-    """Optimize zip creation with compression"""
-    with zipfile.ZipFile(str(zip_path), "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6) as z:
-        for f in files:
-            z.write(str(f), arcname=f.name)
+def iter_pdf_bytes(template_path: Path, rows: list, placeholders: dict, fonts_dir: Path, default_font: str, filename_field: str = None,
+                   executor: str = None, workers: int = None, chunk_size: int = None,
+                   progress_callback=None, cancel_event=None, total: int = None, output_mode: str = None,
+                   timings: dict = None, static_keys=None, fits: dict = None, encoding: dict = None):
+    """Yield (filename, pdf_bytes) for every row, in row order, without touching disk"""
+    config = {
+        "template_path": template_path,
+        "placeholders": placeholders,
+        "fonts_dir": fonts_dir,
+        "output_dir": None,
+        "default_font": default_font,
+        "filename_field": filename_field,
+        "output_mode": output_mode or OUTPUT_MODE,
+        "static_keys": static_keys,
+        "fits": fits,
+        "encoding": encoding,
+    }
+    for results in _iter_rendered(config, rows, executor, workers, chunk_size, progress_callback, cancel_event, total, timings):
+        for r in results:
+            if r:
+                yield r
+
+def create_merged_pdf(template_path: Path, rows, placeholders: dict, fonts_dir: Path, pdf_path: Path, default_font: str,
+                      progress_callback=None, cancel_event=None, total: int = None, timings: dict = None,
+                      fits: dict = None, encoding: dict = None, chunk_pages: int = None):
+    """Write every row as one page of a single PDF and return the page count
+
+    Pages use the vector layout, so the template background is stored once
+    per chunk and referenced by its pages; each page only adds its text
+    operators. Rows that need raster output get their own full-page image.
+    A ReportLab canvas keeps its pages in memory until saved, so rows are
+    drawn chunk_pages at a time and each finished chunk is appended to the
+    file.
+    """
+    if total is None and hasattr(rows, "__len__"):
+        total = len(rows)
+    chunk_pages = chunk_pages or MERGED_PDF_CHUNK_PAGES
+    page_size = get_template_image(template_path).size
+    part_path = pdf_path.with_name(pdf_path.name + ".part")
+    out = PdfAppender(part_path)
+    c, buf, chunk = None, None, 0
+
+    def flush():
+        with metrics.stage("pdf_encode"):
+            c.save()
+            out.append(buf.getvalue())
+
+    try:
+        for i, row in enumerate(rows, start=1):
+            if c is None:
+                buf = io.BytesIO()
+                c = canvas.Canvas(buf, pagesize=page_size)
+
+            ok = False
+            with metrics.collect() as timer:
+                try:
+                    ops = _vector_ops(layout_certificate(placeholders, row, fonts_dir, default_font, fits))
+                    if ops is not None:
+                        with metrics.stage("pdf_encode"):
+                            draw_vector_page(c, template_path, ops, page_size)
+                    else:
+                        img = render_certificate_image(template_path, placeholders, row, fonts_dir, default_font,
+                                                       fits=fits)
+                        with metrics.stage("pdf_encode"):
+                            c.drawImage(_page_image(img, encoding), 0, 0, width=page_size[0], height=page_size[1])
+                    c.showPage()
+                    chunk += 1
+                    ok = True
+                except Exception as e:
+                    print(f"Error generating page for row {i}: {str(e)}")
+            metrics.record_row(timer.totals, ok=ok, breakdown=timings)
+            if chunk >= chunk_pages:
+                flush()
+                c, buf, chunk = None, None, 0
+            if progress_callback:
+                progress_callback(i, total)
+            if cancel_event is not None and cancel_event.is_set():
+                raise GenerationCancelled()
+        if chunk:
+            flush()
+        pages = out.close()
+        os.replace(part_path, pdf_path)
+    finally:
+        out.abort()
+        part_path.unlink(missing_ok=True)
+    return pages
+
+def zip_files(files, zip_path: Path, compression=zipfile.ZIP_DEFLATED, compresslevel=6,
+              max_part_bytes=None, max_part_files=None):
+    """Optimize zip creation with compression
+
+    With max_part_bytes and/or max_part_files the batch is written as
+    independent archives <stem>.part001.zip, <stem>.part002.zip, ... instead,
+    each one openable on its own. Returns the paths written.
+    """
+    entries = [(f.name, f.stat().st_size, partial(_write_file_entry, f)) for f in (Path(f) for f in files)]
+    return write_zip(zip_path, entries, compression, compresslevel, max_part_bytes, max_part_files)
+
+
+def _write_file_entry(path: Path, z, arcname):
+    z.write(str(path), arcname=arcname)
+
+
+def write_zip(zip_path: Path, entries, compression=zipfile.ZIP_DEFLATED, compresslevel=6,
+              max_part_bytes=None, max_part_files=None):
+    """Write entries [(arcname, size, write(z, arcname))] as zip_path, or only as its volumes
+
+    With part limits nothing is written to zip_path itself: each entry goes
+    straight into its volume. Every archive is built under a temporary name
+    and all of them are renamed into place at the end, so entries may still
+    be read from the archives being replaced. Returns the paths written.
+    """
+    if max_part_bytes or max_part_files:
+        groups = _group_parts([size for _, size, _ in entries], max_part_bytes, max_part_files)
+        targets = [zip_part_name(zip_path, number) for number in range(1, len(groups) + 1)]
+    else:
+        groups, targets = [list(range(len(entries)))], [zip_path]
+    temps = [target.with_name(target.name + ".part") for target in targets]
+    try:
+        with metrics.stage("zip"):
+            for group, tmp in zip(groups, temps):
+                with zipfile.ZipFile(str(tmp), "w", compression=compression, compresslevel=compresslevel) as z:
+                    for i in group:
+                        name, _, write_entry = entries[i]
+                        write_entry(z, name)
+        for tmp, target in zip(temps, targets):
+            os.replace(tmp, target)
+    finally:
+        for tmp in temps:
+            tmp.unlink(missing_ok=True)
+    if targets[0] != zip_path:
+        # Volumes left over from an earlier, larger split of the same batch
+        number = len(targets) + 1
+        while zip_part_name(zip_path, number).exists():
+            zip_part_name(zip_path, number).unlink()
+            number += 1
+    return targets
+
+
+def _group_parts(sizes, max_bytes, max_files):
+    """Split entry indexes into consecutive runs of at most max_files entries and about max_bytes
+
+    A single entry larger than max_bytes gets a volume of its own.
+    """
+    groups, current, current_bytes = [], [], 0
+    for i, size in enumerate(sizes):
+        if current and ((max_files and len(current) >= max_files)
+                        or (max_bytes and current_bytes + size > max_bytes)):
+            groups.append(current)
+            current, current_bytes = [], 0
+        current.append(i)
+        current_bytes += size
+    if current:
+        groups.append(current)
+    return groups or [[]]
+
+
+class _ZipStreamBuffer:
+    """Write-only sink for ZipFile that hands bytes to a generator as they appear
+
+    It exposes tell() but no seek(), so ZipFile writes data descriptors and
+    never has to go back to patch a local header.
+    """
+
+    def __init__(self, tee=None):
+        self._buf = bytearray()
+        self._pos = 0
+        self._tee = tee
+
+    def write(self, data):
+        self._buf += data
+        self._pos += len(data)
+        if self._tee is not None:
+            self._tee.write(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+
+def stream_zip(entries, persist_path: Path = None, compression=zipfile.ZIP_STORED, compresslevel=None):
+    """Yield a ZIP archive chunk by chunk while (filename, data) entries arrive
+
+    PDFs are already compressed, so entries are stored by default. When
+    persist_path is given the same bytes are also written there (via a .part
+    file that is renamed once the archive is complete) for later re-download.
+    """
+    tee = None
+    part_path = None
+    if persist_path is not None:
+        part_path = persist_path.with_name(persist_path.name + ".part")
+        tee = part_path.open("wb")
+    completed = False
+    try:
+        sink = _ZipStreamBuffer(tee)
+        with zipfile.ZipFile(sink, "w", compression=compression, compresslevel=compresslevel) as z:
+            for name, data in entries:
+                info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                info.compress_type = compression
+                info.external_attr = 0o644 << 16
+                with metrics.stage("zip"):
+                    z.writestr(info, data, compress_type=compression, compresslevel=compresslevel)
+                chunk = sink.drain()
+                if chunk:
+                    yield chunk
+        chunk = sink.drain()
+        if chunk:
+            yield chunk
+        completed = True
+    finally:
+        if tee is not None:
+            tee.close()
+            if completed:
+                os.replace(part_path, persist_path)
+            else:
+                part_path.unlink(missing_ok=True)
@@ -0,0 +1,122 @@
+"""
+PDF Merge Module
+Appends the pages of ReportLab documents to one output file as they are produced
+"""
+
+import re
+from pathlib import Path
+
+_REF = re.compile(rb"(\d+) 0 R\b")
+_OBJ_HEADER = re.compile(rb"\s*(\d+) 0 obj\s*")
+_STREAM = re.compile(rb"\bstream\r?\n")
+
+# Object numbers reserved for the merged document's own catalog and page tree
+_CATALOG, _PAGES = 1, 2
+
+
+def _read_objects(data: bytes):
+    """({number: object body}, root number) from a classic-xref PDF (as ReportLab writes them)"""
+    start = int(data[data.rindex(b"startxref") + len(b"startxref"):].split()[0])
+    xref, _, trailer = data[start:].partition(b"trailer")
+    offsets = {}
+    lines = xref.split(b"\n")[1:]
+    i = 0
+    while i < len(lines) and lines[i].strip():
+        first, count = (int(v) for v in lines[i].split())
+        for n in range(count):
+            entry = lines[i + 1 + n].split()
+            if entry[2] == b"n":
+                offsets[first + n] = int(entry[0])
+        i += 1 + count
+    bounds = sorted(offsets.values()) + [start]
+    ends = dict(zip(bounds, bounds[1:]))
+    objects = {}
+    for num, offset in offsets.items():
+        body = data[offset:ends[offset]]
+        body = body[_OBJ_HEADER.match(body).end():]
+        objects[num] = body[:body.rindex(b"endobj")].rstrip()
+    root = int(re.search(rb"/Root (\d+) 0 R", trailer).group(1))
+    return objects, root
+
+
+def _head(body: bytes):
+    """The dictionary part of an object body (references are never rewritten inside streams)"""
+    m = _STREAM.search(body)
+    return body[:m.start()] if m else body
+
+
+class PdfAppender:
+    """Streams the pages of whole PDFs into one file
+
+    Each append() copies one document's pages and everything they use,
+    renumbered, straight to disk; only that document is in memory. The page
+    tree and the cross-reference table are written by close(). Inputs must
+    use a classic xref table without object streams or encryption, which is
+    what ReportLab produces.
+    """
+
+    def __init__(self, path: Path):
+        self._f = open(path, "wb")
+        self._f.write(b"%PDF-1.4\n%\x93\x8c\x8b\x9e\n")
+        self._offsets = {}
+        self._next = _PAGES + 1
+        self._kids = []
+
+    @property
+    def pages(self):
+        return len(self._kids)
+
+    def append(self, data: bytes):
+        """Add every page of the PDF in data; returns the number of pages added"""
+        objects, root = _read_objects(data)
+        tree = int(re.search(rb"/Pages (\d+) 0 R", objects[root]).group(1))
+        kids = [int(n) for n in _REF.findall(re.search(rb"/Kids\s*\[(.*?)\]", objects[tree], re.S).group(1))]
+
+        # Copy what the pages reach; the source catalog, info and page tree are left behind
+        numbers = {tree: _PAGES}
+        pending = list(kids)
+        while pending:
+            num = pending.pop()
+            if num in numbers:
+                continue
+            numbers[num] = self._next
+            self._next += 1
+            pending.extend(int(n) for n in _REF.findall(_head(objects[num])))
+
+        for old, new in sorted(numbers.items(), key=lambda item: item[1]):
+            if old == tree:
+                continue
+            body = objects[old]
+            head = _head(body)
+            rest = body[len(head):]
+            head = _REF.sub(lambda m: b"%d 0 R" % numbers[int(m.group(1))], head)
+            self._write_object(new, head + rest)
+        self._kids.extend(numbers[n] for n in kids)
+        return len(kids)
+
+    def _write_object(self, num: int, body: bytes):
+        self._offsets[num] = self._f.tell()
+        self._f.write(b"%d 0 obj\n" % num)
+        self._f.write(body)
+        self._f.write(b"\nendobj\n")
+
+    def close(self):
+        """Write the page tree, xref and trailer; returns the page count"""
+        if self._f.closed:
+            return self.pages
+        try:
+            self._write_object(_CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % _PAGES)
+            kids = b" ".join(b"%d 0 R" % n for n in self._kids)
+            self._write_object(_PAGES, b"<< /Type /Pages /Count %d /Kids [ %s ] >>" % (len(self._kids), kids))
+            start = self._f.tell()
+            self._f.write(b"xref\n0 %d\n0000000000 65535 f \n" % self._next)
+            for num in range(1, self._next):
+                self._f.write(b"%010d 00000 n \n" % self._offsets[num])
+            self._f.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                          % (self._next, _CATALOG, start))
+        finally:
+            self._f.close()
+        return self.pages
+
+    def abort(self):
+        self._f.close()
@@ -0,0 +1,74 @@
+"""
+Preview Module
+Low-resolution certificate previews with an in-memory render cache
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from .image_processor import get_template_image, render_scaled_image, pil_image_to_bytes
+from ..settings import PREVIEW_CACHE_SIZE, PREVIEW_CACHE_MB
+
+# format parameter -> (Pillow format, media type)
+PREVIEW_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+# Smallest scale a preview may be rendered at
+MIN_SCALE = 0.05
+
+# preview key -> encoded bytes, bounded by entry count and by total size
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+_CACHE_STATS = {"hits": 0, "misses": 0}
+_cache_bytes = 0
+
+
+def preview_key(*parts):
+    """Stable hash of everything a preview depends on (also used as its ETag)"""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def preview_scale(template_path: Path, width: int = None, scale: float = None):
+    """Scale factor for a requested output width or scale, rounded so nearby requests share cache entries"""
+    if width:
+        scale = width / get_template_image(template_path).size[0]
+    if not scale:
+        return 1.0
+    return round(min(1.0, max(MIN_SCALE, scale)), 3)
+
+
+def render_preview(key: str, template_path: Path, placeholders: dict, row: dict, fonts_dir: Path,
+                   default_font: str, scale: float = 1.0, fmt: str = "png", quality: int = None):
+    """Encoded preview bytes, rendered only on the first request for key"""
+    with _CACHE_LOCK:
+        data = _CACHE.get(key)
+        if data is not None:
+            _CACHE.move_to_end(key)
+            _CACHE_STATS["hits"] += 1
+            return data
+
+    global _cache_bytes
+    img = render_scaled_image(template_path, placeholders, row, fonts_dir, default_font, scale)
+    data = pil_image_to_bytes(img, format=PREVIEW_FORMATS[fmt][0], quality=quality)
+    max_bytes = PREVIEW_CACHE_MB * 1024 * 1024
+    with _CACHE_LOCK:
+        _CACHE_STATS["misses"] += 1
+        # a preview bigger than the whole budget is served but not kept
+        if len(data) <= max_bytes:
+            _cache_bytes += len(data) - len(_CACHE.pop(key, b""))
+            _CACHE[key] = data
+            while len(_CACHE) > PREVIEW_CACHE_SIZE or _cache_bytes > max_bytes:
+                _cache_bytes -= len(_CACHE.popitem(last=False)[1])
+    return data
+
+
+def preview_cache_stats():
+    with _CACHE_LOCK:
+        return {**_CACHE_STATS, "entries": len(_CACHE), "bytes": _cache_bytes}
@@ -0,0 +1,195 @@
+"""
+Shared State Module
+SQLite-backed session and job state shared by every server worker process
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    template_path TEXT,
+    excel_path TEXT,
+    placeholders TEXT NOT NULL DEFAULT '{}',
+    default_font TEXT,
+    filename_field TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    session_id TEXT,
+    state TEXT NOT NULL,
+    data TEXT NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs(session_id, updated_at);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+_PATH_FIELDS = ("template_path", "excel_path")
+_SESSION_FIELDS = ("template_path", "excel_path", "placeholders", "default_font", "filename_field")
+
+
+class StateStore:
+    """Thin wrapper around one SQLite file (WAL mode, one connection per thread)"""
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self.executescript(_SCHEMA)
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+
+    def executescript(self, sql):
+        self.connection().executescript(sql)
+
+    # ---- sessions ----
+
+    def get_session(self, session_id):
+        """Session state with paths as Path objects (empty state for unknown sessions)"""
+        row = self.execute("SELECT * FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        state = {"session_id": session_id, "template_path": None, "excel_path": None,
+                 "placeholders": {}, "default_font": None, "filename_field": None}
+        if row is None:
+            return state
+        for field in _SESSION_FIELDS:
+            state[field] = row[field]
+        for field in _PATH_FIELDS:
+            state[field] = Path(state[field]) if state[field] else None
+        state["placeholders"] = json.loads(row["placeholders"] or "{}")
+        return state
+
+    def update_session(self, session_id, **fields):
+        unknown = set(fields) - set(_SESSION_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown session fields: {sorted(unknown)}")
+        values = {}
+        for key, value in fields.items():
+            if key in _PATH_FIELDS:
+                value = str(value) if value else None
+            elif key == "placeholders":
+                value = json.dumps(value or {})
+            values[key] = value
+        self.execute("INSERT OR IGNORE INTO sessions (session_id, updated_at) VALUES (?, ?)",
+                     (session_id, time.time()))
+        if values:
+            assignments = ", ".join(f"{k} = ?" for k in values)
+            self.execute(f"UPDATE sessions SET {assignments}, updated_at = ? WHERE session_id = ?",
+                         (*values.values(), time.time(), session_id))
+
+    def expire_sessions(self, max_idle_seconds, limit=None):
+        """Delete (at most limit) sessions not changed for max_idle_seconds; returns their ids"""
+        cutoff = time.time() - max_idle_seconds
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN")
+            rows = conn.execute("SELECT session_id FROM sessions WHERE updated_at < ? ORDER BY updated_at LIMIT ?",
+                                (cutoff, -1 if limit is None else limit)).fetchall()
+            conn.executemany("DELETE FROM sessions WHERE session_id = ?", [(r["session_id"],) for r in rows])
+        return [r["session_id"] for r in rows]
+
+    # ---- jobs ----
+
+    def save_job(self, job_id, session_id, state, data):
+        self.execute(
+            """INSERT INTO jobs (job_id, session_id, state, data, updated_at) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(job_id) DO UPDATE SET session_id = excluded.session_id, state = excluded.state,
+               data = excluded.data, updated_at = excluded.updated_at""",
+            (job_id, session_id, state, json.dumps(data), time.time()),
+        )
+
+    def reset_job(self, job_id):
+        """Clear a previous run's cancel flag before the id is reused"""
+        self.execute("UPDATE jobs SET cancel_requested = 0 WHERE job_id = ?", (job_id,))
+
+    def get_job(self, job_id):
+        row = self.execute("SELECT state, data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def job_state(self, job_id):
+        row = self.execute("SELECT state FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row["state"] if row else None
+
+    def list_jobs(self, session_id, limit=200):
+        rows = self.execute("SELECT data FROM jobs WHERE session_id = ? ORDER BY updated_at DESC LIMIT ?",
+                            (session_id, limit)).fetchall()
+        return [json.loads(r["data"]) for r in rows]
+
+    def request_cancel(self, job_id):
+        return self.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ?", (job_id,)).rowcount > 0
+
+    def cancel_requested(self, job_id):
+        row = self.execute("SELECT cancel_requested FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def running_job_ids(self, max_idle_seconds=None):
+        """Jobs queued or running in any worker (optionally only those updated recently)"""
+        sql = "SELECT job_id FROM jobs WHERE state IN ('queued', 'running')"
+        params = ()
+        if max_idle_seconds is not None:
+            sql += " AND updated_at >= ?"
+            params = (time.time() - max_idle_seconds,)
+        return {r["job_id"] for r in self.execute(sql, params).fetchall()}
+
+    def touch_jobs(self, job_ids):
+        """Heartbeat: mark queued/running jobs as still owned by a live worker"""
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "UPDATE jobs SET updated_at = ? WHERE job_id = ? AND state IN ('queued', 'running')",
+                [(now, job_id) for job_id in job_ids],
+            )
+
+    def fail_stale_jobs(self, max_idle_seconds, error):
+        """Mark queued/running jobs without a heartbeat for max_idle_seconds as failed; returns their ids"""
+        now = time.time()
+        cutoff = now - max_idle_seconds
+        conn = self.connection()
+        with conn:
+            conn.execute("BEGIN")
+            rows = conn.execute(
+                "SELECT job_id FROM jobs WHERE state IN ('queued', 'running') AND updated_at < ?", (cutoff,)
+            ).fetchall()
+            conn.execute(
+                """UPDATE jobs SET state = 'failed', updated_at = ?,
+                   data = json_set(data, '$.state', 'failed', '$.error', ?)
+                   WHERE state IN ('queued', 'running') AND updated_at < ?""",
+                (now, error, cutoff),
+            )
+        return [r["job_id"] for r in rows]
+
+    # ---- leases ----
+
+    def try_lease(self, name, holder, seconds):
+        """Take (or renew) a named lease unless another holder's lease is still valid"""
+        now = time.time()
+        cur = self.execute(
+            """INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+               ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+               WHERE leases.expires_at < ? OR leases.holder = excluded.holder""",
+            (name, holder, now + seconds, now),
+        )
+        return cur.rowcount > 0
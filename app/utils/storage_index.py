@@ -0,0 +1,244 @@
+"""
+Storage Index Module
+SQLite index of generated, temporary and stored upload files so size queries and cleanup never walk the tree
+"""
+
+import os
+import re
+import time
+from pathlib import Path
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS storage_items (
+    path TEXT PRIMARY KEY,
+    area TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    job_id TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_storage_items_kind ON storage_items(kind, created_at);
+CREATE INDEX IF NOT EXISTS idx_storage_items_job ON storage_items(job_id, kind);
+CREATE TABLE IF NOT EXISTS storage_totals (
+    area TEXT PRIMARY KEY,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    files INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS storage_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS storage_items_ai AFTER INSERT ON storage_items BEGIN
+    UPDATE storage_totals SET bytes = bytes + NEW.size, files = files + (NEW.kind != 'job_dir')
+    WHERE area = NEW.area;
+END;
+CREATE TRIGGER IF NOT EXISTS storage_items_ad AFTER DELETE ON storage_items BEGIN
+    UPDATE storage_totals SET bytes = bytes - OLD.size, files = files - (OLD.kind != 'job_dir')
+    WHERE area = OLD.area;
+END;
+CREATE TRIGGER IF NOT EXISTS storage_items_au AFTER UPDATE OF size, area, kind ON storage_items BEGIN
+    UPDATE storage_totals SET bytes = bytes - OLD.size, files = files - (OLD.kind != 'job_dir')
+    WHERE area = OLD.area;
+    UPDATE storage_totals SET bytes = bytes + NEW.size, files = files + (NEW.kind != 'job_dir')
+    WHERE area = NEW.area;
+END;
+"""
+
+# Item kinds: zip / pdf (batch outputs in the output root), zip_part (one volume
+# of a split batch), job_dir / job_file (a job folder and the PDFs inside it)
+# temp (anything under the temp dir) and blob (a stored upload or a cache
+# derived from it, such as a parsed-sheet sidecar, under the CAS dir)
+
+_ZIP_PART_RE = re.compile(r"^(?P<job>.+)\.part(?P<number>\d{3,})\.zip$")
+
+
+def zip_part_name(zip_path: Path, number: int):
+    """Path of volume number (1-based) of a split batch: <job>.part001.zip"""
+    return zip_path.with_name(f"{zip_path.stem}.part{number:03d}.zip")
+
+
+def output_job_id(path: Path):
+    """(job_id, kind) of a file in the output root"""
+    match = _ZIP_PART_RE.match(path.name)
+    if match:
+        return match.group("job"), "zip_part"
+    return path.stem, path.suffix[1:]
+
+
+class StorageIndex:
+    """Files under the output, temp and (optionally) CAS dirs with their size, kind and owning job
+
+    Writers record files as they create and delete them. Running totals are
+    kept by triggers, so storage size is a single-row lookup. rebuild()
+    walks the tree once to reconcile changes made outside the app.
+    """
+
+    def __init__(self, state_store, output_dir, temp_dir, cas_dir=None):
+        self.store = state_store
+        self.areas = {"output": Path(output_dir), "temp": Path(temp_dir)}
+        if cas_dir is not None:
+            self.areas["cas"] = Path(cas_dir)
+        self.store.executescript(_SCHEMA)
+        # Triggers only update totals rows, so every area needs one up front
+        for area in self.areas:
+            self.store.execute("INSERT OR IGNORE INTO storage_totals (area) VALUES (?)", (area,))
+
+    def _area(self, path: Path):
+        for area, root in self.areas.items():
+            if path == root or root in path.parents:
+                return area
+        raise ValueError(f"{path} is outside the indexed directories")
+
+    @staticmethod
+    def _key(path):
+        return os.path.abspath(path)
+
+    def _row(self, path, kind, job_id):
+        path = Path(self._key(path))
+        st = path.stat()
+        size = 0 if kind == "job_dir" else st.st_size
+        return (str(path), self._area(path), kind, job_id, size, st.st_mtime)
+
+    def add(self, path, kind, job_id=None):
+        self.add_many([path], kind, job_id)
+
+    def add_many(self, paths, kind, job_id=None):
+        """Record (or refresh) files that were just written"""
+        rows = []
+        for p in paths:
+            try:
+                rows.append(self._row(p, kind, job_id))
+            except FileNotFoundError:
+                continue
+        if not rows:
+            return
+        conn = self.store.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                """INSERT INTO storage_items (path, area, kind, job_id, size, created_at) VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(path) DO UPDATE SET area = excluded.area, kind = excluded.kind,
+                   job_id = excluded.job_id, size = excluded.size, created_at = excluded.created_at""",
+                rows,
+            )
+
+    def remove(self, path):
+        self.store.execute("DELETE FROM storage_items WHERE path = ?", (self._key(path),))
+
+    def remove_many(self, paths):
+        conn = self.store.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM storage_items WHERE path = ?", [(self._key(p),) for p in paths])
+
+    def remove_tree(self, path):
+        """Forget path and everything below it (an indexed range scan on the primary key)"""
+        key = self._key(path)
+        self.store.execute(
+            "DELETE FROM storage_items WHERE path = ? OR (path >= ? AND path < ?)",
+            (key, key + os.sep, key + chr(ord(os.sep) + 1)),
+        )
+
+    # ---- queries ----
+
+    def totals(self):
+        """{area: {"bytes", "files"}} from the trigger-maintained totals table"""
+        rows = self.store.execute("SELECT area, bytes, files FROM storage_totals").fetchall()
+        return {r["area"]: {"bytes": r["bytes"], "files": r["files"]} for r in rows}
+
+    def expired(self, kinds, cutoff):
+        """Paths of the given kinds last written before cutoff, oldest first"""
+        marks = ", ".join("?" for _ in kinds)
+        rows = self.store.execute(
+            f"SELECT path, job_id FROM storage_items WHERE kind IN ({marks}) AND created_at < ? ORDER BY created_at",
+            (*kinds, cutoff),
+        ).fetchall()
+        return [(Path(r["path"]), r["job_id"]) for r in rows]
+
+    def batch_count(self):
+        """Batch outputs: every zip and merged PDF, plus every job written as zip volumes (once per job)"""
+        return self.store.execute(
+            """SELECT (SELECT COUNT(*) FROM storage_items WHERE kind IN ('zip', 'pdf'))
+                    + (SELECT COUNT(DISTINCT job_id) FROM storage_items WHERE kind = 'zip_part')"""
+        ).fetchone()[0]
+
+    def oldest_batches(self, limit):
+        """The limit oldest batch outputs; a job's volumes are one batch, listed by its first volume"""
+        rows = self.store.execute(
+            """SELECT path, job_id, created_at FROM storage_items WHERE kind IN ('zip', 'pdf')
+               UNION ALL
+               SELECT MIN(path), job_id, MIN(created_at) FROM storage_items WHERE kind = 'zip_part' GROUP BY job_id
+               ORDER BY created_at LIMIT ?""",
+            (limit,),
+        ).fetchall()
+        return [(Path(r["path"]), r["job_id"]) for r in rows]
+
+    def job_items(self, job_id, kinds):
+        """Paths of the given kinds belonging to job_id, by path"""
+        marks = ", ".join("?" for _ in kinds)
+        rows = self.store.execute(
+            f"SELECT path FROM storage_items WHERE job_id = ? AND kind IN ({marks}) ORDER BY path",
+            (job_id, *kinds),
+        ).fetchall()
+        return [Path(r["path"]) for r in rows]
+
+    def empty_job_dirs(self, cutoff):
+        """Job folders created before cutoff that hold no indexed files"""
+        rows = self.store.execute(
+            """SELECT d.path, d.job_id FROM storage_items d
+               WHERE d.kind = 'job_dir' AND d.created_at < ?
+               AND NOT EXISTS (SELECT 1 FROM storage_items f WHERE f.job_id = d.job_id AND f.kind = 'job_file')""",
+            (cutoff,),
+        ).fetchall()
+        return [(Path(r["path"]), r["job_id"]) for r in rows]
+
+    # ---- reconciliation ----
+
+    def is_built(self):
+        """Whether a rebuild has covered every area this index now tracks"""
+        row = self.store.execute("SELECT value FROM storage_meta WHERE key = 'areas'").fetchone()
+        return row is not None and row["value"] == ",".join(sorted(self.areas))
+
+    def rebuild(self):
+        """Walk the indexed dirs once and replace the index with what is on disk"""
+        output, temp, cas = self.areas["output"], self.areas["temp"], self.areas.get("cas")
+        entries = []
+        if output.exists():
+            for item in output.iterdir():
+                if item.is_dir():
+                    entries.append((item, "job_dir", item.name))
+                    entries.extend((f, "job_file", item.name) for f in item.rglob("*") if f.is_file())
+                elif item.suffix in (".zip", ".pdf"):
+                    job_id, kind = output_job_id(item)
+                    entries.append((item, kind, job_id))
+        if temp.exists():
+            entries.extend((f, "temp", None) for f in temp.rglob("*") if f.is_file())
+        if cas is not None and cas.exists():
+            entries.extend((f, "blob", None) for f in cas.rglob("*") if f.is_file())
+
+        rows = []
+        for path, kind, job_id in entries:
+            try:
+                rows.append(self._row(path, kind, job_id))
+            except FileNotFoundError:
+                continue
+        conn = self.store.connection()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM storage_items")
+            conn.execute("UPDATE storage_totals SET bytes = 0, files = 0")
+            conn.executemany(
+                "INSERT INTO storage_items (path, area, kind, job_id, size, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            conn.execute("INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('built_at', ?)",
+                         (str(time.time()),))
+            conn.execute("INSERT OR REPLACE INTO storage_meta (key, value) VALUES ('areas', ?)",
+                         (",".join(sorted(self.areas)),))
+        return len(rows)
+
+    def ensure_built(self):
+        """Build the index on first start; afterwards writers keep it current"""
+        if not self.is_built():
+            count = self.rebuild()
+            print(f"[Storage] Indexed {count} existing files")
@@ -9,18 +9,51 @@ import time
 from pathlib import Path
 from datetime import datetime, timedelta
 
+from .storage_index import output_job_id
+
+# Empty job folders younger than this are left alone (their job may still be starting)
+EMPTY_JOB_DIR_GRACE_SECONDS = 600
+
+# Uploads are stored before their session references them, so younger blobs are never quota victims
+BLOB_GRACE_SECONDS = 600
+
 
 class StorageManager:
     """Manages file cleanup and disk space"""
     
-    def __init__(self, output_dir, temp_dir, templates_dir, retention_hours=48):
+    def __init__(self, output_dir, temp_dir, templates_dir, retention_hours=48, content_store=None, index=None,
+                 max_zip_files=None, state_store=None, session_ttl_hours=None, max_cas_mb=None):
         self.output_dir = Path(output_dir)
         self.temp_dir = Path(temp_dir)
         self.templates_dir = Path(templates_dir)
         self.retention_seconds = retention_hours * 3600
+        # Oldest batch outputs beyond this many are deleted even inside the retention window
+        self.max_zip_files = max_zip_files
+        # ContentStore holding uploads; blobs are deleted once nothing references them
+        self.content_store = content_store
+        # StorageIndex of output/temp (and CAS) files; without one, sizes and ages come from walking the tree
+        self.index = index
+        # StateStore whose idle sessions expire after session_ttl_hours, releasing their uploads
+        self.state_store = state_store
+        self.session_ttl_seconds = session_ttl_hours * 3600 if session_ttl_hours else None
+        # Unreferenced uploads beyond this size are deleted oldest first, inside the retention window too
+        self.max_cas_bytes = int(max_cas_mb * 1024 * 1024) if max_cas_mb else None
     
     def get_storage_info(self):
         """Get current storage usage information"""
+        if self.index is not None:
+            totals = self.index.totals()
+            output_size = totals["output"]["bytes"]
+            temp_size = totals["temp"]["bytes"]
+            cas = totals.get("cas", {"bytes": 0, "files": 0})
+            return {
+                "output_dir_mb": round(output_size / (1024 * 1024), 2),
+                "temp_dir_mb": round(temp_size / (1024 * 1024), 2),
+                "uploads_mb": round(cas["bytes"] / (1024 * 1024), 2),
+                "total_mb": round((output_size + temp_size + cas["bytes"]) / (1024 * 1024), 2),
+                "files": totals["output"]["files"] + totals["temp"]["files"] + cas["files"]
+            }
+
         def get_dir_size(path):
             total = 0
             if path.exists():
@@ -38,34 +71,124 @@ class StorageManager:
             "total_mb": round((output_size + temp_size) / (1024 * 1024), 2)
         }
     
-    def cleanup_old_zips(self, force=False):
-        """Delete zip files older than retention period (or all if force=True)"""
+    def cleanup_old_zips(self, force=False, exclude_jobs=(), limit=None):
+        """Delete zip files, split zip volumes and merged batch PDFs older than retention period (or all if force=True)
+
+        Outputs of jobs in exclude_jobs are skipped; at most limit files are deleted.
+        """
+        if self.index is not None:
+            cutoff = float("inf") if force else time.time() - self.retention_seconds
+            candidates = self.index.expired(("zip", "pdf", "zip_part"), cutoff)
+        else:
+            if not self.output_dir.exists():
+                return 0
+            current_time = time.time()
+            candidates = [
+                (item, output_job_id(item)[0]) for item in self.output_dir.iterdir()
+                if item.is_file() and item.suffix in ('.zip', '.pdf')
+                and (force or current_time - item.stat().st_mtime > self.retention_seconds)
+            ]
+        return self._delete_outputs(candidates, exclude_jobs, limit)
+
+    def enforce_zip_quota(self, exclude_jobs=(), limit=None):
+        """Delete the oldest batches (and their job folders and volumes) beyond max_zip_files
+
+        A zip, a merged PDF or a job's set of zip volumes each count as one batch.
+        """
+        if not self.max_zip_files or self.index is None:
+            return 0
+        excess = self.index.batch_count() - self.max_zip_files
+        if excess <= 0:
+            return 0
+        oldest = self.index.oldest_batches(excess + len(exclude_jobs))
+        oldest = [(path, job_id) for path, job_id in oldest if job_id not in exclude_jobs][:excess]
+        if limit is not None:
+            oldest = oldest[:limit]
+        deleted = 0
+        for path, job_id in oldest:
+            if output_job_id(path)[1] != "zip_part":
+                deleted += self._delete_outputs([(path, job_id)], (), None)
+            if not path.exists() or output_job_id(path)[1] == "zip_part":
+                self.discard_job_folder(job_id)
+                deleted += self.discard_zip_parts(job_id)
+        return deleted
+
+    def _delete_outputs(self, candidates, exclude_jobs, limit):
         deleted_count = 0
-        if not self.output_dir.exists():
-            return deleted_count
-        
-        current_time = time.time()
-        for item in self.output_dir.iterdir():
-            if item.is_file() and item.suffix == '.zip':
-                file_age = current_time - item.stat().st_mtime
-                if force or file_age > self.retention_seconds:
-                    try:
-                        item.unlink()
-                        deleted_count += 1
-                        print(f"[{self._timestamp()}] Deleted zip: {item.name}")
-                    except Exception as e:
-                        print(f"Failed to delete {item.name}: {e}")
+        for item, job_id in candidates:
+            if limit is not None and deleted_count >= limit:
+                break
+            if job_id in exclude_jobs:
+                continue
+            try:
+                item.unlink(missing_ok=True)
+                deleted_count += 1
+                print(f"[{self._timestamp()}] Deleted zip: {item.name}")
+                if self.index is not None:
+                    self.index.remove(item)
+                if self.content_store is not None:
+                    # the output is gone, so its inputs no longer need to be kept for it
+                    self.content_store.forget_output(item.name)
+                    if output_job_id(item)[1] == 'zip':
+                        self.content_store.forget_row_fingerprints(job_id)
+            except Exception as e:
+                print(f"Failed to delete {item.name}: {e}")
         return deleted_count
+
+    def discard_zip_parts(self, job_id, keep=()):
+        """Remove the split volumes of a job's zip, except the paths in keep"""
+        if self.index is None:
+            return 0
+        keep = {Path(p) for p in keep}
+        parts = [path for path in self.index.job_items(job_id, ("zip_part",)) if path not in keep]
+        return self._delete_outputs([(path, job_id) for path in parts], (), None)
+
+    def discard_zip(self, job_id):
+        """Remove a job's single zip (e.g. once the batch is written as volumes instead)"""
+        zip_path = self.output_dir / f"{job_id}.zip"
+        if not zip_path.exists():
+            return 0
+        return self._delete_outputs([(zip_path, job_id)], (), None)
+
+    def discard_job_folder(self, job_id):
+        """Remove a job's folder of individual PDFs (e.g. once they are zipped)"""
+        folder = self.output_dir / job_id
+        if folder.is_dir():
+            shutil.rmtree(folder, ignore_errors=True)
+        if self.index is not None:
+            self.index.remove_tree(folder)
     
-    def cleanup_job_dirs(self, force=False):
+    def cleanup_job_dirs(self, force=False, exclude_jobs=(), limit=None):
         """Delete job directories (all if force=True, otherwise specific logic if needed)"""
         deleted_count = 0
+        if self.index is not None:
+            current_time = time.time()
+            cutoff = float("inf") if force else current_time - self.retention_seconds
+            candidates = dict(self.index.expired(("job_dir",), cutoff))
+            # Empty folders (e.g. from failed jobs) go regardless of age once they have sat for a while
+            candidates.update(self.index.empty_job_dirs(current_time - EMPTY_JOB_DIR_GRACE_SECONDS))
+            for item, job_id in candidates.items():
+                if limit is not None and deleted_count >= limit:
+                    break
+                if job_id in exclude_jobs:
+                    continue
+                try:
+                    shutil.rmtree(item, ignore_errors=True)
+                    self.index.remove_tree(item)
+                    deleted_count += 1
+                    print(f"[{self._timestamp()}] Deleted job folder: {item.name}")
+                except Exception as e:
+                    print(f"Failed to delete directory {item.name}: {e}")
+            return deleted_count
+
         if not self.output_dir.exists():
             return deleted_count
         
         current_time = time.time()
         for item in self.output_dir.iterdir():
-            if item.is_dir():
+            if limit is not None and deleted_count >= limit:
+                break
+            if item.is_dir() and item.name not in exclude_jobs:
                 try:
                     # If force is True, delete everything. 
                     # If force is False, check age (retention) or simply delete if empty.
@@ -90,14 +213,34 @@ class StorageManager:
                     print(f"Failed to delete directory {item.name}: {e}")
         return deleted_count
     
-    def cleanup_temp_files(self, force=False):
-        """Delete temporary files (force=True deletes all)"""
+    def cleanup_temp_files(self, force=False, limit=None, exclude_files=()):
+        """Delete temporary files (force=True deletes all but exclude_files, e.g. uploads in progress)"""
         deleted_count = 0
+        if self.index is not None:
+            cutoff = float("inf") if force else time.time() - self.retention_seconds
+            for item, _ in self.index.expired(("temp",), cutoff):
+                if limit is not None and deleted_count >= limit:
+                    break
+                if item.name in exclude_files:
+                    continue
+                try:
+                    item.unlink(missing_ok=True)
+                    self.index.remove(item)
+                    deleted_count += 1
+                    print(f"[{self._timestamp()}] Deleted temp: {item.name}")
+                except Exception as e:
+                    print(f"Failed to delete {item.name}: {e}")
+            return deleted_count
+
         if not self.temp_dir.exists():
             return deleted_count
         
         current_time = time.time()
         for item in self.temp_dir.iterdir():
+            if limit is not None and deleted_count >= limit:
+                break
+            if item.name in exclude_files:
+                continue
             try:
                 # Check age for both files and directories
                 file_age = current_time - item.stat().st_mtime
@@ -106,6 +249,10 @@ class StorageManager:
                         item.unlink()
                     elif item.is_dir():
                         shutil.rmtree(item, ignore_errors=True)
+                    if self.index is not None:
+                        self.index.remove_tree(item)
+                    if item.exists():
+                        continue
                     deleted_count += 1
                     print(f"[{self._timestamp()}] Deleted temp: {item.name}")
             except Exception as e:
@@ -144,16 +291,83 @@ class StorageManager:
                 print(f"Failed to delete template {old_template.name}: {e}")
         return deleted_count
     
-    def full_cleanup(self, force=False):
-        """Run all cleanup tasks. Set force=True to delete everything immediately."""
+    def cleanup_unreferenced_blobs(self, force=False, limit=None, exclude_jobs=()):
+        """Delete stored uploads no session, generation or job references (any age if force=True)
+
+        Running jobs hold job:{id}: references on the template and sheet they
+        read; only the references of jobs not in exclude_jobs are let go here.
+        """
+        deleted_count = 0
+        if self.content_store is None:
+            return deleted_count
+        self.content_store.release_job_refs(keep_jobs=exclude_jobs)
+        older_than = 0 if force else self.retention_seconds
+        for sha, path in self.content_store.unreferenced_blobs(older_than):
+            if limit is not None and deleted_count >= limit:
+                break
+            try:
+                self.content_store.delete_blob(sha)
+                deleted_count += 1
+                print(f"[{self._timestamp()}] Deleted unreferenced upload: {path.name}")
+            except Exception as e:
+                print(f"Failed to delete blob {path.name}: {e}")
+        return deleted_count
+
+    def cleanup_expired_sessions(self, limit=None):
+        """Forget sessions idle for longer than the session TTL and release the uploads they held"""
+        if self.state_store is None or not self.session_ttl_seconds:
+            return 0
+        expired = self.state_store.expire_sessions(self.session_ttl_seconds, limit)
+        for session_id in expired:
+            if self.content_store is not None:
+                self.content_store.release_refs(f"session:{session_id}:")
+            print(f"[{self._timestamp()}] Expired session: {session_id}")
+        return len(expired)
+
+    def enforce_cas_quota(self, limit=None):
+        """Delete the oldest unreferenced uploads while stored uploads exceed max_cas_bytes"""
+        if not self.max_cas_bytes or self.index is None or self.content_store is None:
+            return 0
+        deleted_count = 0
+        for sha, path in self.content_store.unreferenced_blobs(BLOB_GRACE_SECONDS):
+            if limit is not None and deleted_count >= limit:
+                break
+            if self.index.totals().get("cas", {"bytes": 0})["bytes"] <= self.max_cas_bytes:
+                break
+            try:
+                self.content_store.delete_blob(sha)
+                deleted_count += 1
+                print(f"[{self._timestamp()}] Deleted upload over quota: {path.name}")
+            except Exception as e:
+                print(f"Failed to delete blob {path.name}: {e}")
+        return deleted_count
+
+    def full_cleanup(self, force=False, exclude_jobs=(), max_items=None, exclude_files=()):
+        """Run all cleanup tasks. Set force=True to delete everything immediately.
+
+        Files of jobs in exclude_jobs (still running) and temp files named in
+        exclude_files (uploads still being received) are left alone. With
+        max_items, the pass stops after deleting that many items so callers
+        can spread a large cleanup over several batches.
+        """
         print(f"\n[{self._timestamp()}] === Starting Full Cleanup (Force={force}) ===")
-        
-        stats = {
-            "old_zips": self.cleanup_old_zips(force=force),
-            "job_dirs": self.cleanup_job_dirs(force=force),
-            "temp_files": self.cleanup_temp_files(force=force),
-            "old_templates": self.cleanup_old_templates(force=force)
-        }
+
+        tasks = [
+            ("old_zips", lambda limit: self.cleanup_old_zips(force=force, exclude_jobs=exclude_jobs, limit=limit)),
+            ("zip_quota", lambda limit: self.enforce_zip_quota(exclude_jobs=exclude_jobs, limit=limit)),
+            ("job_dirs", lambda limit: self.cleanup_job_dirs(force=force, exclude_jobs=exclude_jobs, limit=limit)),
+            ("temp_files", lambda limit: self.cleanup_temp_files(force=force, limit=limit,
+                                                                 exclude_files=exclude_files)),
+            ("old_templates", lambda limit: self.cleanup_old_templates(force=force)),
+            ("expired_sessions", lambda limit: self.cleanup_expired_sessions(limit=limit)),
+            ("unreferenced_uploads", lambda limit: self.cleanup_unreferenced_blobs(force=force, limit=limit,
+                                                                                   exclude_jobs=exclude_jobs)),
+            ("upload_quota", lambda limit: self.enforce_cas_quota(limit=limit)),
+        ]
+        stats = {}
+        for name, task in tasks:
+            remaining = None if max_items is None else max_items - sum(stats.values())
+            stats[name] = task(remaining) if remaining is None or remaining > 0 else 0
         
         storage_before = self.get_storage_info()
         print(f"[{self._timestamp()}] === Cleanup Complete ===")
@@ -0,0 +1,308 @@
+"""
+Upload Module
+Streaming upload validation and resumable chunked upload sessions
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+from ..settings import MAX_TEMPLATE_UPLOAD_MB, MAX_SHEET_UPLOAD_MB, UPLOAD_SESSION_TTL_HOURS
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    upload_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    received INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Accepted extensions per upload kind
+UPLOAD_KINDS = {
+    "template": {".png", ".jpg", ".jpeg"},
+    "excel": {".xlsx", ".xls", ".csv"},
+}
+
+# Leading bytes every file of that type starts with
+_MAGIC = {
+    ".png": b"\x89PNG\r\n\x1a\n",
+    ".jpg": b"\xff\xd8\xff",
+    ".jpeg": b"\xff\xd8\xff",
+    ".xlsx": b"PK\x03\x04",
+    ".xls": b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1",
+}
+_HEAD_SIZE = 8
+
+# Allowance for multipart boundaries and part headers on top of the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadRejected(ValueError):
+    """Upload refused; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def max_upload_bytes(kind: str):
+    mb = MAX_TEMPLATE_UPLOAD_MB if kind == "template" else MAX_SHEET_UPLOAD_MB
+    return int(mb * 1024 * 1024)
+
+
+def check_magic(ext: str, head: bytes):
+    """Reject content that does not match its extension (CSV only has to look like text)"""
+    if ext == ".csv":
+        if b"\x00" in head:
+            raise UploadRejected("CSV upload looks like a binary file")
+        return
+    if not head.startswith(_MAGIC[ext]):
+        raise UploadRejected(f"File content is not a valid {ext[1:].upper()} file")
+
+
+class MultipartFileParser:
+    """Incremental multipart/form-data parser for one file field
+
+    feed() takes request body chunks as they arrive and returns the bytes
+    of the file field found in them, so the file can be checked and written
+    without the body being spooled first. filename is set once the field's
+    part headers have been read; other fields are skipped.
+    """
+
+    def __init__(self, content_type: str, field: str = "file"):
+        ctype, params = parse_options_header(content_type or "")
+        if ctype != b"multipart/form-data" or not params.get(b"boundary"):
+            raise UploadRejected("Expected a multipart/form-data upload")
+        self.field = field.encode("utf-8")
+        self.filename = None
+        self.complete = False
+        self._in_file = False
+        self._data = []
+        self._headers = {}
+        self._name = b""
+        self._value = b""
+        self._parser = MultipartParser(params[b"boundary"], callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_end": self._on_end,
+        })
+
+    def feed(self, chunk: bytes):
+        try:
+            self._parser.write(chunk)
+        except UploadRejected:
+            raise
+        except Exception as e:
+            raise UploadRejected(f"Malformed multipart body: {e}")
+        data = b"".join(self._data)
+        self._data.clear()
+        return data
+
+    def finish(self):
+        if not self.complete:
+            raise UploadRejected("Incomplete multipart body")
+        if self.filename is None:
+            raise UploadRejected(f"No '{self.field.decode()}' file in the upload")
+
+    def _on_part_begin(self):
+        self._headers = {}
+        self._in_file = False
+
+    def _on_header_field(self, data, start, end):
+        self._name += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._name.strip().lower()] = self._value.strip()
+        self._name, self._value = b"", b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if options.get(b"name") == self.field and b"filename" in options:
+            if self.filename is not None:
+                raise UploadRejected("Only one file per upload")
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+            self._in_file = True
+
+    def _on_part_data(self, data, start, end):
+        if self._in_file:
+            self._data.append(data[start:end])
+
+    def _on_part_end(self):
+        self._in_file = False
+
+    def _on_end(self):
+        self.complete = True
+
+
+class UploadWriter:
+    """Writes chunks to a temp file, enforcing the size cap and hashing as data arrives
+
+    A writer resuming at a non-zero offset continues the hash handed over
+    from the previous chunk; without one (the earlier chunks went to another
+    worker process) it hashes the bytes already on disk once.
+    """
+
+    def __init__(self, path: Path, ext: str, limit: int, offset: int = 0, hasher=None):
+        self.path = Path(path)
+        self.ext = ext
+        self.limit = limit
+        self.size = offset
+        self._head = b"" if offset == 0 else None
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = self.path.open("r+b" if offset else "wb")
+        if offset:
+            # Drop anything past the committed offset (a chunk cut off mid-way)
+            self._f.seek(offset)
+            self._f.truncate()
+        if hasher is None:
+            hasher = hashlib.sha256()
+            if offset:
+                self._f.seek(0)
+                remaining = offset
+                while remaining > 0:
+                    block = self._f.read(min(1024 * 1024, remaining))
+                    hasher.update(block)
+                    remaining -= len(block)
+        self.hasher = hasher
+
+    def write(self, chunk: bytes):
+        if self.size + len(chunk) > self.limit:
+            raise UploadRejected(f"Upload exceeds its limit of {self.limit} bytes", status=413)
+        if self._head is not None:
+            self._head += chunk[:_HEAD_SIZE]
+            if len(self._head) >= _HEAD_SIZE:
+                check_magic(self.ext, self._head[:_HEAD_SIZE])
+                self._head = None
+        self._f.write(chunk)
+        self.hasher.update(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        if not self._f.closed:
+            self._f.close()
+
+    def finish(self):
+        """Close and run the checks that need the whole file; returns the sha256"""
+        self.close()
+        if self.size == 0:
+            raise UploadRejected("Empty upload")
+        if self._head is not None:
+            check_magic(self.ext, self._head)
+        return self.hasher.hexdigest()
+
+
+class UploadStore:
+    """Resumable uploads: metadata in SQLite, bytes appended to root/upload-<upload_id>.part
+
+    Part files sit directly in the temp dir, so the regular temp cleanup
+    removes abandoned ones by age (their mtime moves with every chunk).
+    The running sha256 of each upload is kept in memory between chunks, so
+    completing it does not read the file again.
+    """
+
+    def __init__(self, state_store, root):
+        self.store = state_store
+        self.root = Path(root)
+        # upload_id -> (committed offset, sha256 object covering bytes up to it)
+        self._hashes = {}
+        self._hashes_lock = threading.Lock()
+        self.store.executescript(_SCHEMA)
+
+    def part_path(self, upload_id: str):
+        return self.root / f"upload-{upload_id}.part"
+
+    def create(self, session_id: str, kind: str, filename: str, size: int):
+        if kind not in UPLOAD_KINDS:
+            raise UploadRejected(f"kind must be one of {sorted(UPLOAD_KINDS)}")
+        ext = Path(filename or "").suffix.lower()
+        if ext not in UPLOAD_KINDS[kind]:
+            raise UploadRejected(f"{kind} must be one of {sorted(UPLOAD_KINDS[kind])}")
+        if size <= 0:
+            raise UploadRejected("size must be positive")
+        if size > max_upload_bytes(kind):
+            raise UploadRejected(f"Upload exceeds the {max_upload_bytes(kind) // (1024 * 1024)} MB limit", status=413)
+        self.purge_expired()
+        upload_id = uuid.uuid4().hex
+        self.store.execute(
+            """INSERT INTO uploads (upload_id, session_id, kind, filename, ext, size, received, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, 0, ?)""",
+            (upload_id, session_id, kind, filename, ext, size, time.time()),
+        )
+        return self.get(upload_id, session_id)
+
+    def get(self, upload_id: str, session_id: str):
+        """Upload state, or None when unknown, owned by another session or expired"""
+        row = self.store.execute("SELECT * FROM uploads WHERE upload_id = ? AND session_id = ?",
+                                 (upload_id, session_id)).fetchone()
+        if row is None:
+            return None
+        if row["received"] and not self.part_path(upload_id).exists():
+            # temp cleanup removed the data; the upload cannot be resumed
+            self.discard(upload_id)
+            return None
+        return dict(row)
+
+    def _hasher(self, upload: dict):
+        """Copy of the hash covering the committed bytes, or None when this process has not seen them"""
+        with self._hashes_lock:
+            offset, hasher = self._hashes.get(upload["upload_id"], (None, None))
+        return hasher.copy() if offset == upload["received"] else None
+
+    def writer(self, upload: dict):
+        """UploadWriter appending at the upload's committed offset"""
+        limit = min(upload["size"], max_upload_bytes(upload["kind"]))
+        return UploadWriter(self.part_path(upload["upload_id"]), upload["ext"], limit, offset=upload["received"],
+                            hasher=self._hasher(upload) if upload["received"] else None)
+
+    def commit(self, upload_id: str, expected: int, writer: UploadWriter):
+        """Record the bytes a writer received; False if another request moved the offset meanwhile"""
+        cur = self.store.execute(
+            "UPDATE uploads SET received = ?, updated_at = ? WHERE upload_id = ? AND received = ?",
+            (writer.size, time.time(), upload_id, expected),
+        )
+        if cur.rowcount > 0:
+            with self._hashes_lock:
+                self._hashes[upload_id] = (writer.size, writer.hasher)
+            return True
+        return False
+
+    def sha256(self, upload: dict):
+        """sha256 of the received bytes as hashed while they arrived; None if another process took the last chunk"""
+        hasher = self._hasher(upload)
+        return hasher.hexdigest() if hasher is not None else None
+
+    def part_names(self):
+        """File names of every upload that can still be resumed"""
+        rows = self.store.execute("SELECT upload_id FROM uploads").fetchall()
+        return {self.part_path(r["upload_id"]).name for r in rows}
+
+    def discard(self, upload_id: str):
+        with self._hashes_lock:
+            self._hashes.pop(upload_id, None)
+        self.part_path(upload_id).unlink(missing_ok=True)
+        self.store.execute("DELETE FROM uploads WHERE upload_id = ?", (upload_id,))
+
+    def purge_expired(self):
+        """Forget uploads that have not received a chunk for UPLOAD_SESSION_TTL_HOURS"""
+        cutoff = time.time() - UPLOAD_SESSION_TTL_HOURS * 3600
+        rows = self.store.execute("SELECT upload_id FROM uploads WHERE updated_at < ?", (cutoff,)).fetchall()
+        for r in rows:
+            self.discard(r["upload_id"])
+        return len(rows)
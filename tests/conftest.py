@@ -0,0 +1,90 @@
+import base64
+import re
+import zlib
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+FONTS_DIR = Path(__file__).resolve().parent.parent / "app" / "static" / "fonts"
+FONT = "Oswald-Bold.ttf"
+
+
+@pytest.fixture
+def fonts_dir():
+    return FONTS_DIR
+
+
+@pytest.fixture
+def template(tmp_path):
+    path = tmp_path / "template.png"
+    Image.new("RGB", (1200, 850), "#f4efe1").save(path)
+    return path
+
+
+@pytest.fixture
+def placeholders():
+    return {
+        "name": {"label": "name", "x": 100, "y": 300, "width": 1000, "height": 120, "font": FONT},
+        "event": {"label": "event", "x": 100, "y": 500, "font_size": 40, "font": FONT},
+    }
+
+
+def pdf_image_streams(pdf: bytes):
+    """[(filters, decoded-from-transport bytes)] for every image XObject in a PDF"""
+    images = []
+    for match in re.finditer(rb"<<(.*?)>>\s*stream\r?\n", pdf, re.S):
+        header = match.group(1)
+        if b"/Subtype /Image" not in header:
+            continue
+        length = int(re.search(rb"/Length (\d+)", header).group(1))
+        data = pdf[match.end():match.end() + length]
+        filters = re.findall(rb"/(ASCII85Decode|FlateDecode|DCTDecode)", header)
+        if b"ASCII85Decode" in filters:
+            data = base64.a85decode(data.strip(), adobe=True) if data.startswith(b"<~") else \
+                base64.a85decode(data.strip().removesuffix(b"~>"))
+        images.append((filters, data))
+    return images
+
+
+def inflate(data: bytes):
+    return zlib.decompress(data)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """TestClient whose state DB, stored uploads, output/temp dirs and job pool all live under tmp_path
+
+    The scheduled cleanup is not started, so nothing outside tmp_path is
+    written or deleted.
+    """
+    from fastapi.testclient import TestClient
+    from app import main
+    from app.utils.content_store import ContentStore
+    from app.utils.job_manager import JobManager
+    from app.utils.on_demand import OnDemandStore
+    from app.utils.state_store import StateStore
+    from app.utils.storage_index import StorageIndex
+    from app.utils.storage_manager import StorageManager
+    from app.utils.uploads import UploadStore
+
+    output, temp, cas = tmp_path / "output", tmp_path / "temp", tmp_path / "cas"
+    for folder in (output, temp, cas):
+        folder.mkdir()
+    state = StateStore(tmp_path / "state.sqlite3")
+    index = StorageIndex(state, output, temp, cas)
+    content = ContentStore(cas, state, index=index)
+    monkeypatch.setattr(main, "OUTPUT_DIR", output)
+    monkeypatch.setattr(main, "TEMP_DIR", temp)
+    monkeypatch.setattr(main, "AUTO_CLEANUP_ENABLED", False)
+    monkeypatch.setattr(main, "state_store", state)
+    monkeypatch.setattr(main, "storage_index", index)
+    monkeypatch.setattr(main, "content_store", content)
+    monkeypatch.setattr(main, "upload_store", UploadStore(state, temp))
+    monkeypatch.setattr(main, "on_demand", OnDemandStore(state, tmp_path / "certificates", 1024 * 1024))
+    monkeypatch.setattr(main, "storage_manager", StorageManager(output, temp, tmp_path / "templates",
+                                                                content_store=content, index=index,
+                                                                state_store=state))
+    monkeypatch.setattr(main, "job_manager", JobManager(store=state))
+    with TestClient(main.app) as c:
+        yield c
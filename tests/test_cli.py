@@ -0,0 +1,25 @@
+import json
+
+from app import cli
+
+
+def test_shard_run_plans_only_its_rows_and_leaves_the_sheet_alone(tmp_path, template, placeholders, monkeypatch):
+    sheet = tmp_path / "people.csv"
+    sheet.write_text("name,event\n" + "".join(f"Person {i},Meetup\n" for i in range(6)), encoding="utf-8")
+    layout = tmp_path / "layout.json"
+    layout.write_text(json.dumps(placeholders), encoding="utf-8")
+    planned = []
+    real_plan = cli.plan_layout
+
+    def spy(placeholders, df, *args, **kwargs):
+        planned.append(list(df.index))
+        return real_plan(placeholders, df, *args, **kwargs)
+
+    monkeypatch.setattr(cli, "plan_layout", spy)
+    out = tmp_path / "out"
+    status = cli.main(["--template", str(template), "--sheet", str(sheet), "--placeholders", str(layout),
+                       "--out", str(out), "--output-mode", "vector", "--executor", "thread", "--shard", "1/2"])
+    assert status == 0
+    assert planned == [[1, 3, 5]]
+    assert len(list(out.glob("*.pdf"))) == 3
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["layout.json", "out", "people.csv", "template.png"]
@@ -0,0 +1,12 @@
+from app.utils.content_store import ContentStore
+from app.utils.state_store import StateStore
+
+
+def test_releasing_a_job_keeps_refs_of_similarly_named_jobs(tmp_path):
+    store = ContentStore(tmp_path / "cas", StateStore(tmp_path / "state.sqlite3"))
+    store.set_ref("ondemand:a_b:template", "aaa")
+    store.set_ref("ondemand:acb:template", "bbb")
+    store.set_ref("ondemand:a_b2:template", "ccc")
+    store.release_refs("ondemand:a_b:")
+    owners = {r["owner"] for r in store.store.execute("SELECT owner FROM blob_refs")}
+    assert owners == {"ondemand:acb:template", "ondemand:a_b2:template"}
@@ -0,0 +1,57 @@
+import pytest
+from openpyxl import Workbook
+
+from app.utils.excel_reader import constant_columns, count_rows, get_row, iter_excel_rows
+
+
+@pytest.fixture
+def csv_sheet(tmp_path):
+    path = tmp_path / "people.csv"
+    path.write_text("id,amount,name\n00123,1.50,Ada\n,,\n7,2,Grace\n", encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def xlsx_sheet(tmp_path):
+    path = tmp_path / "people.xlsx"
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["id", "name", "score"])
+    ws.append([12, "Ada", 1.5])
+    ws.append([None, "Grace", 2.0])
+    ws.append([14, "Linus", None])
+    wb.save(path)
+    return path
+
+
+@pytest.mark.parametrize("sheet", ["csv_sheet", "xlsx_sheet"])
+def test_streamed_rows_match_get_row(sheet, request):
+    path = request.getfixturevalue(sheet)
+    streamed = list(iter_excel_rows(path))
+    assert len(streamed) == count_rows(path)
+    for i, row in enumerate(streamed):
+        assert get_row(path, i) == row
+        assert {k: str(v) for k, v in get_row(path, i).items()} == {k: str(v) for k, v in row.items()}
+
+
+def test_csv_cells_keep_their_text(csv_sheet):
+    assert get_row(csv_sheet, 0) == {"id": "00123", "amount": "1.50", "name": "Ada"}
+
+
+def test_xlsx_integer_column_with_blank_stays_integer(xlsx_sheet):
+    assert get_row(xlsx_sheet, 0)["id"] == 12
+    assert str(get_row(xlsx_sheet, 0)["id"]) == "12"
+    assert "id" not in constant_columns(xlsx_sheet)
+
+
+def test_dataset_cache_is_bounded(tmp_path, monkeypatch):
+    from app.utils import excel_reader
+    monkeypatch.setattr(excel_reader, "DATASET_CACHE_SIZE", 2)
+    paths = []
+    for i in range(4):
+        path = tmp_path / f"sheet{i}.csv"
+        path.write_text(f"name\nrow{i}\n", encoding="utf-8")
+        paths.append(path)
+        get_row(path, 0)
+    cached = [key for key in excel_reader._DATASETS if key.startswith(str(tmp_path.resolve()))]
+    assert cached == [str(p.resolve()) for p in paths[-2:]]
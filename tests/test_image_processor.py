@@ -0,0 +1,19 @@
+from PIL import Image
+
+from app.utils import image_processor
+
+
+def test_template_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_processor, "TEMPLATE_CACHE_SIZE", 2)
+    image_processor.invalidate_template_cache()
+    paths = []
+    for i in range(4):
+        path = tmp_path / f"template{i}.png"
+        Image.new("RGB", (40, 30), (i, i, i)).save(path)
+        paths.append(path)
+        image_processor.get_template_image(path)
+        image_processor.get_scaled_template(path, 0.5)
+    # the least recently used template goes, together with its scaled copies
+    image_processor.get_template_image(paths[2])
+    assert list(image_processor._TEMPLATE_CACHE) == [str(paths[3].resolve()), str(paths[2].resolve())]
+    assert image_processor.template_cache_stats()["evictions"] >= 2
@@ -0,0 +1,66 @@
+import zipfile
+
+from app.utils.incremental import rebuild_zip
+from app.utils.storage_index import zip_part_name
+
+
+def _pdfs(folder, names):
+    folder.mkdir(exist_ok=True)
+    for name in names:
+        (folder / name).write_bytes(b"%PDF-1.4 " + name.encode() * 200)
+
+
+def _entries(paths):
+    entries = {}
+    for path in paths:
+        with zipfile.ZipFile(path) as z:
+            entries.update({name: z.read(name) for name in z.namelist()})
+    return entries
+
+
+def test_volumes_are_written_without_a_full_zip(tmp_path):
+    folder = tmp_path / "job"
+    names = [f"{i:03d}.pdf" for i in range(5)]
+    _pdfs(folder, names)
+    zip_path = tmp_path / "job.zip"
+    parts = rebuild_zip(zip_path, names, folder, max_part_files=2)
+    assert parts == [zip_part_name(zip_path, n) for n in (1, 2, 3)]
+    assert not zip_path.exists()
+    assert sorted(_entries(parts)) == names
+
+
+def test_rerun_copies_unchanged_entries_out_of_the_old_volumes(tmp_path):
+    folder = tmp_path / "job"
+    names = [f"{i:03d}.pdf" for i in range(5)]
+    _pdfs(folder, names)
+    zip_path = tmp_path / "job.zip"
+    before = _entries(rebuild_zip(zip_path, names, folder, max_part_files=2))
+    # PDFs were deleted after zipping; only one row is re-rendered
+    for name in names:
+        (folder / name).unlink()
+    _pdfs(folder, ["004.pdf"])
+    old = [zip_part_name(zip_path, n) for n in (1, 2, 3)]
+    parts = rebuild_zip(zip_path, names, folder, old_archives=old, max_part_files=4)
+    assert parts == [zip_part_name(zip_path, 1), zip_part_name(zip_path, 2)]
+    assert not zip_part_name(zip_path, 3).exists()
+    assert _entries(parts) == before
+
+
+def test_copied_entries_keep_their_compressed_bytes(tmp_path, monkeypatch):
+    folder = tmp_path / "job"
+    names = [f"{i:03d}.pdf" for i in range(3)]
+    _pdfs(folder, names)
+    old = rebuild_zip(tmp_path / "old.zip", names, folder, compresslevel=9)
+    for name in names:
+        (folder / name).unlink()
+
+    def no_inflate(*args, **kwargs):
+        raise AssertionError("an unchanged entry was decompressed to be copied")
+
+    monkeypatch.setattr(zipfile.ZipFile, "open", no_inflate)
+    new = rebuild_zip(tmp_path / "new.zip", names, folder, old_archives=old, compresslevel=1)
+    monkeypatch.undo()
+    with zipfile.ZipFile(old[0]) as a, zipfile.ZipFile(new[0]) as b:
+        assert b.testzip() is None
+        assert [(i.filename, i.compress_size, i.CRC) for i in a.infolist()] == \
+            [(i.filename, i.compress_size, i.CRC) for i in b.infolist()]
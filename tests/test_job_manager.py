@@ -0,0 +1,30 @@
+import threading
+import time
+
+from app.utils.job_manager import JobManager
+from app.utils.state_store import StateStore
+
+
+def test_shutdown_marks_queued_jobs_cancelled(tmp_path):
+    store = StateStore(tmp_path / "state.db")
+    manager = JobManager(max_concurrent_jobs=1, store=store)
+    release = threading.Event()
+    manager.submit("running", lambda job: release.wait(5))
+    manager.submit("queued", lambda job: None)
+    time.sleep(0.2)
+    manager.shutdown()
+    release.set()
+    assert store.job_state("queued") == "cancelled"
+
+
+def test_stale_jobs_stop_blocking_their_folder(tmp_path):
+    store = StateStore(tmp_path / "state.db")
+    # A row left behind by a worker that died mid-job
+    store.save_job("orphan", None, "running", {"state": "running"})
+    manager = JobManager(store=store, stale_seconds=0.2)
+    time.sleep(0.3)
+    assert "orphan" not in manager.active_job_ids()
+    job = manager.submit("orphan", lambda job: "ok")
+    job.future.result(timeout=5)
+    manager.shutdown()
+    assert store.job_state("orphan") == "completed"
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import main
+from conftest import FONT
+
+
+@pytest.fixture
+def job(client):
+    job = main.job_manager.submit("owned-job", lambda job: "ok", session_id="alice")
+    job.future.result(timeout=5)
+    return job
+
+
+def test_job_endpoints_hide_other_sessions_jobs(client, job):
+    assert client.get("/jobs/owned-job", headers={"X-Session-Id": "alice"}).status_code == 200
+    assert client.get("/jobs/owned-job", headers={"X-Session-Id": "mallory"}).status_code == 404
+    assert client.post("/jobs/owned-job/cancel", headers={"X-Session-Id": "mallory"}).status_code == 404
+    assert client.delete("/jobs/owned-job", headers={"X-Session-Id": "mallory"}).status_code == 404
+    assert client.delete("/jobs/owned-job", headers={"X-Session-Id": "alice"}).status_code == 200
+
+
+def test_manifest_is_scoped_to_the_jobs_session(client, job):
+    assert client.get("/manifest/owned-job", headers={"X-Session-Id": "mallory"}).status_code == 404
+    # the job exists for its owner, it just has no download
+    assert client.get("/manifest/owned-job", headers={"X-Session-Id": "alice"}).status_code == 404
+
+
+def test_clients_without_a_session_get_their_own_cookie(client):
+    first = client.get("/status")
+    sid = first.cookies.get("session_id")
+    assert sid and first.json()["session_id"] == sid
+    # the cookie is sent back from then on, so the session sticks
+    assert client.get("/status").json()["session_id"] == sid
+    other = TestClient(main.app).get("/status")
+    assert other.json()["session_id"] != sid
+
+
+def _session_with_inputs(client, template, placeholders, headers):
+    with open(template, "rb") as f:
+        assert client.post("/upload-template", files={"file": ("t.png", f, "image/png")},
+                           headers=headers).status_code == 200
+    sheet = b"name,event\nJane,Meetup\nJohn,Meetup\n"
+    assert client.post("/upload-excel", files={"file": ("s.csv", sheet, "text/csv")},
+                       headers=headers).status_code == 200
+    placeholders = {key: {"width": 1000, "height": 120, **cfg} for key, cfg in placeholders.items()}
+    assert client.post("/set-placeholders", json={"placeholders": placeholders, "default_font": FONT},
+                       headers=headers).status_code == 200
+
+
+def test_streamed_generation_is_a_tracked_job(client, template, placeholders):
+    alice = {"X-Session-Id": "alice"}
+    _session_with_inputs(client, template, placeholders, alice)
+    r = client.post("/generate", data={"stream": "true", "folder_name": "streamed"}, headers=alice)
+    assert r.status_code == 200 and r.content.startswith(b"PK")
+    job = client.get("/jobs/streamed", headers=alice).json()
+    assert job["state"] == "completed" and job["result"]["count"] == 2
+    assert client.get("/jobs/streamed", headers={"X-Session-Id": "mallory"}).status_code == 404
+
+
+def test_streamed_generation_refuses_a_folder_in_use(client, template, placeholders):
+    alice = {"X-Session-Id": "alice"}
+    _session_with_inputs(client, template, placeholders, alice)
+    release = threading.Event()
+    main.job_manager.submit("busy", lambda job: release.wait(5), session_id="alice")
+    try:
+        r = client.post("/generate", data={"stream": "true", "folder_name": "busy"}, headers=alice)
+        assert r.status_code == 409
+    finally:
+        release.set()
@@ -0,0 +1,104 @@
+import io
+import re
+import tracemalloc
+
+from PIL import Image
+
+from app.utils.pdf_generator import create_merged_pdf, create_pdfs_from_rows, render_pdf_bytes, raster_encoding
+from app.utils.pdf_merge import _read_objects
+from conftest import FONT, pdf_image_streams
+
+ROW = {"name": "Jane Doe", "event": "Spring Meetup"}
+
+
+def test_jpeg_page_renders_and_embeds_a_readable_jpeg(template, placeholders, fonts_dir):
+    pdf = render_pdf_bytes(template, placeholders, ROW, fonts_dir, FONT, "raster",
+                           encoding=raster_encoding("jpeg", 80))
+    assert pdf.startswith(b"%PDF")
+    jpegs = [data for filters, data in pdf_image_streams(pdf) if b"DCTDecode" in filters]
+    assert len(jpegs) == 1
+    with Image.open(io.BytesIO(jpegs[0])) as img:
+        assert img.format == "JPEG"
+        assert img.size == (1200, 850)
+
+
+def _noisy_template(path):
+    # Photographic-ish content so compressing the background has a real cost
+    Image.effect_noise((1600, 1130), 40).convert("RGB").save(path)
+    return path
+
+
+def test_vector_pages_reuse_the_encoded_background(tmp_path, placeholders, fonts_dir, monkeypatch):
+    from app.utils import pdf_generator
+    template = _noisy_template(tmp_path / "noisy.png")
+    encoded = []
+    real = pdf_generator.pdfdoc.PDFImageXObject
+
+    def counting(*args, **kwargs):
+        encoded.append(args)
+        return real(*args, **kwargs)
+
+    monkeypatch.setattr(pdf_generator.pdfdoc, "PDFImageXObject", counting)
+    pdfs = [render_pdf_bytes(template, placeholders, {**ROW, "name": f"Person {i}"}, fonts_dir, FONT, "vector")
+            for i in range(3)]
+    # one encode for all three documents, and each embeds the background exactly once
+    assert len(encoded) == 1
+    streams = [pdf_image_streams(pdf) for pdf in pdfs]
+    assert all(len(s) == 1 for s in streams)
+    assert streams[0] == streams[1] == streams[2]
+    raster_pdf = render_pdf_bytes(template, placeholders, ROW, fonts_dir, FONT, "raster")
+    assert len(pdfs[0]) < len(raster_pdf) * 1.1
+
+
+def _merged_peak(template, placeholders, fonts_dir, path, rows, chunk_pages):
+    rows = [{"name": f"Person {i}", "event": "Spring Meetup"} for i in range(rows)]
+    tracemalloc.start()
+    try:
+        pages = create_merged_pdf(template, rows, placeholders, fonts_dir, path, FONT, chunk_pages=chunk_pages)
+        return pages, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_merged_pdf_is_one_valid_document_across_chunks(tmp_path, template, placeholders, fonts_dir):
+    path = tmp_path / "merged.pdf"
+    pages, _ = _merged_peak(template, placeholders, fonts_dir, path, 7, chunk_pages=3)
+    assert pages == 7
+    # every xref offset must land on its object header
+    objects, root = _read_objects(path.read_bytes())
+    tree = int(re.search(rb"/Pages (\d+) 0 R", objects[root]).group(1))
+    assert b"/Count 7" in objects[tree]
+    assert sum(1 for body in objects.values() if re.search(rb"/Type /Page\b", body)) == 7
+
+
+def test_merged_pdf_memory_does_not_grow_with_page_count(tmp_path, template, placeholders, fonts_dir):
+    path = tmp_path / "merged.pdf"
+    _merged_peak(template, placeholders, fonts_dir, path, 5, chunk_pages=25)  # warm caches
+    _, small = _merged_peak(template, placeholders, fonts_dir, path, 100, chunk_pages=25)
+    pages, large = _merged_peak(template, placeholders, fonts_dir, path, 800, chunk_pages=25)
+    assert pages == 800
+    # one canvas for all 800 pages peaks at several times the 100-page run
+    assert large < small * 2
+
+
+def test_process_pipeline_window_is_counted_in_rows(tmp_path, template, placeholders, fonts_dir, monkeypatch):
+    from app.utils import pdf_generator
+    monkeypatch.setattr(pdf_generator, "PIPELINE_DEPTH", 6)
+    pulled = 0
+    ahead = []
+
+    def rows():
+        nonlocal pulled
+        for i in range(30):
+            pulled += 1
+            yield {"name": f"Person {i}", "event": "Spring Meetup"}
+
+    def progress(done, total):
+        ahead.append(pulled - done)
+
+    paths = create_pdfs_from_rows(template, rows(), placeholders, fonts_dir, tmp_path, FONT, executor="process",
+                                  workers=2, chunk_size=16, total=30, output_mode="vector",
+                                  progress_callback=progress)
+    assert len(paths) == 30
+    # before a result is handed back at most PIPELINE_DEPTH rows were read ahead of it
+    assert max(ahead) <= 6
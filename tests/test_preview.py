@@ -0,0 +1,19 @@
+from app.utils import preview
+from conftest import FONT
+
+ROW = {"name": "Jane Doe", "event": "Spring Meetup"}
+
+
+def test_preview_cache_is_bounded_by_size(template, placeholders, fonts_dir, monkeypatch):
+    monkeypatch.setattr(preview, "_CACHE", preview.OrderedDict())
+    monkeypatch.setattr(preview, "_cache_bytes", 0)
+    one = len(preview.render_preview("k0", template, placeholders, ROW, fonts_dir, FONT, 1.0, "png"))
+    # room for about two full-size previews
+    monkeypatch.setattr(preview, "PREVIEW_CACHE_MB", one * 2.5 / (1024 * 1024))
+    for i in range(1, 5):
+        preview.render_preview(f"k{i}", template, placeholders, {**ROW, "name": f"Person {i}"}, fonts_dir, FONT,
+                               1.0, "png")
+    stats = preview.preview_cache_stats()
+    assert stats["entries"] <= 2
+    assert stats["bytes"] == sum(len(v) for v in preview._CACHE.values()) <= one * 2.5
+    assert list(preview._CACHE)[-1] == "k4"
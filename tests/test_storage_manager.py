@@ -0,0 +1,118 @@
+from app.utils.content_store import ContentStore
+from app.utils.state_store import StateStore
+from app.utils.storage_manager import StorageManager
+
+
+def _manager(tmp_path, **kwargs):
+    return StorageManager(tmp_path / "output", tmp_path / "temp", tmp_path / "templates", **kwargs)
+
+
+def test_forced_temp_cleanup_skips_uploads_in_progress(tmp_path):
+    temp = tmp_path / "temp"
+    temp.mkdir()
+    (temp / "upload-live.part").write_bytes(b"half")
+    (temp / "stale.xlsx").write_bytes(b"old")
+    manager = _manager(tmp_path)
+    manager.cleanup_temp_files(force=True, exclude_files={"upload-live.part"})
+    assert [p.name for p in temp.iterdir()] == ["upload-live.part"]
+
+
+def test_blobs_read_by_running_jobs_survive_forced_cleanup(tmp_path):
+    content = ContentStore(tmp_path / "cas", StateStore(tmp_path / "state.sqlite3"))
+    src = tmp_path / "t.png"
+    src.write_bytes(b"template")
+    sha, path, _ = content.put_file(src, ".png")
+    # the session moved on to another template; only the running job still reads this one
+    content.set_ref("job:batch_1:template", sha)
+    manager = _manager(tmp_path, content_store=content)
+    assert manager.cleanup_unreferenced_blobs(force=True, exclude_jobs={"batch_1"}) == 0
+    assert path.exists()
+    # once the job is no longer active its hold is dropped and the blob goes
+    assert manager.cleanup_unreferenced_blobs(force=True) == 1
+    assert not path.exists()
+
+
+def _stores(tmp_path):
+    from app.utils.storage_index import StorageIndex
+    state = StateStore(tmp_path / "state.sqlite3")
+    index = StorageIndex(state, tmp_path / "output", tmp_path / "temp", tmp_path / "cas")
+    return state, index, ContentStore(tmp_path / "cas", state, index=index)
+
+
+def _blob(tmp_path, content, data, ext=".png"):
+    src = tmp_path / f"upload{ext}"
+    src.write_bytes(data)
+    return content.put_file(src, ext)
+
+
+def test_expired_sessions_release_their_uploads(tmp_path):
+    state, index, content = _stores(tmp_path)
+    sha, path, _ = _blob(tmp_path, content, b"template")
+    content.set_ref("session:idle:template", sha)
+    state.update_session("idle", template_path=path)
+    state.execute("UPDATE sessions SET updated_at = 0 WHERE session_id = 'idle'")
+    manager = _manager(tmp_path, content_store=content, index=index, state_store=state, session_ttl_hours=1)
+    assert manager.cleanup_expired_sessions() == 1
+    assert state.get_session("idle")["template_path"] is None
+    assert content.unreferenced_blobs() == [(sha, path)]
+
+
+def test_uploads_count_toward_storage_and_their_quota(tmp_path):
+    state, index, content = _stores(tmp_path)
+    kept, kept_path, _ = _blob(tmp_path, content, b"k" * 4096)
+    content.set_ref("session:a:template", kept)
+    old, old_path, _ = _blob(tmp_path, content, b"o" * 4096)
+    (old_path.parent / f".{old_path.name}.dataset.pkl").write_bytes(b"p" * 1024)
+    content.index_derived(old_path)
+    assert index.totals()["cas"] == {"bytes": 9216, "files": 3}
+    state.execute("UPDATE blobs SET created_at = 0")
+    manager = _manager(tmp_path, content_store=content, index=index, max_cas_mb=6000 / (1024 * 1024))
+    assert manager.get_storage_info()["files"] == 3
+    # only the unreferenced upload (and its sidecar) may go to get under the quota
+    assert manager.enforce_cas_quota() == 1
+    assert kept_path.exists() and not old_path.exists()
+    assert index.totals()["cas"] == {"bytes": 4096, "files": 1}
+
+
+def test_zip_volumes_count_once_toward_the_batch_quota(tmp_path):
+    import os
+    from app.utils.storage_index import StorageIndex, zip_part_name
+    output = tmp_path / "output"
+    output.mkdir()
+    index = StorageIndex(StateStore(tmp_path / "state.sqlite3"), output, tmp_path / "temp")
+    volumes = [zip_part_name(output / "old.zip", n) for n in (1, 2, 3)]
+    for age, path in enumerate([*volumes, output / "mid.zip", output / "new.pdf"]):
+        path.write_bytes(b"x")
+        os.utime(path, (1000 + age, 1000 + age))
+    index.add_many(volumes, "zip_part", "old")
+    index.add(output / "mid.zip", "zip", "mid")
+    index.add(output / "new.pdf", "pdf", "new")
+    assert index.batch_count() == 3
+    manager = _manager(tmp_path, index=index, max_zip_files=2)
+    # the oldest batch is the three volumes of "old", all removed together
+    assert manager.enforce_zip_quota() == 3
+    assert sorted(p.name for p in output.iterdir()) == ["mid.zip", "new.pdf"]
+    assert index.batch_count() == 2
+
+
+def test_temp_cleanup_reads_ages_from_the_index(tmp_path, monkeypatch):
+    import os
+    from pathlib import Path
+    from app.utils.storage_index import StorageIndex
+    temp = tmp_path / "temp"
+    temp.mkdir()
+    index = StorageIndex(StateStore(tmp_path / "state.sqlite3"), tmp_path / "output", temp)
+    for name, mtime in (("old.xlsx", 1000), ("upload-live.part", 1000), ("fresh.xlsx", None)):
+        (temp / name).write_bytes(b"x")
+        if mtime:
+            os.utime(temp / name, (mtime, mtime))
+        index.add(temp / name, "temp")
+
+    def no_scan(self):
+        raise AssertionError("temp dir was scanned")
+
+    monkeypatch.setattr(Path, "iterdir", no_scan)
+    manager = _manager(tmp_path, index=index)
+    assert manager.cleanup_temp_files(exclude_files={"upload-live.part"}) == 1
+    monkeypatch.undo()
+    assert sorted(p.name for p in temp.iterdir()) == ["fresh.xlsx", "upload-live.part"]
@@ -0,0 +1,54 @@
+import hashlib
+import io
+
+import pytest
+from PIL import Image
+
+from app.utils import content_store, uploads
+
+SESSION = {"X-Session-Id": "uploads-test"}
+
+
+@pytest.fixture
+def png():
+    buf = io.BytesIO()
+    Image.effect_noise((300, 200), 40).convert("RGB").save(buf, "PNG")
+    return buf.getvalue()
+
+
+def test_one_shot_upload_is_streamed_and_hashed(client, png):
+    r = client.post("/upload-template", files={"file": ("t.png", png, "image/png")}, headers=SESSION)
+    assert r.status_code == 200, r.text
+    assert r.json()["sha256"] == hashlib.sha256(png).hexdigest()
+
+
+def test_mislabelled_and_misnamed_uploads_are_refused(client, png):
+    r = client.post("/upload-template", files={"file": ("t.png", b"GIF89a" + png, "image/png")}, headers=SESSION)
+    assert r.status_code == 400
+    r = client.post("/upload-template", files={"file": ("t.gif", png, "image/gif")}, headers=SESSION)
+    assert r.status_code == 400
+
+
+def test_oversized_content_length_is_refused_up_front(client, png, monkeypatch):
+    monkeypatch.setattr(uploads, "MAX_TEMPLATE_UPLOAD_MB", 0.01)
+    body = b"x" * (uploads.max_upload_bytes("template") + uploads.MULTIPART_OVERHEAD + 1)
+    r = client.post("/upload-template", files={"file": ("t.png", body, "image/png")}, headers=SESSION)
+    assert r.status_code == 413
+
+
+def test_resumable_upload_is_hashed_as_chunks_arrive(client, png, monkeypatch):
+    r = client.post("/uploads", json={"kind": "template", "filename": "t.png", "size": len(png)}, headers=SESSION)
+    upload_id = r.json()["upload_id"]
+    half = len(png) // 2
+    for offset, chunk in ((0, png[:half]), (half, png[half:])):
+        r = client.put(f"/uploads/{upload_id}", content=chunk, headers={**SESSION, "Upload-Offset": str(offset)})
+        assert r.status_code == 200, r.text
+
+    def no_rehash(path):
+        raise AssertionError("completed upload was read again to hash it")
+
+    monkeypatch.setattr(content_store, "sha256_file", no_rehash)
+    r = client.post(f"/uploads/{upload_id}/complete", headers=SESSION)
+    assert r.status_code == 200, r.text
+    assert r.json()["sha256"] == hashlib.sha256(png).hexdigest()
+